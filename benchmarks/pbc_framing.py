@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the PBC frame decoder.
+
+Feeds RpbGetResp-sized frames, chunked like TCP reads, into the
+FrameReceiver used by RiakPBC and into the Int32StringReceiver it
+replaced, and reports per MB received the wall clock time and the bytes
+moved by each receiver's buffer operations (concatenation, slicing,
+compaction, body extraction). Small frames (200 bytes, 1K) are dominated
+by the per frame overhead, large ones by the copies.
+
+    python benchmarks/pbc_framing.py
+"""
+
+import time
+from struct import pack
+
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.test import proto_helpers
+
+from riakasaurus.transport.pbc.framing import FrameReceiver
+
+MB = 1024 * 1024
+READ_SIZE = 64 * 1024
+TOTAL = 64 * MB
+# the best of this many runs is reported
+RUNS = 3
+
+
+class LegacyReceiver(Int32StringReceiver):
+    MAX_LENGTH = 999999999
+    copied = 0
+
+    def dataReceived(self, data):
+        # alldata = self._unprocessed + data
+        self.copied += len(self._unprocessed) + len(data)
+        Int32StringReceiver.dataReceived(self, data)
+        # self._unprocessed = alldata[currentOffset:] copies the remainder
+        # whenever at least one frame was consumed
+        if self.consumed:
+            self.copied += len(self._unprocessed)
+        self.consumed = False
+
+    consumed = False
+
+    def stringReceived(self, data):
+        self.consumed = True
+        # packet = alldata[start:end], then RiakPBC sliced data[1:]
+        self.copied += len(data) + len(data) - 1
+        code, body = ord(data[0]), data[1:]
+
+
+class CountingReceiver(FrameReceiver):
+    MAX_LENGTH = 999999999
+    copied = 0
+
+    def dataReceived(self, data):
+        self.copied += len(data)
+        before = len(self._buffer)
+        FrameReceiver.dataReceived(self, data)
+        # compaction moves whatever partial frame is left to the front
+        if len(self._buffer) != before + len(data):
+            self.copied += len(self._buffer)
+
+    def frameReceived(self, code, body):
+        if len(body) < self.SLICE_MAX:
+            # sliced into a bytearray, then copied into a str
+            self.copied += 2 * len(body)
+        else:
+            self.copied += len(body)
+
+
+def run(receiver_class, frame_size):
+    body = 'x' * (frame_size - 1)
+    frame = pack('>IB', frame_size, 10) + body
+    frames = max(1, TOTAL // frame_size)
+    stream = frame * min(frames, max(1, 8 * MB // frame_size))
+    repeat = max(1, frames // max(1, 8 * MB // frame_size))
+    proto = receiver_class()
+    proto.makeConnection(proto_helpers.StringTransport())
+    received = 0
+    start = time.time()
+    for i in xrange(repeat):
+        for offset in xrange(0, len(stream), READ_SIZE):
+            chunk = stream[offset:offset + READ_SIZE]
+            proto.dataReceived(chunk)
+            received += len(chunk)
+    elapsed = time.time() - start
+    mbs = float(received) / MB
+    return elapsed / mbs * 1000, float(proto.copied) / mbs / MB
+
+
+def main():
+    print "%-10s %-22s %12s %16s" % ('frame', 'receiver', 'ms per MB',
+                                     'MB copied per MB')
+    for frame_size in (200, 1024, 64 * 1024, 1 * MB, 8 * MB):
+        for name, cls in (('Int32StringReceiver', LegacyReceiver),
+                          ('FrameReceiver', CountingReceiver)):
+            ms, copied = min(run(cls, frame_size) for i in xrange(RUNS))
+            if frame_size < 1024:
+                label = '%dB' % frame_size
+            else:
+                label = '%dK' % (frame_size // 1024)
+            print "%-10s %-22s %12.2f %16.2f" % (label, name, ms, copied)
+
+
+if __name__ == '__main__':
+    main()
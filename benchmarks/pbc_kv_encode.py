@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for encoding get, put and delete requests.
+
+Compares the generic path (an intermediate payload dict read back by
+RiakPBC.put/get/delete, which fill in the generated protobuf classes and
+serialize them) with the kv_codec encoders now used by PBCTransport, and
+reports the CPU time per request for each. Requests are written to an in
+memory transport, so only the client side cost is measured.
+
+    python benchmarks/pbc_kv_encode.py
+"""
+
+import time
+
+from twisted.test import proto_helpers
+
+from riakasaurus.client import RiakClient
+from riakasaurus.mapreduce import RiakLink
+from riakasaurus.transport import pbc
+from riakasaurus.transport.pbc import kv_codec
+
+ROUNDS = 20000
+
+
+def legacy_put(proto, robj):
+    # what PBCTransport.__put did before kv_codec
+    kwargs = {'w': 'default', 'dw': 'default', 'pw': 'default',
+              'return_body': True, 'if_none_match': False}
+    payload = {'value': robj.get_encoded_data(),
+               'content_type': robj.get_content_type()}
+    links = robj.get_links()
+    if links:
+        payload['links'] = [(l.get_bucket(), l.get_key(), l.get_tag())
+                            for l in links]
+    if robj.get_usermeta():
+        payload['usermeta'] = robj.get_usermeta().items()
+    if robj.get_indexes():
+        payload['indexes'] = [(i.get_field(), i.get_value())
+                              for i in robj.get_indexes()]
+    return proto.put(robj.get_bucket().name, robj.get_key(), payload,
+                     robj.vclock() or None,
+                     bucket_type=robj.get_bucket().bucket_type, **kwargs)
+
+
+def codec_put(proto, robj):
+    return proto.sendRequest(pbc.MSG_CODE_PUT_REQ, kv_codec.encode_put(
+        robj, w='default', dw='default', pw='default', return_body=True,
+        if_none_match=False))
+
+
+def legacy_get(proto, robj):
+    return proto.get(robj.get_bucket().name, robj.get_key(), r='default',
+                     pr='default', bucket_type=robj.get_bucket().bucket_type)
+
+
+def codec_get(proto, robj):
+    bucket = robj.get_bucket()
+    return proto.sendRequest(pbc.MSG_CODE_GET_REQ, kv_codec.encode_get(
+        bucket.name, robj.get_key(), bucket.bucket_type, r='default',
+        pr='default'))
+
+
+def legacy_delete(proto, robj):
+    return proto.delete(robj.get_bucket().name, robj.get_key(),
+                        bucket_type=robj.get_bucket().bucket_type,
+                        rw='default', r='default', w='default',
+                        dw='default', pr='default', pw='default')
+
+
+def codec_delete(proto, robj):
+    bucket = robj.get_bucket()
+    return proto.sendRequest(pbc.MSG_CODE_DEL_REQ, kv_codec.encode_delete(
+        bucket.name, robj.get_key(), bucket.bucket_type, rw='default',
+        r='default', w='default', dw='default', pr='default', pw='default'))
+
+
+def run(encode, robj):
+    # best of three, to keep other load on the machine out of the numbers
+    return min(run_once(encode, robj) for i in range(3))
+
+
+def run_once(encode, robj):
+    proto = pbc.RiakPBCClientFactory().buildProtocol(None)
+    transport = proto_helpers.StringTransport()
+    proto.makeConnection(transport)
+    start = time.clock()
+    for i in xrange(ROUNDS):
+        encode(proto, robj)
+        if i % 1000 == 0:
+            proto._pending.clear()
+            transport.clear()
+    return (time.clock() - start) / ROUNDS * 1000000
+
+
+def main():
+    bucket = RiakClient().bucket('benchmark')
+    small = bucket.new('key', {'name': 'value'})
+    rich = bucket.new('key', {'name': 'value' * 200})
+    rich.set_usermeta({'owner': 'someone', 'source': 'benchmark'})
+    rich.set_links([RiakLink('benchmark', 'other%d' % i, 'tag')
+                    for i in range(5)], all_link=True)
+    for i in range(5):
+        rich.add_index('field%d_bin' % i, 'value%d' % i)
+
+    print "%-14s %14s %14s %8s" % ('request', 'generic us', 'kv_codec us',
+                                    'speedup')
+    for name, robj, legacy, codec in (
+            ('get', small, legacy_get, codec_get),
+            ('put', small, legacy_put, codec_put),
+            ('put (meta)', rich, legacy_put, codec_put),
+            ('delete', small, legacy_delete, codec_delete)):
+        old = run(legacy, robj)
+        new = run(codec, robj)
+        print "%-14s %14.2f %14.2f %7.1fx" % (name, old, new, old / new)
+
+
+if __name__ == '__main__':
+    main()
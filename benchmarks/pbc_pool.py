@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for acquiring and releasing PBC connections.
+
+Compares the list based pool (every acquire filters the whole list of
+transports for retired ones and scans it for an idle one) with the idle
+deque and active set now used by PBCTransport, and reports the CPU time
+per acquire/release for different numbers of connections in use. The
+connections are protocols on in memory transports, no Riak is needed.
+
+    python benchmarks/pbc_pool.py
+"""
+
+import time
+
+from twisted.test import proto_helpers
+
+from riakasaurus.client import RiakClient
+from riakasaurus.transport import pbc, pbc_transport
+
+ROUNDS = 20000
+CONNECTIONS = 100
+
+
+def legacy_acquire(pool, transports):
+    # what PBCTransport._getFreeTransport did before the idle deque
+    transports[:] = [x for x in transports if not x.isRetired()]
+    for stp in transports:
+        if stp.isIdle():
+            stp.setActive()
+            stp.getTransport().setTimeout(pool.factory.timeout)
+            return stp
+
+
+def legacy_release(pool, stp):
+    stp._StatefulTransport__pending -= 1
+    pool.active_count -= 1
+
+
+def build(busy):
+    """
+    a pool of CONNECTIONS connections, busy of them in use
+    """
+    factory = pbc_transport.PBCTransport(RiakClient())
+    factory.MAX_TRANSPORTS = CONNECTIONS
+    factory.ADAPTIVE_LIMIT = False
+    pool, = factory.cluster.nodes
+    for i in range(CONNECTIONS):
+        proto = pbc.RiakPBCClientFactory().buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        stp = pbc_transport.StatefulTransport(pool)
+        stp.setTransport(proto)
+        stp.setActive()
+        pool._active.add(stp)
+        stp.setIdle()
+    # the ones acquired first stay in use
+    for i in range(busy):
+        pool._acquireTransport()
+    return pool
+
+
+def run_legacy(busy):
+    pool = build(busy)
+    # busy ones first, as they were created and used first
+    transports = list(pool._active) + list(pool._idle)
+    start = time.clock()
+    for i in xrange(ROUNDS):
+        legacy_release(pool, legacy_acquire(pool, transports))
+    return (time.clock() - start) / ROUNDS * 1000000
+
+
+def run_pool(busy):
+    pool = build(busy)
+    start = time.clock()
+    for i in xrange(ROUNDS):
+        pool._acquireTransport().setIdle()
+    return (time.clock() - start) / ROUNDS * 1000000
+
+
+def main():
+    print "%-14s %14s %14s %8s" % ('in use', 'list us', 'deque us',
+                                    'speedup')
+    for busy in (0, 50, 90, 99):
+        # best of three, to keep other load on the machine out of the
+        # numbers
+        old = min(run_legacy(busy) for i in range(3))
+        new = min(run_pool(busy) for i in range(3))
+        print "%-14s %14.2f %14.2f %7.1fx" % (
+            '%d/%d' % (busy, CONNECTIONS), old, new, old / new)
+
+
+if __name__ == '__main__':
+    main()
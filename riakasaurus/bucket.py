@@ -20,6 +20,7 @@ under the License.
 from twisted.internet import defer
 
 from riakasaurus.riak_object import RiakObject
+from riakasaurus.stream import ResultStream
 from twisted.python import log
 from twisted.internet import defer,reactor
 
@@ -323,7 +324,7 @@ class RiakBucket(object):
         obj._encode_data = False
         return obj
 
-    def get(self, key, r=None, pr=None):
+    def get(self, key, r=None, pr=None, timeout=None):
         """
         Retrieve a JSON-encoded object from Riak.
 
@@ -333,13 +334,16 @@ class RiakBucket(object):
         :type r: integer
         :param pr: PR-Value of the request (defaults to bucket's PR)
         :type pr: integer
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
         :rtype: :class:`RiakObject <riak.riak_object.RiakObject>`
         """
         obj = RiakObject(self._client, self, key)
         obj._encode_data = True
         r = self.get_r(r)
         pr = self.get_pr(pr)
-        return obj.reload(r=r, pr=pr)
+        return obj.reload(r=r, pr=pr, timeout=timeout)
 
     def delete(self, key, **kwargs):
         """Deletes an object from riak. Short hand for
@@ -353,7 +357,7 @@ class RiakBucket(object):
         return self.new(key).delete(**kwargs)
 
 
-    def head(self, key, r=None, pr=None):
+    def head(self, key, r=None, pr=None, timeout=None):
         """
         Retrieve a JSON-encoded object from Riak.
 
@@ -363,15 +367,18 @@ class RiakBucket(object):
         :type r: integer
         :param pr: PR-Value of the request (defaults to bucket's PR)
         :type pr: integer
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
         :rtype: :class:`RiakObject <riak.riak_object.RiakObject>`
         """
         obj = RiakObject(self._client, self, key)
         obj._encode_data = True
         r = self.get_r(r)
         pr = self.get_pr(pr)
-        return obj.head(r=r, pr=pr)
+        return obj.head(r=r, pr=pr, timeout=timeout)
 
-    def get_binary(self, key, r=None, pr=None):
+    def get_binary(self, key, r=None, pr=None, timeout=None):
         """
         Retrieve a binary/string object from Riak.
 
@@ -381,13 +388,16 @@ class RiakBucket(object):
         :type r: integer
         :param pr: PR-Value of the request (defaults to bucket's PR)
         :type pr: integer
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
         :rtype: :class:`RiakObject <riak.riak_object.RiakObject>`
         """
         obj = RiakObject(self._client, self, key)
         obj._encode_data = False
         r = self.get_r(r)
         pr = self.get_pr(pr)
-        return obj.reload(r=r, pr=pr)
+        return obj.reload(r=r, pr=pr, timeout=timeout)
 
     def set_n_val(self, nval):
         """
@@ -553,15 +563,48 @@ class RiakBucket(object):
         """
         return self._client.transport.reset_bucket_props(self)
 
-    def get_keys(self):
+    def get_keys(self, timeout=None):
         """
         Return all keys within the bucket.
 
         .. warning::
 
            At current, this is a very expensive operation. Use with caution.
+
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
+        """
+        return self._client.transport.get_keys(self, timeout=timeout)
+
+    def stream_keys(self, consumer=None, timeout=None):
+        """
+        Stream the keys within the bucket chunk by chunk as Riak sends them,
+        so only a few chunks are held in memory at any time.
+
+        Without a consumer a :class:`ResultStream
+        <riakasaurus.stream.ResultStream>` is returned, call its ``next()``
+        until it fires with ``None``. With a consumer, it is called with
+        every list of keys and a deferred is returned that fires once all
+        keys have been consumed. If the consumer returns a deferred, no
+        more keys are delivered until it fires.
+
+        .. warning::
+
+           At current, this is a very expensive operation. Use with caution.
+
+        :param consumer: optional callable receiving each list of keys
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
+        :rtype: ResultStream or deferred
         """
-        return self._client.transport.get_keys(self)
+        stream = ResultStream()
+        d = self._client.transport.stream_keys(self, stream, timeout=timeout)
+        d.addErrback(stream.fail)
+        if consumer is None:
+            return stream
+        return stream.consume(consumer)
 
     def new_binary_from_file(self, key, filename):
         """
@@ -574,6 +617,29 @@ class RiakBucket(object):
             mimetype = 'application/octet-stream'
         return self.new_binary(key, binary_data, mimetype)
 
+    @defer.inlineCallbacks
+    def store_file(self, key, filename, timeout=None):
+        """
+        Store the content of the specified file under key, streamed chunk
+        by chunk instead of read into memory like
+        :func:`new_binary_from_file`. Needs the HTTP transport.
+
+        :param key: Name of the key, None to have Riak generate one.
+        :type key: string
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
+        :rtype: :class:`RiakObject <riak.riak_object.RiakObject>`
+        """
+        mimetype, encoding = mimetypes.guess_type(filename)
+        if not mimetype:
+            mimetype = 'application/octet-stream'
+        obj = self.new_binary(key, None, mimetype)
+        obj._streaming_transport('put_stream')
+        with open(filename, "rb") as source:
+            yield obj.store_from(source, timeout=timeout)
+        defer.returnValue(obj)
+
     @defer.inlineCallbacks
     def search_enabled(self):
         """
@@ -616,12 +682,40 @@ class RiakBucket(object):
             raise Exception("Current %s bucket haven't bind to a search index yet" %self.name)
 
     def get_index(self, index, startkey, endkey=None, return_terms=None,
-                  max_results=None,continuation=None):
+                  max_results=None,continuation=None, timeout=None):
         """
         Queries a secondary index over objects in this bucket, returning keys.
         """
         return self._client.transport.get_index(
-            self._name,index, startkey, endkey,return_terms=return_terms,max_results=max_results,continuation=continuation,bucket_type = self.bucket_type)
+            self._name,index, startkey, endkey,return_terms=return_terms,max_results=max_results,continuation=continuation,bucket_type = self.bucket_type, timeout=timeout)
+
+    def stream_index(self, index, startkey, endkey=None, return_terms=None,
+                     max_results=None, consumer=None, timeout=None):
+        """
+        Queries a secondary index over objects in this bucket, delivering
+        the keys as Riak streams them. Range queries with ``return_terms``
+        deliver (term, key) tuples instead. If ``max_results`` is given the
+        index is walked page by page, following the continuation of every
+        page automatically, so only one page is ever in flight.
+
+        Without a consumer a :class:`ResultStream
+        <riakasaurus.stream.ResultStream>` is returned, call its ``next()``
+        until it fires with ``None``. With a consumer, it is called with
+        every list of results and a deferred is returned that fires once
+        the whole index range has been consumed. ``timeout`` applies to
+        the whole range, not to every page.
+
+        :rtype: ResultStream or deferred
+        """
+        stream = ResultStream()
+        d = self._client.transport.stream_index(
+            self._name, index, startkey, stream, endkey=endkey,
+            return_terms=return_terms, max_results=max_results,
+            bucket_type=self.bucket_type, timeout=timeout)
+        d.addErrback(stream.fail)
+        if consumer is None:
+            return stream
+        return stream.consume(consumer)
 
     def list_keys(self):
         """ Same as get_keys - for txRiak compat """
@@ -664,8 +758,8 @@ class RiakBucket(object):
 
         Fetches the value of a Riak Datatype.
 
-        .. note:: This request is automatically retried :attr:`retries`
-           times if it fails due to network error.
+        .. note:: This request is retried if it fails due to a network
+           error, see the retry_policy of the client.
 
         :param key: the key of the datatype
         :type key: string
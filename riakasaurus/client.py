@@ -13,8 +13,10 @@ from twisted.internet import defer
 
 from riakasaurus import mapreduce, bucket
 from riakasaurus.search import RiakSearch
+from riakasaurus.stream import ResultStream
 
 from riakasaurus import transport
+from riakasaurus.transport import cluster, retry
 from twisted.python import log
 
 
@@ -27,14 +29,37 @@ class RiakClient(object):
                 mapred_prefix='mapred',
                 client_id=None, r_value="default", w_value="default",
                 dw_value="default", transport=transport.HTTPTransport,
-                request_timeout=None):
+                request_timeout=None, max_frame_size=None,
+                spool_threshold=None, nodes=None, balancer='round_robin',
+                min_idle=0, retry_policy=None):
         """
         Construct a new RiakClient object.
 
         If a client_id is not provided, generate a random one.
-        """
-        self._host = host
-        self._port = port
+
+        To spread the requests over several nodes of a cluster, pass them
+        as nodes, a list of 'host', 'host:port' or (host, port) entries
+        (port defaults to port). balancer picks the node for each request:
+        'round_robin', 'least_outstanding', 'latency_weighted' or an
+        object with a select(nodes) method, see transport.cluster.
+
+        max_frame_size, spool_threshold and min_idle only apply to the
+        protocol buffers transport: the largest response accepted, the size
+        above which a response is spooled to a temporary file instead of
+        being held in memory (values of spooled objects are file-like), and
+        how many idle connections to every node are opened on start and
+        kept open.
+
+        Reads and pings failing due to a network error are retried with
+        retry_policy, by default a transport.retry.RetryPolicy() retrying
+        three times. Pass RetryPolicy(retries=0) to disable retries.
+        """
+        if nodes:
+            self._nodes = cluster.parseNodes(nodes, port)
+        else:
+            self._nodes = [(host, port)]
+        self._host, self._port = self._nodes[0]
+        self._balancer = balancer
         self._mapred_prefix = mapred_prefix
         if client_id:
             self._client_id = client_id
@@ -56,6 +81,12 @@ class RiakClient(object):
         self._solr = None
 
         self.request_timeout = request_timeout
+        self.max_frame_size = max_frame_size
+        self.spool_threshold = spool_threshold
+        self.min_idle = min_idle
+        if retry_policy is None:
+            retry_policy = retry.RetryPolicy()
+        self.retry_policy = retry_policy
 
         self.transport = transport(self)
 
@@ -343,6 +374,21 @@ class RiakClient(object):
 
         return self.transport.get_buckets(bucket_type)
 
+    def stream_buckets(self, bucket_type='default', consumer=None):
+        """
+        Stream the list of all buckets chunk by chunk as Riak sends them,
+        see :func:`RiakBucket.stream_keys
+        <riakasaurus.bucket.RiakBucket.stream_keys>` for the consumer.
+
+        :rtype: ResultStream or deferred
+        """
+        stream = ResultStream()
+        d = self.transport.stream_buckets(stream, bucket_type)
+        d.addErrback(stream.fail)
+        if consumer is None:
+            return stream
+        return stream.consume(consumer)
+
     def index(self, *args):
         """
         Start assembling a Map/Reduce operation based on secondary
@@ -387,8 +433,8 @@ class RiakClient(object):
 
         Gets the value of a counter.
 
-        .. note:: This request is automatically retried :attr:`RETRY_COUNT`
-           times if it fails due to network error.
+        .. note:: This request is retried if it fails due to a network
+           error, see the retry_policy of the client.
 
         :param bucket: the bucket of the counter
         :type bucket: RiakBucket
@@ -10,6 +10,21 @@ class ConnectTimeout(Exception):
     """
 
 
+class PoolExhausted(Exception):
+    """
+        Raised when no connection could be acquired from the pool, either
+        because too many requests are waiting already or because none was
+        released in time
+    """
+
+
+class CircuitOpen(Exception):
+    """
+        Raised without sending a request when the circuit breaker of the
+        node (or of every node) is open
+    """
+
+
 class RiakPBCException(Exception):
     """Generic PBC exception"""
     pass
@@ -23,6 +23,7 @@ from twisted.internet import defer
 
 from riakasaurus.riak_object import RiakObject
 from riakasaurus.bucket import RiakBucket
+from riakasaurus.stream import ResultStream
 from twisted.python import log
 
 
@@ -199,13 +200,11 @@ class RiakMapReduce(object):
         self._phases.append(mr)
         return self
 
-    @defer.inlineCallbacks
-    def run(self, timeout=None):
+    def _build_query(self):
         """
-        Run the map/reduce operation. Returns an array of results, or an
-        array of RiakLink objects if the last phase is a link phase.
-        @param integer timeout - Timeout in milliseconds.
-        @return array()
+        Convert the phases and inputs to the job description sent to
+        Riak. Used internally.
+        @return (inputs, query, link_results_flag)
         """
         num_phases = len(self._phases)
 
@@ -243,8 +242,20 @@ class RiakMapReduce(object):
                     'key_filters':  self._key_filters
                 }
 
+        return self._inputs, query, link_results_flag
+
+    @defer.inlineCallbacks
+    def run(self, timeout=None):
+        """
+        Run the map/reduce operation. Returns an array of results, or an
+        array of RiakLink objects if the last phase is a link phase.
+        @param integer timeout - Timeout in milliseconds.
+        @return array()
+        """
+        inputs, query, link_results_flag = self._build_query()
+
         t = self._client.get_transport()
-        result = yield t.mapred(self._inputs, query, timeout)
+        result = yield t.mapred(inputs, query, timeout)
 
         # If the last phase is NOT a link phase, then return the result.
         link_results_flag = link_results_flag or isinstance(
@@ -271,6 +282,27 @@ class RiakMapReduce(object):
 
         defer.returnValue(a)
 
+    def stream(self, consumer=None, timeout=None):
+        """
+        Run the map/reduce operation, delivering the results of every
+        phase as soon as Riak sends them instead of collecting the whole
+        result set first. Each chunk is a tuple (phase, results) where
+        results is the decoded list of values for that phase.
+        Link phase results are not converted to RiakLink objects.
+        @param callable consumer - Optional, called with every chunk. If it
+        returns a deferred, no more chunks are delivered until it fired.
+        @param integer timeout - Timeout in milliseconds.
+        @return ResultStream, or a deferred if a consumer is given
+        """
+        inputs, query, link_results_flag = self._build_query()
+        stream = ResultStream()
+        t = self._client.get_transport()
+        d = t.stream_mapred(inputs, query, stream, timeout)
+        d.addErrback(stream.fail)
+        if consumer is None:
+            return stream
+        return stream.consume(consumer)
+
     ##
     # Start Shortcuts to built-ins
     ##
@@ -19,7 +19,6 @@ under the License.
 """
 
 import types
-import copy
 
 from twisted.internet import defer
 
@@ -57,6 +56,8 @@ class RiakObject(object):
         self._encode_data = True
         self._vclock = None
         self._data = None
+        # encoded data as read from Riak, decoded on first access
+        self._encoded = None
         self._metadata = {MD_USERMETA: {}, MD_INDEX: []}
         self._links = []
         self._siblings = []
@@ -86,8 +87,14 @@ class RiakObject(object):
         :func:`RiakBucket.get_binary <riak.bucket.RiakBucket.get_binary>`,
         in which case this will return a string.
 
-        :rtype: array or string
+        Values of binary objects that were spooled to disk (see the
+        ``spool_threshold`` of :class:`RiakClient`) are returned as a
+        file-like object.
+
+        :rtype: array, string or file-like
         """
+        if self._encoded is not None:
+            self._decode()
         return self._data
 
     def set_data(self, data):
@@ -102,6 +109,7 @@ class RiakObject(object):
         :type data: mixed
         :rtype: data
         """
+        self._encoded = None
         self._data = data
         if MD_CTYPE not in self._metadata:
             if self._encode_data:
@@ -114,12 +122,17 @@ class RiakObject(object):
         """
         Get the data encoded for storing
         """
+        if self._encoded is not None:
+            # never decoded, still exactly what was read
+            return self._encoded
         if self._encode_data == True:
             content_type = self.get_content_type()
             encoder = self._bucket.get_encoder(content_type)
             if encoder is None:
                 if isinstance(self._data, basestring):
                     return self._data.encode()
+                elif hasattr(self._data, 'read'):
+                    return self._data
                 else:
                     raise RiakError("No encoder for non-string data "
                                     "with content type ${0}".
@@ -132,20 +145,27 @@ class RiakObject(object):
     def set_encoded_data(self, data):
         """
         Set the object data from an encoded string. Make sure
-        the metadata has been set correctly first.
+        the metadata has been set correctly first. The data is decoded
+        when it is first accessed.
         """
+        self._data = None
+        self._encoded = data
+        return self
+
+    def _decode(self):
+        data = self._encoded
         if self._encode_data == True:
             content_type = self.get_content_type()
             decoder = self._bucket.get_decoder(content_type)
-            if decoder is None:
-                # if no decoder, just set as string data for
-                # application to handle
-                self._data = data
-            else:
-                self._data = decoder(data)
-        else:
-            self._data = data
-        return self
+            if decoder is not None:
+                if hasattr(data, 'read'):
+                    # a spooled value, decoding needs all of it
+                    data = data.read()
+                data = decoder(data)
+            # if no decoder, just set as string data for
+            # application to handle
+        self._data = data
+        self._encoded = None
 
     def get_metadata(self):
         """
@@ -393,7 +413,7 @@ class RiakObject(object):
 
     @defer.inlineCallbacks
     def store(self, w=None, dw=None, pw=None, return_body=True,
-              if_none_match=False):
+              if_none_match=False, timeout=None):
         """
         Store the object in Riak. When this operation completes, the
         object could contain new metadata and possibly new data if Riak
@@ -414,6 +434,9 @@ class RiakObject(object):
         :param if_none_match: Should the object be stored only if there is no
                               key previously defined
         :type if_none_match: bool
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
         :rtype: self
         """
         # Use defaults if not specified...
@@ -426,7 +449,8 @@ class RiakObject(object):
 
         if self._key is None:
             key, vclock, metadata = yield t.put_new(self, w=w, dw=dw, pw=pw,
-                return_body=return_body, if_none_match=if_none_match)
+                return_body=return_body, if_none_match=if_none_match,
+                timeout=timeout)
 
             self._exists = True
             self._key = key
@@ -434,7 +458,8 @@ class RiakObject(object):
             self.set_metadata(metadata)
         else:
             Result = yield t.put(self, w=w, dw=dw, pw=pw,
-                return_body=return_body, if_none_match=if_none_match)
+                return_body=return_body, if_none_match=if_none_match,
+                timeout=timeout)
 
             if Result is not None:
                 self.populate(Result)
@@ -442,7 +467,70 @@ class RiakObject(object):
         defer.returnValue(self)
 
     @defer.inlineCallbacks
-    def reload(self, r=None, pr=None, vtag=None):
+    def store_from(self, source, w=None, dw=None, pw=None, timeout=None):
+        """
+        Store the object in Riak with its value read from source chunk by
+        chunk, so a large value is never held in memory. The data of the
+        object is ignored, its metadata is stored. Needs the HTTP
+        transport.
+
+        :param source: file like object or
+                       :class:`IBodyProducer <twisted.web.iweb.IBodyProducer>`
+        :param w: W-value, see :func:`store`
+        :param dw: DW-value, see :func:`store`
+        :param pw: PW-value, see :func:`store`
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
+        :rtype: self
+        """
+        w = self._bucket.get_w(w)
+        dw = self._bucket.get_dw(dw)
+        pw = self._bucket.get_pw(pw)
+        t = self._streaming_transport('put_stream')
+        self._key = yield t.put_stream(self, source, w=w, dw=dw, pw=pw,
+                                       timeout=timeout)
+        self._exists = True
+        defer.returnValue(self)
+
+    def _streaming_transport(self, method):
+        # a protocol buffers value is a single message, it can't be streamed
+        t = self._client.get_transport()
+        if not hasattr(t, method):
+            raise RiakError("Streaming values needs the HTTP transport")
+        return t
+
+    @defer.inlineCallbacks
+    def fetch_to(self, consumer, r=None, pr=None, timeout=None):
+        """
+        Load the object from Riak, writing its value to consumer chunk by
+        chunk as it arrives instead of keeping it in the object. Only the
+        metadata is loaded, or the siblings if there are any. Needs the
+        HTTP transport.
+
+        :param consumer: file like object or
+                         :class:`IConsumer
+                         <twisted.internet.interfaces.IConsumer>`
+        :param r: R-Value, see :func:`reload`
+        :param pr: PR-Value, see :func:`reload`
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
+        :rtype: self
+        """
+        r = self._bucket.get_r(r)
+        pr = self._bucket.get_pr(pr)
+        t = self._streaming_transport('get_stream')
+        Result = yield t.get_stream(self, consumer, r=r, pr=pr,
+                                    timeout=timeout)
+        self.clear()
+        if Result is not None:
+            self.populate(Result)
+
+        defer.returnValue(self)
+
+    @defer.inlineCallbacks
+    def reload(self, r=None, pr=None, vtag=None, timeout=None):
         """
         Reload the object from Riak. When this operation completes, the
         object could contain new metadata and a new value, if the object
@@ -451,13 +539,16 @@ class RiakObject(object):
         :param r: R-Value, wait for this many partitions to respond
          before returning to client.
         :type r: integer
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
         :rtype: self
         """
         # Do the request...
         r = self._bucket.get_r(r)
         pr = self._bucket.get_pr(pr)
         t = self._client.get_transport()
-        Result = yield t.get(self, r=r, pr=pr, vtag=vtag)
+        Result = yield t.get(self, r=r, pr=pr, vtag=vtag, timeout=timeout)
         self.clear()
         if Result is not None:
             self.populate(Result)
@@ -465,7 +556,7 @@ class RiakObject(object):
         defer.returnValue(self)
 
     @defer.inlineCallbacks
-    def head(self, r=None, pr=None, vtag=None):
+    def head(self, r=None, pr=None, vtag=None, timeout=None):
         """
         Loads the metadata from Riak. When this operation completes, the
         object could contain new metadata if the object was updated in Riak
@@ -474,13 +565,16 @@ class RiakObject(object):
         :param r: R-Value, wait for this many partitions to respond
          before returning to client.
         :type r: integer
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
         :rtype: self
         """
         # Do the request...
         r = self._bucket.get_r(r)
         pr = self._bucket.get_pr(pr)
         t = self._client.get_transport()
-        Result = yield t.head(self, r=r, pr=pr, vtag=vtag)
+        Result = yield t.head(self, r=r, pr=pr, vtag=vtag, timeout=timeout)
 
         self.clear()
         if Result is not None:
@@ -489,7 +583,8 @@ class RiakObject(object):
         defer.returnValue(self)
 
     @defer.inlineCallbacks
-    def delete(self, rw=None, r=None, w=None, dw=None, pr=None, pw=None):
+    def delete(self, rw=None, r=None, w=None, dw=None, pr=None, pw=None,
+               timeout=None):
         """
         Delete this object from Riak.
 
@@ -512,6 +607,9 @@ class RiakObject(object):
         :param pr: PW-value, require this many primary partitions to be
                    available before performing the put
         :type pw: integer
+        :param timeout: seconds the request may take, also enforced by
+                        Riak (defaults to the client's request timeout)
+        :type timeout: float
         :rtype: self
         """
         # Use defaults if not specified...
@@ -522,7 +620,8 @@ class RiakObject(object):
         pr = self._bucket.get_pr(pr)
         pw = self._bucket.get_pw(pw)
         t = self._client.get_transport()
-        Result = yield t.delete(self, rw=rw, r=r, w=w, dw=dw, pr=pr, pw=pw)
+        Result = yield t.delete(self, rw=rw, r=r, w=w, dw=dw, pr=pr, pw=pw,
+                                timeout=timeout)
         self.clear()
         defer.returnValue(self)
 
@@ -535,6 +634,7 @@ class RiakObject(object):
         self._headers = []
         self._links = []
         self._data = None
+        self._encoded = None
         self._exists = False
         self._siblings = []
         return self
@@ -573,15 +673,8 @@ class RiakObject(object):
                 self.set_metadata(metadata)
                 if data:        # needed for HEAD support
                     self.set_encoded_data(data)
-                # Create objects for all siblings
-                siblings = [self]
-                for (metadata, data) in contents:
-                    sibling = copy.copy(self)
-                    sibling.set_metadata(metadata)
-                    sibling.set_encoded_data(data)
-                    siblings.append(sibling)
-                for sibling in siblings:
-                    sibling.set_siblings(siblings)
+                # siblings stay (metadata, data) until get_sibling()
+                self.set_siblings([self] + contents)
         else:
             raise RiakError("do not know how to handle type " +
                             str(type(Result)))
@@ -614,8 +707,20 @@ class RiakObject(object):
         :type r: integer
         :rtype: RiakObject.
         """
-        if isinstance(self._siblings[i], RiakObject):
-            defer.returnValue(self._siblings[i])
+        sibling = self._siblings[i]
+        if isinstance(sibling, RiakObject):
+            defer.returnValue(sibling)
+        elif isinstance(sibling, tuple):
+            metadata, data = sibling
+            obj = RiakObject(self._client, self._bucket, self._key)
+            obj._encode_data = self._encode_data
+            obj._vclock = self._vclock
+            obj._exists = True
+            obj.set_metadata(metadata)
+            obj.set_encoded_data(data)
+            obj._siblings = self._siblings
+            self._siblings[i] = obj
+            defer.returnValue(obj)
         else:
             # Use defaults if not specified.
             r = self._bucket.get_r(r)
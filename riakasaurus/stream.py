@@ -0,0 +1,144 @@
+"""
+.. module:: stream.py
+
+Flow controlled delivery of streamed results (key listings, mapreduce
+phases, index pages) from a transport to the application.
+
+"""
+
+from collections import deque
+
+from twisted.internet import defer
+
+
+class ResultStream(object):
+    """
+    A ``ResultStream`` receives the chunks of a streamed response as they
+    arrive and hands them to the application, either one at a time through
+    :func:`next` or by pushing them into a consumer with :func:`consume`.
+
+    When more than ``high_water`` chunks are buffered the registered
+    producer (the connection delivering the response) is paused, and it is
+    resumed once the buffer drains down to ``low_water``. Memory use is
+    therefore bounded by the chunk size, not by the size of the result.
+
+    If a ``decoder`` is given, every chunk written is passed through it
+    before being buffered.
+    """
+    HIGH_WATER = 16
+    LOW_WATER = 4
+
+    def __init__(self, high_water=None, low_water=None, decoder=None):
+        self.high_water = high_water or self.HIGH_WATER
+        self.low_water = low_water or self.LOW_WATER
+        self.decoder = decoder
+        self._chunks = deque()
+        self._waiting = deque()
+        self._producer = None
+        self._paused = False
+        self._finished = False
+        self._stopped = False
+        self._failure = None
+
+    def registerProducer(self, producer):
+        """
+        Register the object delivering chunks, it must provide
+        ``pauseProducing`` and ``resumeProducing``.
+        """
+        self._producer = producer
+
+    def write(self, chunk):
+        """
+        Called by the transport for every chunk received.
+        """
+        if self._stopped or self._finished:
+            return
+        if self.decoder is not None:
+            chunk = self.decoder(chunk)
+        if self._waiting:
+            self._waiting.popleft().callback(chunk)
+            return
+        self._chunks.append(chunk)
+        if (len(self._chunks) >= self.high_water and
+                self._producer is not None and not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def finish(self):
+        """
+        Called by the transport once the last chunk has been written.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        while self._waiting:
+            self._waiting.popleft().callback(None)
+
+    def fail(self, failure):
+        """
+        Called by the transport if the streamed request failed.
+        """
+        if self._finished:
+            return
+        self._failure = failure
+        self._finished = True
+        while self._waiting:
+            self._waiting.popleft().errback(failure)
+
+    def stop(self):
+        """
+        Discard everything buffered and every chunk still to come. The
+        producer is resumed so the response can drain from the connection.
+        """
+        self._stopped = True
+        self._chunks.clear()
+        self._resume()
+        self.finish()
+
+    def isStopped(self):
+        return self._stopped
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+
+    def next(self):
+        """
+        Return a deferred firing with the next chunk, or with ``None`` once
+        the stream is exhausted.
+        """
+        if self._chunks:
+            chunk = self._chunks.popleft()
+            if len(self._chunks) <= self.low_water:
+                self._resume()
+            return defer.succeed(chunk)
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        if self._finished:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    @defer.inlineCallbacks
+    def consume(self, consumer):
+        """
+        Call ``consumer`` with every chunk as it arrives. If the consumer
+        returns a deferred, the next chunk is only delivered after it
+        fired, so a slow consumer throttles the connection.
+
+        :returns: deferred firing with the number of chunks consumed
+        """
+        count = 0
+        try:
+            while True:
+                chunk = yield self.next()
+                if chunk is None:
+                    break
+                yield consumer(chunk)
+                count += 1
+        except Exception:
+            self.stop()
+            raise
+        defer.returnValue(count)
@@ -103,3 +103,27 @@ class Tests(unittest.TestCase):
 
         log.msg("done secondary_index")
 
+
+    @defer.inlineCallbacks
+    def test_stream_index(self):
+        log.msg("*** stream_index")
+
+        for i in range(10):
+            obj = self.bucket.new('foo%d' % i, {'field2': i})
+            obj.add_index('field2_int', i)
+            yield obj.store()
+
+        # pages of three keys, continuations are followed automatically
+        stream = self.bucket.stream_index('field2_int', 0, 100,
+                                          max_results=3)
+        results = []
+        while True:
+            chunk = yield stream.next()
+            if chunk is None:
+                break
+            results.extend(chunk)
+
+        self.assertEqual(sorted(results),
+                         sorted(['foo%d' % i for i in range(10)]))
+
+        log.msg("done stream_index")
@@ -42,3 +42,31 @@ class Tests_PB(unittest.TestCase, BasicTestsMixin):
     def test_is_alive(self):
         alive = yield self.client.is_alive()
         self.assertEqual(alive, True)
+
+    @defer.inlineCallbacks
+    def test_stream_keys(self):
+        keys = ['key%d' % i for i in range(20)]
+        for key in keys:
+            yield self.bucket.new_binary(key, 'data').store()
+
+        # iterator style
+        stream = self.bucket.stream_keys()
+        streamed = []
+        while True:
+            chunk = yield stream.next()
+            if chunk is None:
+                break
+            streamed.extend(chunk)
+        self.assertEqual(sorted(streamed), sorted(keys))
+
+        # consumer style
+        consumed = []
+        yield self.bucket.stream_keys(consumed.extend)
+        self.assertEqual(sorted(consumed), sorted(keys))
+
+    @defer.inlineCallbacks
+    def test_stream_buckets(self):
+        yield self.bucket.new_binary('key', 'data').store()
+        streamed = []
+        yield self.client.stream_buckets(consumer=streamed.extend)
+        self.assertIn(self.bucket.get_name(), streamed)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+tests for load balancing over several nodes, trial. No Riak needed.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+
+from riakasaurus import riak, transport, exceptions
+from riakasaurus.transport import cluster, pbc, pbc_transport
+
+
+class Test_Cluster(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(cluster, 'reactor', self.clock)
+        self.nodes = [cluster.Node('riak%d' % i, 8087) for i in range(3)]
+
+    def test_parse_nodes(self):
+        self.assertEqual(
+            cluster.parseNodes(['a', 'b:8088', ('c', 8089)], 8087),
+            [('a', 8087), ('b', 8088), ('c', 8089)])
+
+    def test_round_robin(self):
+        c = cluster.Cluster(self.nodes, 'round_robin')
+        picked = [c.pick() for i in range(6)]
+        self.assertEqual(picked[:3], picked[3:])
+        self.assertEqual(set(picked), set(self.nodes))
+
+    def test_least_outstanding(self):
+        c = cluster.Cluster(self.nodes, 'least_outstanding')
+        self.nodes[0].requestStarted()
+        self.nodes[2].requestStarted()
+        self.assertIdentical(c.pick(), self.nodes[1])
+
+    def test_latency_weighted(self):
+        c = cluster.Cluster(self.nodes, 'latency_weighted')
+        self.nodes[0].latency = 0.001
+        self.nodes[1].latency = self.nodes[2].latency = 1
+        picked = [c.pick() for i in range(1000)]
+        self.assertTrue(picked.count(self.nodes[0]) > 900)
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, cluster.Cluster, self.nodes, 'random')
+
+    def test_ejection_and_reinstatement(self):
+        c = cluster.Cluster(self.nodes)
+        for i in range(c.EJECT_AFTER):
+            self.assertFalse(self.nodes[0].ejected)
+            c.failed(self.nodes[0])
+        self.assertTrue(self.nodes[0].ejected)
+        self.assertEqual(c.available(), self.nodes[1:])
+        self.assertFalse(self.nodes[0] in [c.pick() for i in range(10)])
+
+        healthy = set(self.nodes)
+        c.startHealthChecks(lambda node, timeout: node in healthy or
+                            defer.fail(Exception('unhealthy')))
+        self.clock.advance(c.HEALTH_INTERVAL)
+        self.assertFalse(self.nodes[0].ejected)
+
+        healthy.remove(self.nodes[2])
+        for i in range(c.EJECT_AFTER):
+            self.clock.advance(c.HEALTH_INTERVAL)
+        self.assertTrue(self.nodes[2].ejected)
+        c.stopHealthChecks()
+
+    def test_connect_errors_are_not_counted_twice(self):
+        c = cluster.Cluster(self.nodes)
+        c._ping = lambda node, timeout: defer.fail(
+            error.ConnectionRefusedError())
+        c.checkHealth()
+        self.assertEqual(self.nodes[0].failures, 0)
+
+    def test_all_ejected(self):
+        c = cluster.Cluster(self.nodes)
+        for node in self.nodes:
+            node.ejected = True
+        self.assertEqual(c.available(), self.nodes)
+
+
+class Test_CircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(cluster, 'reactor', self.clock)
+        self.breaker = cluster.CircuitBreaker()
+
+    def trip(self, breaker):
+        for i in range(breaker.MIN_REQUESTS):
+            breaker.record(i % 2 == 0)
+
+    def test_trips_on_failure_rate(self):
+        b = self.breaker
+        b.record(True)
+        for i in range(b.MIN_REQUESTS - 2):
+            b.record(False)
+        # too few requests to tell
+        self.assertTrue(b.isClosed())
+        b.record(False)
+        self.assertEqual(b.state, b.OPEN)
+        self.assertFalse(b.acquire())
+
+    def test_window_forgets_old_failures(self):
+        b = self.breaker
+        for i in range(b.WINDOW):
+            b.record(i % 3 != 0)
+        for i in range(b.WINDOW):
+            b.record(True)
+        for i in range(b.WINDOW / 2 - 1):
+            b.record(False)
+        self.assertTrue(b.isClosed())
+        b.record(False)
+        self.assertFalse(b.isClosed())
+
+    def test_half_open_single_probe(self):
+        b = self.breaker
+        self.trip(b)
+        self.clock.advance(b.OPEN_TIME)
+        self.assertTrue(b.acquire())
+        self.assertEqual(b.state, b.HALF_OPEN)
+        self.assertFalse(b.acquire())
+        b.record(False)
+        self.assertEqual(b.state, b.OPEN)
+
+        self.clock.advance(b.OPEN_TIME)
+        self.assertTrue(b.acquire())
+        b.record(True)
+        self.assertTrue(b.isClosed())
+        self.assertTrue(b.acquire())
+
+    def test_only_the_probe_decides(self):
+        b = self.breaker
+        before = self.clock.seconds()
+        self.trip(b)
+        self.clock.advance(b.OPEN_TIME)
+        self.assertTrue(b.acquire())
+        # sent before the breaker opened, finishing before the probe
+        b.record(True, started=before)
+        self.assertEqual(b.state, b.HALF_OPEN)
+        b.record(False, started=self.clock.seconds())
+        self.assertEqual(b.state, b.OPEN)
+
+        self.clock.advance(b.OPEN_TIME)
+        self.assertTrue(b.acquire())
+        b.record(True, started=self.clock.seconds())
+        self.assertTrue(b.isClosed())
+        # stragglers don't open it again right away
+        for i in range(b.MIN_REQUESTS):
+            b.record(False, started=before)
+        self.assertTrue(b.isClosed())
+
+    def test_pbc_probe_trace(self):
+        self.patch(pbc_transport, 'reactor', self.clock)
+        t = pbc_transport.PBCTransport(riak.RiakClient())
+        pool, = t.cluster.nodes
+        before = pbc.tracing.RequestTrace(pbc.MSG_CODE_PING_REQ, 'PING_REQ',
+                                          5, self.clock.seconds())
+        self.trip(pool.breaker)
+        self.clock.advance(pool.breaker.OPEN_TIME)
+        self.assertIdentical(t.cluster.pick(), pool)
+        pool._requestTraced(before)
+        self.assertEqual(pool.breaker.state, pool.breaker.HALF_OPEN)
+        probe = pbc.tracing.RequestTrace(pbc.MSG_CODE_PING_REQ, 'PING_REQ',
+                                         5, self.clock.seconds())
+        pool._requestTraced(probe)
+        self.assertTrue(pool.breaker.isClosed())
+
+    def test_lost_probe_is_replaced(self):
+        b = self.breaker
+        self.trip(b)
+        self.clock.advance(b.OPEN_TIME)
+        self.assertTrue(b.acquire())
+        self.clock.advance(b.OPEN_TIME)
+        self.assertTrue(b.acquire())
+
+    def test_pick_skips_open_nodes(self):
+        nodes = [cluster.Node('riak%d' % i, 8087) for i in range(2)]
+        c = cluster.Cluster(nodes)
+        self.trip(nodes[0].breaker)
+        self.assertEqual(set(c.pick() for i in range(4)), set([nodes[1]]))
+        self.trip(nodes[1].breaker)
+        self.assertRaises(exceptions.CircuitOpen, c.pick)
+
+    def test_pbc_fails_fast(self):
+        self.patch(pbc_transport, 'reactor', self.clock)
+        connects = []
+
+        def connect(client, host, port):
+            connects.append(host)
+            return defer.fail(error.ConnectionRefusedError())
+        self.patch(pbc.RiakPBCClient, 'connect', connect)
+        t = pbc_transport.PBCTransport(riak.RiakClient())
+        pool, = t.cluster.nodes
+        for i in range(pool.breaker.MIN_REQUESTS):
+            self.failureResultOf(t._getFreeTransport(),
+                                 error.ConnectionRefusedError)
+        self.failureResultOf(t._getFreeTransport(), exceptions.CircuitOpen)
+        self.assertEqual(len(connects), pool.breaker.MIN_REQUESTS)
+
+
+class Test_AdaptiveLimit(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(cluster, 'reactor', self.clock)
+        self.limit = cluster.AdaptiveLimit()
+
+    def test_grows_while_used_and_fast(self):
+        l = self.limit
+        l.sample(0.01, l.INITIAL)
+        self.assertEqual(l.current(), l.INITIAL + 1)
+        # hardly used, no reason to allow more
+        l.sample(0.01, 1)
+        self.assertEqual(l.current(), l.INITIAL + 1)
+        self.assertEqual(l.increases, 1)
+
+    def test_backs_off_once_per_round_trip(self):
+        l = self.limit
+        l.sample(0.01, l.INITIAL)
+        for i in range(10):
+            l.sample(0.05, l.INITIAL)
+        self.assertEqual(l.current(), int((l.INITIAL + 1) * l.BACKOFF))
+        self.clock.advance(0.05)
+        l.sample(0.05, l.INITIAL)
+        self.assertEqual(l.decreases, 2)
+
+    def test_dropped(self):
+        l = self.limit
+        for i in range(100):
+            l.sample(1, 0, dropped=True)
+            self.clock.advance(1)
+        self.assertEqual(l.current(), l.MINIMUM)
+        self.assertEqual(l.baseline(), None)
+
+    def test_baseline_follows_the_node(self):
+        l = self.limit
+        l.sample(0.001, 0)
+        for i in range(2 * l.WINDOW):
+            l.sample(0.01, 0)
+        self.assertEqual(l.baseline(), 0.01)
+
+
+class Test_ClusterTransports(unittest.TestCase):
+    def setUp(self):
+        clock = task.Clock()
+        self.patch(cluster, 'reactor', clock)
+        self.patch(pbc_transport, 'reactor', clock)
+
+    def test_pbc_pool_per_node(self):
+        client = riak.RiakClient(port=8087, nodes=['riak1', 'riak2:8088'],
+                                 transport=transport.PBCTransport,
+                                 balancer='least_outstanding')
+        t = client.get_transport()
+        self.addCleanup(t.quit)
+        self.assertEqual([(pool.host, pool.port) for pool in t.cluster.nodes],
+                         [('riak1', 8087), ('riak2', 8088)])
+        self.assertEqual((client._host, client._port), ('riak1', 8087))
+
+        first, second = t.cluster.nodes
+        stp = first._acquireTransport()
+        self.assertEqual(first.outstanding(), 1)
+        self.assertIdentical(t.cluster.pick(), second)
+        stp.setIdle()
+        self.assertEqual(first.outstanding(), 0)
+
+    def test_http_nodes(self):
+        client = riak.RiakClient(nodes=[('riak1', 8098), ('riak2', 8098)])
+        t = client.get_transport()
+        self.addCleanup(t.quit)
+        self.assertEqual([node.host for node in t.cluster.nodes],
+                         ['riak1', 'riak2'])
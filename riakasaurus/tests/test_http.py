@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+"""
+tests for HTTPTransport against in memory connections, trial. No Riak
+needed.
+"""
+
+from cStringIO import StringIO
+from functools import partial
+import time
+
+from twisted.trial import unittest
+from twisted.internet import endpoints, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.web import client
+from twisted.web.client import Agent
+
+from riakasaurus import riak, exceptions
+from riakasaurus.metadata import MD_VTAG
+from riakasaurus.stream import ResultStream
+from riakasaurus.transport import http_transport, retry
+
+
+class MemoryEndpoints(object):
+    """
+    TCP endpoints on the memory reactor, without name resolution
+    """
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def endpointForURI(self, uri):
+        return endpoints.TCP4ClientEndpoint(self.reactor, uri.host, uri.port)
+
+
+class HTTPTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = proto_helpers.MemoryReactorClock()
+        self.patch(http_transport, 'reactor', self.reactor)
+        self.transport = http_transport.HTTPTransport(riak.RiakClient())
+        self.transport.agent = Agent.usingEndpointFactory(
+            self.reactor, MemoryEndpoints(self.reactor),
+            pool=self.transport.pool)
+        self.connected = 0
+
+    def connect(self):
+        """
+        the connection of the next connect started
+        """
+        factory = self.reactor.tcpClients[self.connected][2]
+        self.connected += 1
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        return proto
+
+    def respond(self, proto, body='', code=200, headers=()):
+        lines = ['HTTP/1.1 %d OK' % code,
+                 'Content-Length: %d' % len(body)]
+        lines.extend('%s: %s' % header for header in headers)
+        proto.dataReceived('\r\n'.join(lines) + '\r\n\r\n' + body)
+
+    def respondChunked(self, proto, chunks, headers=()):
+        lines = ['HTTP/1.1 200 OK', 'Transfer-Encoding: chunked']
+        lines.extend('%s: %s' % header for header in headers)
+        proto.dataReceived('\r\n'.join(lines) + '\r\n\r\n')
+        self.sendChunks(proto, chunks)
+
+    def sendChunks(self, proto, chunks):
+        for chunk in chunks:
+            proto.dataReceived('%x\r\n%s\r\n' % (len(chunk), chunk))
+
+
+class Test_HTTPPool(HTTPTestCase):
+    def test_connections_are_reused(self):
+        path = '/types/default/buckets/b/keys/k'
+        d = self.transport.http_request('GET', path)
+        proto = self.connect()
+        self.respond(proto, 'ok')
+        self.assertEqual(self.successResultOf(d)[1], 'ok')
+        self.assertEqual(self.transport.metrics.idleConnections(), 1)
+
+        proto.transport.clear()
+        d = self.transport.http_request('PUT', path, body='data')
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertTrue(proto.transport.value().startswith('PUT '))
+        self.assertEqual(self.transport.metrics.activeConnections(), 1)
+        self.respond(proto, code=204)
+        self.successResultOf(d)
+
+        stats = self.transport.metrics.asDict()
+        self.assertEqual((stats['open'], stats['idle'], stats['connects']),
+                         (1, 1, 1))
+        self.assertEqual(stats['operations']['get']['count'], 1)
+        self.assertEqual(stats['operations']['put']['count'], 1)
+        self.assertEqual(stats['acquire_wait']['count'], 2)
+
+    def test_idle_timeout(self):
+        d = self.transport.http_request('GET', '/ping')
+        proto = self.connect()
+        self.respond(proto, 'OK')
+        self.successResultOf(d)
+        self.reactor.advance(self.transport.MAX_IDLETIME)
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_max_idletime(self):
+        self.transport.setMaxIdleTime(10)
+        d = self.transport.http_request('GET', '/ping')
+        proto = self.connect()
+        self.respond(proto, 'OK')
+        self.successResultOf(d)
+        self.reactor.advance(9)
+        self.assertFalse(proto.transport.disconnecting)
+        self.reactor.advance(1)
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_max_persistent(self):
+        self.transport.setMaxPersistent(1)
+        requests = [self.transport.http_request('GET', '/ping')
+                    for i in range(2)]
+        protos = [self.connect() for d in requests]
+        for proto, d in zip(protos, requests):
+            self.respond(proto, 'OK')
+            self.successResultOf(d)
+        # one of them is closed
+        self.assertEqual(sorted(proto.transport.disconnecting
+                                for proto in protos), [False, True])
+        self.assertEqual(self.transport.metrics.idleConnections(), 1)
+        self.assertEqual(self.transport.metrics.asDict()['max_persistent'], 1)
+
+    def test_quit_closes_idle_connections(self):
+        d = self.transport.http_request('GET', '/ping')
+        proto = self.connect()
+        self.respond(proto, 'OK')
+        self.successResultOf(d)
+        self.transport.quit()
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_retries_are_counted(self):
+        self.patch(retry, 'reactor', self.reactor)
+        d = self.transport.http_request('GET', '/ping')
+        proto = self.connect()
+        proto.connectionLost(failure.Failure(error.ConnectionLost()))
+        self.reactor.advance(self.transport.client.retry_policy.max_backoff)
+        self.respond(self.connect(), 'OK')
+        self.assertEqual(self.successResultOf(d)[1], 'OK')
+        self.assertEqual(self.transport.metrics.asDict()['retries'], 1)
+
+    def test_retries_share_the_timeout(self):
+        self.patch(retry, 'reactor', self.reactor)
+        self.patch(time, 'time', self.reactor.seconds)
+        self.patch(retry.random, 'uniform', lambda low, high: high)
+        d = self.transport.http_request('GET', '/ping', timeout=1)
+        self.reactor.advance(0.5)
+        self.connect().connectionLost(failure.Failure(error.ConnectionLost()))
+        self.reactor.advance(self.transport.client.retry_policy.backoff)
+        proto = self.connect()
+        self.assertNoResult(d)
+        # the retry only gets what is left of the second
+        self.reactor.advance(0.45)
+        self.failureResultOf(d, exceptions.RequestTimeout)
+
+    def test_operations(self):
+        op = self.transport._operation
+        self.assertEqual(op('GET', '/types/t/buckets/b/keys/k?r=2'), 'get')
+        self.assertEqual(op('HEAD', '/types/t/buckets/b/keys/k'), 'get')
+        self.assertEqual(op('POST', '/types/t/buckets/b/keys'), 'put')
+        self.assertEqual(op('DELETE', '/types/t/buckets/b/keys/k'), 'delete')
+        self.assertEqual(op('GET', '/types/t/buckets/b/keys?keys=true'),
+                         'other')
+        self.assertEqual(op('GET', '/types/t/buckets/b/index/i_bin/x'),
+                         'index')
+        self.assertEqual(op('POST', '/mapred'), 'mapred')
+        self.assertEqual(op('GET', '/types/t/buckets/b/datatypes/k'),
+                         'datatype_fetch')
+        self.assertEqual(op('POST', '/types/t/buckets/b/datatypes/k'),
+                         'datatype_update')
+        self.assertEqual(op('GET', '/buckets/b/counters/k'), 'counter_get')
+        self.assertEqual(op('POST', '/buckets/b/counters/k'),
+                         'counter_update')
+
+
+class Test_HTTPStreaming(HTTPTestCase):
+    def setUp(self):
+        HTTPTestCase.setUp(self)
+        self.bucket = riak.RiakClient().bucket('b')
+
+    def test_parser(self):
+        parser = http_transport.JSONStreamParser()
+        self.assertEqual(parser.feed('{"keys":["a"]}{"ke'), [{'keys': ['a']}])
+        self.assertEqual(parser.feed('ys":["b"]} \n{"keys":[]}'),
+                         [{'keys': ['b']}, {'keys': []}])
+        parser.close()
+        parser.feed('{"keys":')
+        self.assertRaises(ValueError, parser.close)
+
+    def test_stream_keys(self):
+        stream = ResultStream()
+        d = self.transport.stream_keys(self.bucket, stream)
+        proto = self.connect()
+        self.assertIn('keys=stream', proto.transport.value())
+        self.respondChunked(proto, ['{"keys":["a","b"]}{"keys":[]}{"ke'])
+        # the first keys arrive before the listing is complete
+        self.assertEqual(self.successResultOf(stream.next()), ['a', 'b'])
+        self.assertNoResult(stream.next())
+        self.sendChunks(proto, ['ys":["c"]}', ''])
+        self.successResultOf(d)
+        self.assertEqual(self.successResultOf(stream.next()), None)
+        self.assertEqual(self.transport.metrics.operations['other'].count, 1)
+
+    def test_stream_pauses_connection(self):
+        stream = ResultStream(high_water=2, low_water=1)
+        self.transport.stream_keys(self.bucket, stream)
+        proto = self.connect()
+        self.respondChunked(proto, ['{"keys":["a"]}{"keys":["b"]}'])
+        self.assertEqual(proto.transport.producerState, 'paused')
+        stream.next()
+        self.assertEqual(proto.transport.producerState, 'producing')
+
+    def test_get_keys(self):
+        d = self.transport.get_keys(self.bucket)
+        proto = self.connect()
+        self.respondChunked(proto, ['{"keys":["a"]}', '{"keys":["b"]}', ''])
+        self.assertEqual(self.successResultOf(d), ['a', 'b'])
+
+    def test_get_buckets(self):
+        d = self.transport.get_buckets()
+        proto = self.connect()
+        self.assertIn('buckets=stream', proto.transport.value())
+        self.respondChunked(proto, ['{"buckets":["b1"]}{"buckets":["b2"]}',
+                                    ''])
+        self.assertEqual(self.successResultOf(d), ['b1', 'b2'])
+
+    def test_error_in_stream(self):
+        d = self.transport.get_keys(self.bucket)
+        proto = self.connect()
+        self.respondChunked(proto, ['{"keys":["a"]}{"error":"timeout"}'])
+        self.failureResultOf(d, exceptions.RiakError)
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_error_status(self):
+        d = self.transport.get_keys(self.bucket)
+        self.respond(self.connect(), 'no such bucket type', code=404)
+        self.failureResultOf(d, exceptions.RiakError)
+
+
+class Test_HTTPMapRed(HTTPTestCase):
+    BOUNDARY = 'Jb6pcbT3HHlUwuxWa8Gn7g3jSZf'
+
+    def setUp(self):
+        HTTPTestCase.setUp(self)
+        self.transport._s_version = '2.0.0'
+
+    def part(self, phase, data):
+        return ('\r\n--%s\r\nContent-Type: application/json\r\n\r\n'
+                '{"phase":%d,"data":%s}' % (self.BOUNDARY, phase, data))
+
+    def respondMultipart(self, proto, chunks):
+        ctype = 'multipart/mixed; boundary=%s' % self.BOUNDARY
+        self.respondChunked(proto, chunks, [('Content-Type', ctype)])
+
+    def test_parser(self):
+        parser = http_transport.MultipartParser('b')
+        body = '--b\r\nContent-Type: text/plain\r\n\r\none\r\n--b\r\n\r\ntwo'
+        self.assertEqual(parser.feed(body[:20]), [])
+        self.assertEqual(parser.feed(body[20:]),
+                         [({'content-type': 'text/plain'}, 'one')])
+        self.assertRaises(ValueError, parser.close)
+        self.assertEqual(parser.feed('\r\n--'), [])
+        self.assertEqual(parser.feed('b--\r\n'), [({}, 'two')])
+        parser.close()
+
+    def test_stream_mapred(self):
+        stream = ResultStream()
+        d = self.transport.stream_mapred('b', [], stream)
+        proto = self.connect()
+        self.assertIn('/mapred?chunked=true', proto.transport.value())
+        first = self.part(0, '[1,2]')
+        self.respondMultipart(proto, [first[:30], first[30:]])
+        results = stream.next()
+        self.assertNoResult(results)
+        self.sendChunks(proto, [self.part(1, '[3]')])
+        self.assertEqual(self.successResultOf(results), (0, [1, 2]))
+        self.assertNoResult(d)
+        self.sendChunks(proto, ['\r\n--%s--\r\n' % self.BOUNDARY, ''])
+        self.successResultOf(d)
+        self.assertEqual(self.successResultOf(stream.next()), (1, [3]))
+        self.assertEqual(self.successResultOf(stream.next()), None)
+        self.assertEqual(self.transport.metrics.operations['mapred'].count,
+                         1)
+
+    def test_results_arrive_per_phase(self):
+        client = self.transport.client
+        client.transport = self.transport
+        results = []
+        d = client.add('b').map_values().stream(results.append)
+        proto = self.connect()
+        self.respondMultipart(proto, [self.part(0, '["a"]'),
+                                      self.part(1, '["b"]')])
+        self.assertEqual(results, [(0, [u'a'])])
+        self.sendChunks(proto, ['\r\n--%s--\r\n' % self.BOUNDARY, ''])
+        self.assertEqual(results, [(0, [u'a']), (1, [u'b'])])
+        self.assertEqual(self.successResultOf(d), 2)
+
+    def test_error_part(self):
+        stream = ResultStream()
+        d = self.transport.stream_mapred('b', [], stream)
+        proto = self.connect()
+        self.respondMultipart(proto, [
+            '\r\n--%s\r\n\r\n{"error":"map_reduce_error"}' % self.BOUNDARY,
+            '\r\n--%s--\r\n' % self.BOUNDARY])
+        self.failureResultOf(d, exceptions.RiakError)
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_not_multipart(self):
+        d = self.transport.stream_mapred('b', [], ResultStream())
+        self.respond(self.connect(), '[]',
+                     headers=[('Content-Type', 'application/json')])
+        self.failureResultOf(d, exceptions.RiakError)
+
+
+class Test_HTTPIndexStream(HTTPTestCase):
+    BOUNDARY = 'Ab8sx2fL4C1bGbj7xM2mkl8x6mh'
+
+    def setUp(self):
+        HTTPTestCase.setUp(self)
+        self.client = self.transport.client
+        self.client.transport = self.transport
+        self.bucket = self.client.bucket('b')
+
+    def respondParts(self, proto, results):
+        ctype = 'multipart/mixed; boundary=%s' % self.BOUNDARY
+        chunks = ['\r\n--%s\r\nContent-Type: application/json\r\n\r\n%s'
+                  % (self.BOUNDARY, result) for result in results]
+        chunks.extend(['\r\n--%s--\r\n' % self.BOUNDARY, ''])
+        self.respondChunked(proto, chunks, [('Content-Type', ctype)])
+
+    def test_pages(self):
+        stream = self.bucket.stream_index('f_bin', 'a', 'z',
+                                          return_terms=True, max_results=2)
+        proto = self.connect()
+        request = proto.transport.value()
+        self.assertIn('/types/default/buckets/b/index/f_bin/a/z?', request)
+        self.assertIn('stream=true', request)
+        proto.transport.clear()
+        self.respondParts(proto, ['{"results":[{"a":"k1"},{"b":"k2"}]}',
+                                  '{"continuation":"g2gCbQ"}'])
+        self.assertEqual(self.successResultOf(stream.next()),
+                         [(u'a', u'k1'), (u'b', u'k2')])
+
+        # the next page is requested with the continuation
+        self.assertIn('continuation=g2gCbQ', proto.transport.value())
+        done = stream.next()
+        self.respondParts(proto, ['{"results":[{"c":"k3"}]}'])
+        self.assertEqual(self.successResultOf(done), [(u'c', u'k3')])
+        self.assertEqual(self.successResultOf(stream.next()), None)
+
+    def test_keys(self):
+        keys = []
+        d = self.bucket.stream_index('f_bin', 'a', consumer=keys.extend)
+        self.respondParts(self.connect(), ['{"keys":["k1"]}',
+                                           '{"keys":["k2"]}'])
+        self.successResultOf(d)
+        self.assertEqual(keys, [u'k1', u'k2'])
+
+    def test_error(self):
+        d = self.bucket.stream_index('f_bin', 'a', consumer=lambda keys: None)
+        self.respond(self.connect(), 'no such index', code=400)
+        self.failureResultOf(d, exceptions.RiakError)
+
+
+class Test_HTTPSiblings(HTTPTestCase):
+    SIBLINGS = (
+        '\r\n--YinLMzyUR9feB17okMytgKsylvh\r\n'
+        'Content-Type: application/json\r\n'
+        'Link: </buckets/b>; rel="up"\r\n'
+        'Etag: 3s0bUBNDj2GZ9KlHMQUyHL\r\n'
+        'X-Riak-Meta-Color: red\r\n'
+        '\r\n'
+        '{"v": 1}'
+        '\r\n--YinLMzyUR9feB17okMytgKsylvh\r\n'
+        'Content-Type: application/json\r\n'
+        'Etag: 6dQBm9oYA1mxRSH0e96l5W\r\n'
+        'X-Riak-Index-Field_bin: a, b\r\n'
+        '\r\n'
+        '{"v": 2}'
+        '\r\n--YinLMzyUR9feB17okMytgKsylvh--\r\n')
+
+    def setUp(self):
+        HTTPTestCase.setUp(self)
+        self.client = self.transport.client
+        self.client.transport = self.transport
+        self.obj = riak.RiakObject(self.client, self.client.bucket('b'), 'k')
+
+    def respondSiblings(self, proto):
+        self.respond(proto, self.SIBLINGS, code=300, headers=[
+            ('Content-Type',
+             'multipart/mixed; boundary=YinLMzyUR9feB17okMytgKsylvh'),
+            ('X-Riak-Vclock', 'a85hYGBgzGDKBVIcypz/fgaUHjmTwZTImMfKsMKK7')])
+
+    def test_siblings_in_one_response(self):
+        d = self.obj.reload()
+        proto = self.connect()
+        self.assertIn('Accept: multipart/mixed', proto.transport.value())
+        self.respondSiblings(proto)
+        self.successResultOf(d)
+        proto.transport.clear()
+
+        siblings = self.successResultOf(self.obj.get_siblings())
+        self.assertEqual(proto.transport.value(), '')
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertEqual([s.get_data() for s in siblings],
+                         [{'v': 1}, {'v': 2}])
+        self.assertEqual([s.vclock() for s in siblings],
+                         ['a85hYGBgzGDKBVIcypz/fgaUHjmTwZTImMfKsMKK7'] * 2)
+        self.assertEqual(siblings[0].get_usermeta(), {'color': 'red'})
+        self.assertEqual(siblings[1].get_metadata()[MD_VTAG],
+                         '6dQBm9oYA1mxRSH0e96l5W')
+        self.assertEqual(len(siblings[1].get_indexes()), 2)
+
+    def test_vtag_list(self):
+        d = self.transport.get(self.obj)
+        self.respond(self.connect(), 'Siblings:\n3s0bUBNDj\n6dQBm9oY\n',
+                     code=300, headers=[('Content-Type', 'text/plain')])
+        self.assertEqual(self.successResultOf(d), ['3s0bUBNDj', '6dQBm9oY'])
+
+
+class Test_HTTPObjectStreaming(HTTPTestCase):
+    def setUp(self):
+        HTTPTestCase.setUp(self)
+        self.client = self.transport.client
+        self.client.transport = self.transport
+        self.transport.set_client_id('test')
+        self.bucket = self.client.bucket('b')
+        # file bodies are read on the memory reactor, 4 bytes at a time
+        self.cooperator = task.Cooperator(
+            scheduler=lambda work: self.reactor.callLater(0, work))
+        self.patch(client, 'FileBodyProducer', partial(
+            client.FileBodyProducer, cooperator=self.cooperator))
+        self.transport.UPLOAD_CHUNK = 4
+
+    def uploaded(self, proto):
+        for i in range(10):
+            self.reactor.advance(0)
+        return proto.transport.value()
+
+    def test_store_file(self):
+        path = self.mktemp() + '.png'
+        with open(path, 'wb') as f:
+            f.write('0123456789')
+        d = self.bucket.store_file('k', path)
+        proto = self.connect()
+        request = self.uploaded(proto)
+        self.assertTrue(request.startswith('PUT /types/default/buckets/b/keys/k'))
+        self.assertIn('returnbody=false', request)
+        self.assertIn('Content-Type: image/png', request)
+        self.assertIn('Content-Length: 10', request)
+        self.assertTrue(request.endswith('\r\n\r\n0123456789'))
+        self.respond(proto, code=204)
+        obj = self.successResultOf(d)
+        self.assertEqual((obj.get_key(), obj.exists()), ('k', True))
+
+    def test_store_from_new_key(self):
+        obj = self.bucket.new_binary(None, None)
+        d = obj.store_from(StringIO('data'))
+        proto = self.connect()
+        self.assertTrue(self.uploaded(proto).startswith('POST '))
+        self.respond(proto, code=201,
+                     headers=[('Location', '/types/default/buckets/b/keys/g')])
+        self.successResultOf(d)
+        self.assertEqual(obj.get_key(), 'g')
+
+    def test_fetch_to_file(self):
+        obj = riak.RiakObject(self.client, self.bucket, 'k')
+        f = StringIO()
+        d = obj.fetch_to(f)
+        proto = self.connect()
+        self.respondChunked(proto, ['0123', '45'], headers=[
+            ('Content-Type', 'image/png'), ('X-Riak-Vclock', 'a85h')])
+        # written as it arrives
+        self.assertEqual(f.getvalue(), '012345')
+        self.assertNoResult(d)
+        self.sendChunks(proto, ['6789', ''])
+        self.successResultOf(d)
+        self.assertEqual(f.getvalue(), '0123456789')
+        self.assertEqual((obj.get_content_type(), obj.vclock()),
+                         ('image/png', 'a85h'))
+        self.assertEqual(obj.get_data(), None)
+
+    def test_fetch_to_consumer(self):
+        obj = riak.RiakObject(self.client, self.bucket, 'k')
+        consumer = proto_helpers.StringTransport()
+        d = obj.fetch_to(consumer)
+        proto = self.connect()
+        self.respondChunked(proto, ['0123'])
+        self.assertTrue(consumer.streaming)
+        consumer.producer.pauseProducing()
+        self.assertEqual(proto.transport.producerState, 'paused')
+        consumer.producer.resumeProducing()
+        self.sendChunks(proto, [''])
+        self.successResultOf(d)
+        self.assertEqual(consumer.value(), '0123')
+        self.assertEqual(consumer.producer, None)
+
+    def test_fetch_missing(self):
+        obj = riak.RiakObject(self.client, self.bucket, 'k')
+        f = StringIO()
+        d = obj.fetch_to(f)
+        self.respond(self.connect(), 'not found', code=404)
+        self.assertFalse(self.successResultOf(d).exists())
+        self.assertEqual(f.getvalue(), '')
@@ -73,6 +73,28 @@ class Tests(unittest.TestCase):
         self.assertEqual(result, [2])
         log.msg('done javascript_source_map')
 
+    @defer.inlineCallbacks
+    def test_javascript_stream_map_reduce(self):
+        """javascript map reduce, results streamed per phase"""
+        log.msg('*** javascript_stream_map_reduce')
+        yield self.bucket.new("foo", 2).store()
+        yield self.bucket.new("bar", 3).store()
+        yield self.bucket.new("baz", 4).store()
+        job = self.client \
+                .add(self.bucket_name, "foo") \
+                .add(self.bucket_name, "bar") \
+                .add(self.bucket_name, "baz") \
+                .map("Riak.mapValuesJson", {'keep': True}) \
+                .reduce(JAVASCRIPT_SUM)
+        phases = {}
+        def collect(chunk):
+            phase, results = chunk
+            phases.setdefault(phase, []).extend(results)
+        yield job.stream(collect)
+        self.assertEqual(sorted(phases[0]), [2, 3, 4])
+        self.assertEqual(phases[1], [9])
+        log.msg('done javascript_stream_map_reduce')
+
     @defer.inlineCallbacks
     def test_javascript_named_map(self):
         """javascript mapping with named map"""
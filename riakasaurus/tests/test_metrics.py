@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+tests for the PBCTransport metrics, trial. No Riak needed.
+"""
+
+from struct import pack
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from riakasaurus import riak, exceptions
+from riakasaurus.transport import metrics, pbc, pbc_transport
+
+
+class Test_Histogram(unittest.TestCase):
+    def test_empty(self):
+        h = metrics.Histogram()
+        self.assertEqual((h.count, h.mean(), h.max, h.percentile(50)),
+                         (0, None, None, None))
+
+    def test_percentiles(self):
+        h = metrics.Histogram()
+        for i in range(98):
+            h.observe(0.003)
+        h.observe(0.2)
+        h.observe(40)
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.max, 40)
+        self.assertEqual(h.percentile(50), 0.005)
+        self.assertEqual(h.percentile(99), 0.25)
+        self.assertEqual(h.percentile(100), 40)
+        self.assertEqual(h.asDict()['buckets'][-1], (None, 1))
+
+    def test_percentile_capped_by_max(self):
+        h = metrics.Histogram()
+        h.observe(0.3)
+        self.assertEqual(h.percentile(50), 0.3)
+
+
+class Test_TransportMetrics(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(pbc_transport, 'reactor', self.clock)
+        self.patch(pbc, 'reactor', self.clock)
+        self.connects = []
+        self.patch(pbc.RiakPBCClient, 'connect',
+                   lambda client, host, port: self.connect())
+        self.transport = pbc_transport.PBCTransport(riak.RiakClient())
+        self.metrics = self.transport.metrics
+
+    def connect(self):
+        d = defer.Deferred()
+        self.connects.append(d)
+        return d
+
+    def connected(self, d):
+        proto = pbc.RiakPBCClientFactory().buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        d.callback(proto)
+        return proto
+
+    def test_connections_and_latency(self):
+        acquired = self.transport._getFreeTransport()
+        self.clock.advance(0.02)
+        proto = self.connected(self.connects[0])
+        stp = self.successResultOf(acquired)
+        stats = self.metrics.asDict()
+        self.assertEqual((stats['open'], stats['idle'], stats['active']),
+                         (1, 0, 1))
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['connect_latency']['max'], 0.02)
+        self.assertEqual(stats['acquire_wait']['count'], 1)
+
+        with stp as conn:
+            d = conn.sendRequest(pbc.MSG_CODE_DEL_REQ, '')
+            self.clock.advance(0.004)
+            proto.dataReceived(pack('>IB', 1, pbc.MSG_CODE_DEL_RESP))
+            self.successResultOf(d)
+        stats = self.metrics.asDict()
+        self.assertEqual((stats['open'], stats['idle'], stats['active']),
+                         (1, 1, 0))
+        self.assertEqual(stats['operations']['delete']['count'], 1)
+        self.assertEqual(stats['operations']['delete']['p50'], 0.004)
+        limit, = stats['concurrency_limits'].values()
+        self.assertEqual(limit['baseline'], 0.004)
+        self.assertEqual(stats['failures'], 0)
+
+    def test_datatype_reads_and_updates(self):
+        acquired = self.transport._getFreeTransport()
+        proto = self.connected(self.connects[0])
+        with self.successResultOf(acquired) as conn:
+            for code in (pbc.MSG_CODE_COUNTER_GET_REQ,
+                         pbc.MSG_CODE_COUNTER_UPDATE_REQ,
+                         pbc.MSG_CODE_DATATYPE_FETCH_REQ,
+                         pbc.MSG_CODE_DATATYPE_UPDATE_REQ):
+                d = conn.sendRequest(code, '')
+                proto.dataReceived(pack('>IB', 1, code + 1))
+                self.successResultOf(d)
+        # reads are hedged on their own latency, not that of updates
+        self.assertEqual(sorted(self.metrics.operations),
+                         ['counter_get', 'counter_update', 'datatype_fetch',
+                          'datatype_update'])
+
+    def test_timeouts(self):
+        acquired = self.transport._getFreeTransport()
+        proto = self.connected(self.connects[0])
+        conn = self.successResultOf(acquired).getTransport()
+        d = conn.sendRequest(pbc.MSG_CODE_GET_REQ, '', timeout=1)
+        self.clock.advance(1)
+        self.failureResultOf(d, exceptions.RequestTimeout)
+        # the timed out request is done once the retired connection closed
+        self.assertTrue(proto.transport.disconnecting)
+        proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual((self.metrics.timeouts, self.metrics.failures),
+                         (1, 1))
+        self.assertEqual(self.metrics.operations['get'].count, 1)
+
+    def test_connect_and_acquire_failures(self):
+        self.transport.MAX_TRANSPORTS = 1
+        self.transport.ACQUIRE_TIMEOUT = 1
+        acquired = self.transport._getFreeTransport()
+        self.connects[0].errback(Exception('refused'))
+        self.failureResultOf(acquired)
+        self.assertEqual(self.metrics.connectFailures, 1)
+
+        self.transport._getFreeTransport()
+        waiting = self.transport._getFreeTransport()
+        self.assertEqual(self.metrics.waiting(), 1)
+        self.clock.advance(1)
+        self.failureResultOf(waiting, exceptions.PoolExhausted)
+        self.assertEqual(self.metrics.acquireFailures, 1)
+
+        self.metrics.reset()
+        self.assertEqual(self.metrics.asDict()['connect_failures'], 0)
@@ -4,11 +4,22 @@ tests for RiakPBCClient, trial
 """
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python import log
 from twisted.internet.error import ConnectionRefusedError
+from twisted.test import proto_helpers
 
-from riakasaurus.transport import pbc
+from struct import pack
+import json
+import time
+
+from riakasaurus.transport import metrics, pbc, pbc_transport
+from riakasaurus.transport.pbc import kv_codec
+from riakasaurus import exceptions
+from riakasaurus.stream import ResultStream
+from riakasaurus.mapreduce import RiakLink
+from riakasaurus.metadata import (MD_CTYPE, MD_VTAG, MD_LINKS, MD_USERMETA,
+                                  MD_INDEX)
 
 from riakasaurus import riak, transport
 
@@ -19,6 +30,58 @@ if VERBOSE:
     log.startLogging(sys.stderr)
 
 
+class Test_PBCIndexStream(unittest.TestCase):
+    """
+    streamed secondary index responses against an in memory transport, no
+    Riak needed
+    """
+    def setUp(self):
+        self.proto = pbc.RiakPBCClientFactory().buildProtocol(None)
+        self.proto.makeConnection(proto_helpers.StringTransport())
+
+    def frame(self, code, message):
+        body = message.SerializeToString()
+        return pack('>IB', len(body) + 1, code) + body
+
+    def test_streamed_index_responses(self):
+        stream = ResultStream()
+        continuations = []
+        self.proto.get_index('bucket', 'field_bin', 'val',
+                             max_results=2, stream=stream
+                             ).addCallback(continuations.append)
+
+        first = pbc.RpbIndexResp()
+        first.keys.extend(['k1', 'k2'])
+        last = pbc.RpbIndexResp()
+        last.continuation = 'next'
+        last.done = True
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_INDEX_RESP, first) +
+                                self.frame(pbc.MSG_CODE_INDEX_RESP, last))
+
+        self.assertEqual(continuations, ['next'])
+        chunk = self.successResultOf(stream.next())
+        self.assertEqual(list(chunk.keys), ['k1', 'k2'])
+
+
+class Test_PBCValueStreaming(unittest.TestCase):
+    """
+    streaming values is refused without connecting, no Riak needed
+    """
+    def setUp(self):
+        self.patch(pbc_transport, 'reactor', task.Clock())
+        self.client = riak.RiakClient(port=8087,
+                                      transport=transport.PBCTransport)
+        self.addCleanup(self.client.get_transport().quit)
+        self.bucket = self.client.bucket('bucket')
+
+    def test_streaming_needs_http(self):
+        obj = self.bucket.new_binary('key', None)
+        self.failureResultOf(obj.store_from(None), exceptions.RiakError)
+        self.failureResultOf(obj.fetch_to(None), exceptions.RiakError)
+        self.failureResultOf(self.bucket.store_file('key', '/nonexistent'),
+                             exceptions.RiakError)
+
+
 class Test_PBCClient(unittest.TestCase):
     @defer.inlineCallbacks
     def setUp(self):
@@ -188,6 +251,24 @@ class Test_PBCClient(unittest.TestCase):
 
         log.msg("done testing links")
 
+    @defer.inlineCallbacks
+    def test_pipelined_requests(self):
+        log.msg("*** testing pipelined requests")
+
+        # fire all puts without waiting, responses arrive in order
+        puts = [self.client.put('bucket', 'pipe%d' % i, 'foo%d' % i)
+                for i in range(10)]
+        self.assertEqual(self.client.pendingCount(), 10)
+        yield defer.gatherResults(puts)
+
+        gets = [self.client.get('bucket', 'pipe%d' % i) for i in range(10)]
+        results = yield defer.gatherResults(gets)
+        self.assertEqual([r.content[0].value for r in results],
+                         ['foo%d' % i for i in range(10)])
+        self.assertEqual(self.client.pendingCount(), 0)
+
+        log.msg("done testing pipelined requests")
+
     @defer.inlineCallbacks
     def test_connection_refused(self):
         try:
@@ -196,3 +277,657 @@ class Test_PBCClient(unittest.TestCase):
             assert False, 'ConnectionRefusedError not raised as expected.'
         except ConnectionRefusedError:
             pass
+
+
+class Test_PBCFraming(unittest.TestCase):
+    """
+    framing tests against an in memory transport, no Riak needed
+    """
+    def setUp(self):
+        factory = pbc.RiakPBCClientFactory()
+        self.proto = factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def frame(self, code, message=None):
+        body = message.SerializeToString() if message else ''
+        return pack('>IB', len(body) + 1, code) + body
+
+    def test_frames_split_across_reads(self):
+        results = []
+        self.proto.ping().addCallback(results.append)
+        self.proto.get('bucket', 'key').addCallback(results.append)
+
+        resp = pbc.RpbGetResp()
+        resp.content.add().value = 'x' * 100000
+        data = (self.frame(pbc.MSG_CODE_PING_RESP) +
+                self.frame(pbc.MSG_CODE_GET_RESP, resp))
+        for i in range(0, len(data), 7000):
+            self.proto.dataReceived(data[i:i + 7000])
+
+        self.assertEqual(results[0], True)
+        self.assertEqual(results[1].content[0].value, 'x' * 100000)
+        self.assertEqual(self.proto.pendingCount(), 0)
+
+    def test_paused_frames_are_delivered_on_resume(self):
+        results = []
+        self.proto.ping().addCallback(results.append)
+        self.proto.ping().addCallback(results.append)
+        self.proto.pauseProducing()
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_PING_RESP) * 2)
+        self.assertEqual(results, [])
+        self.proto.resumeProducing()
+        self.assertEqual(results, [True, True])
+
+    def test_buffer_is_compacted_lazily(self):
+        self.proto.COMPACT_AFTER = 20
+        results = []
+        for i in range(7):
+            self.proto.ping().addCallback(results.append)
+        ping = self.frame(pbc.MSG_CODE_PING_RESP)
+        self.proto.dataReceived(ping * 2 + ping[:3])
+        # the consumed frames stay in front of the partial one
+        self.assertEqual(len(self.proto._buffer), 13)
+        self.proto.dataReceived(ping[3:] + ping * 3 + ping[:1])
+        self.assertEqual(len(self.proto._buffer), 1)
+        self.proto.dataReceived(ping[1:])
+        self.assertEqual(len(self.proto._buffer), 0)
+        self.assertEqual(results, [True] * 7)
+
+    def test_max_frame_size(self):
+        self.proto.setMaxFrameSize(10)
+        d = self.proto.ping()
+        self.proto.dataReceived(pack('>IB', 100, pbc.MSG_CODE_GET_RESP))
+        self.assertTrue(self.transport.disconnecting)
+        return self.assertFailure(d, exceptions.RiakPBCException)
+
+    def test_large_get_response_is_spooled(self):
+        self.proto.setSpoolThreshold(1000)
+        results = []
+        self.proto.get('bucket', 'key').addCallback(results.append)
+        self.proto.ping().addCallback(results.append)
+
+        resp = pbc.RpbGetResp()
+        resp.vclock = 'vclock'
+        for value in ('a' * 5000, 'b' * 3000):
+            content = resp.content.add()
+            content.value = value
+            content.content_type = 'application/octet-stream'
+            meta = content.usermeta.add()
+            meta.key, meta.value = 'meta', 'data'
+        data = (self.frame(pbc.MSG_CODE_GET_RESP, resp) +
+                self.frame(pbc.MSG_CODE_PING_RESP))
+        for i in range(0, len(data), 700):
+            self.proto.dataReceived(data[i:i + 700])
+
+        spooled, pong = results
+        self.assertTrue(isinstance(spooled, kv_codec.SpooledGetResp))
+        self.assertEqual(pong, True)
+        self.assertEqual(spooled.response.vclock, 'vclock')
+        self.assertEqual([c.content_type for c in spooled.response.content],
+                         ['application/octet-stream'] * 2)
+        self.assertEqual(spooled.response.content[1].usermeta[0].value, 'data')
+        first, second = spooled.values
+        self.assertEqual(len(first), 5000)
+        self.assertEqual(second.read(10), 'b' * 10)
+        self.assertEqual(first.read(), 'a' * 5000)
+        second.seek(0)
+        self.assertEqual(second.read(), 'b' * 3000)
+
+        # the siblings share the spool, closing one leaves the other
+        first.close()
+        self.assertRaises(ValueError, first.read)
+        second.seek(0)
+        self.assertEqual(second.read(3), 'bbb')
+        spool = spooled._spool
+        self.assertFalse(spool.closed)
+        second.close()
+        self.assertTrue(spool.closed)
+
+    def test_small_responses_are_not_spooled(self):
+        self.proto.setSpoolThreshold(1000)
+        results = []
+        self.proto.get('bucket', 'key').addCallback(results.append)
+        resp = pbc.RpbGetResp()
+        resp.content.add().value = 'small'
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_GET_RESP, resp))
+        self.assertEqual(results[0].content[0].value, 'small')
+
+    def test_timed_out_connection_is_retired(self):
+        clock = task.Clock()
+        self.patch(pbc, 'reactor', clock)
+        timedout = self.proto.sendRequest(pbc.MSG_CODE_PING_REQ, timeout=1)
+        results = []
+        self.proto.ping().addCallback(results.append)
+
+        clock.advance(1)
+        self.failureResultOf(timedout, exceptions.RequestTimeout)
+        self.assertTrue(self.proto.isRetired())
+        # the pipelined request is still answered before closing
+        self.assertFalse(self.transport.disconnecting)
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_PING_RESP) * 2)
+        self.assertEqual(results, [True])
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_stalled_stream_times_out(self):
+        clock = task.Clock()
+        self.patch(pbc, 'reactor', clock)
+        stream = ResultStream()
+        d = self.proto.streamKeys('bucket', stream, timeout=2)
+        clock.advance(1)
+        resp = pbc.RpbListKeysResp()
+        resp.keys.extend(['a'])
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_LIST_KEYS_RESP, resp))
+        self.assertEqual(self.successResultOf(stream.next()), ['a'])
+
+        # nothing more arrives, the first chunk didn't stop the timeout
+        clock.advance(1)
+        self.failureResultOf(d, exceptions.RequestTimeout)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_tracing(self):
+        clock = task.Clock()
+        self.patch(pbc, 'reactor', clock)
+        self.proto.ping()
+        self.assertEqual(self.proto._pending[0].trace, None)
+
+        traces = []
+        self.proto.addTracer(traces.append)
+        self.proto.getKeys('bucket')
+        clock.advance(0.5)
+        resp = pbc.RpbListKeysResp()
+        resp.keys.extend(['a', 'b'])
+        first = self.frame(pbc.MSG_CODE_LIST_KEYS_RESP, resp)
+        resp = pbc.RpbListKeysResp()
+        resp.done = True
+        last = self.frame(pbc.MSG_CODE_LIST_KEYS_RESP, resp)
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_PING_RESP) + first)
+        clock.advance(0.25)
+        self.proto.dataReceived(last)
+
+        trace, = traces
+        self.assertEqual(trace.name, 'LIST_KEYS_REQ')
+        self.assertEqual(trace.bytesSent, len(self.transport.value()) - 5)
+        self.assertEqual(trace.bytesReceived, len(first) + len(last))
+        self.assertEqual(trace.frames, 2)
+        self.assertEqual(trace.timeToFirstFrame(), 0.5)
+        self.assertEqual(trace.duration(), 0.75)
+        self.assertEqual(trace.asDict()['failed'], False)
+
+        self.proto.removeTracer(traces.append)
+        self.proto.ping()
+        self.assertEqual(self.proto._pending[0].trace, None)
+
+    def test_trace_excludes_callbacks(self):
+        clock = task.Clock()
+        self.patch(pbc, 'reactor', clock)
+        traces = []
+        self.proto.addTracer(traces.append)
+        d = self.proto.ping()
+        clock.advance(0.5)
+        # a slow callback of the caller
+        d.addCallback(lambda result: clock.advance(2))
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_PING_RESP))
+        self.assertEqual(traces[0].duration(), 0.5)
+
+    def test_stream_buckets(self):
+        stream = ResultStream()
+        d = self.proto.streamBuckets(stream)
+        resp = pbc.RpbListBucketsResp()
+        resp.buckets.extend(['b1', 'b2'])
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_LIST_BUCKETS_RESP,
+                                           resp))
+        self.assertEqual(self.successResultOf(stream.next()), ['b1', 'b2'])
+        self.assertNoResult(d)
+        resp = pbc.RpbListBucketsResp()
+        resp.done = True
+        self.proto.dataReceived(self.frame(pbc.MSG_CODE_LIST_BUCKETS_RESP,
+                                           resp))
+        self.successResultOf(d)
+
+
+class Test_KVCodec(unittest.TestCase):
+    """
+    the hand written encoders must produce what the generated classes parse
+    """
+    def setUp(self):
+        self.client = riak.RiakClient()
+        self.bucket = self.client.bucket('bucket', bucket_type='typed')
+
+    def test_encode_get(self):
+        req = pbc.RpbGetReq()
+        req.ParseFromString(kv_codec.encode_get('bucket', u'k\xe9y', 'typed',
+                                                r='quorum', pr=2, head=True))
+        self.assertEqual(req.bucket, 'bucket')
+        self.assertEqual(req.key, u'k\xe9y'.encode('utf-8'))
+        self.assertEqual(req.type, 'typed')
+        self.assertEqual(req.r, 4294967293)
+        self.assertEqual(req.pr, 2)
+        self.assertTrue(req.head)
+        self.assertFalse(req.HasField('basic_quorum'))
+
+    def test_encode_put(self):
+        obj = self.bucket.new('key', {'foo': 'bar'})
+        obj.set_links([RiakLink('bucket', 'other', 'tag')], all_link=True)
+        obj.set_usermeta({'meta': 'data'})
+        obj.add_index('field_bin', 'value')
+        obj.add_index('field_int', 42)
+        obj.vclock = lambda: 'vclock'
+
+        req = pbc.RpbPutReq()
+        req.ParseFromString(kv_codec.encode_put(obj, w='all', dw='One',
+                                                pw=None, return_body=True,
+                                                if_none_match=False))
+        self.assertEqual((req.bucket, req.key, req.type),
+                         ('bucket', 'key', 'typed'))
+        self.assertEqual(req.vclock, 'vclock')
+        self.assertEqual((req.w, req.dw), (4294967292, 4294967294))
+        self.assertFalse(req.HasField('pw'))
+        self.assertTrue(req.return_body)
+        self.assertTrue(req.HasField('if_none_match'))
+        self.assertFalse(req.if_none_match)
+        self.assertEqual(req.content.value, obj.get_encoded_data())
+        self.assertEqual(req.content.content_type, 'application/json')
+        self.assertEqual([(l.bucket, l.key, l.tag) for l in req.content.links],
+                         [('bucket', 'other', 'tag')])
+        self.assertEqual([(p.key, p.value) for p in req.content.usermeta],
+                         [('meta', 'data')])
+        self.assertEqual(sorted((p.key, p.value) for p in req.content.indexes),
+                         [('field_bin', 'value'), ('field_int', '42')])
+
+    def test_encode_delete(self):
+        req = pbc.RpbDelReq()
+        req.ParseFromString(kv_codec.encode_delete('bucket', 'key', 'default',
+                                                   vclock='vclock',
+                                                   rw='default', w=1))
+        self.assertEqual((req.bucket, req.key, req.type),
+                         ('bucket', 'key', 'default'))
+        self.assertEqual(req.vclock, 'vclock')
+        self.assertEqual((req.rw, req.w), (4294967291, 1))
+        self.assertFalse(req.HasField('dw'))
+
+    def test_timeout_in_milliseconds(self):
+        for encoded, message in (
+                (kv_codec.encode_get('bucket', 'key', timeout=1.5),
+                 pbc.RpbGetReq()),
+                (kv_codec.encode_delete('bucket', 'key', timeout=1.5),
+                 pbc.RpbDelReq()),
+                (kv_codec.encode_put(self.bucket.new('key', 1), timeout=1.5),
+                 pbc.RpbPutReq())):
+            message.ParseFromString(encoded)
+            self.assertEqual(message.timeout, 1500)
+
+    def test_invalid_quorum(self):
+        self.assertRaises(exceptions.RiakPBCException,
+                          kv_codec.encode_get, 'bucket', 'key', r='most')
+
+
+class Test_LazyGetResp(unittest.TestCase):
+    """
+    objects read from a RpbGetResp are only decoded as far as they are used
+    """
+    def setUp(self):
+        self.client = riak.RiakClient()
+        self.bucket = self.client.bucket('bucket')
+
+    def content(self, value):
+        resp = pbc.RpbGetResp()
+        content = resp.content.add()
+        content.value = value
+        content.content_type = 'application/json'
+        content.vtag = 'vtag'
+        link = content.links.add()
+        link.bucket, link.key, link.tag = 'bucket', 'other', 'tag'
+        meta = content.usermeta.add()
+        meta.key, meta.value = 'meta', 'data'
+        index = content.indexes.add()
+        index.key, index.value = 'field_bin', 'value'
+        return content
+
+    def test_metadata_is_a_plain_dict(self):
+        metadata = pbc_transport.decodeContentMetadata(self.content('1'))
+        self.assertIdentical(type(metadata), dict)
+        # nothing is left behind by the C level dict copies
+        for copied in (dict(metadata), dict(**metadata), metadata.copy()):
+            self.assertEqual(copied, metadata)
+        self.assertEqual(sorted(metadata),
+                         sorted([MD_CTYPE, MD_VTAG, MD_LINKS, MD_USERMETA,
+                                 MD_INDEX]))
+        self.assertEqual(metadata[MD_VTAG], 'vtag')
+        self.assertEqual(metadata[MD_USERMETA], {'meta': 'data'})
+        link, = metadata[MD_LINKS]
+        self.assertEqual((link.get_bucket(), link.get_key(), link.get_tag()),
+                         ('bucket', 'other', 'tag'))
+        entry, = metadata[MD_INDEX]
+        self.assertEqual((entry.get_field(), entry.get_value()),
+                         ('field_bin', 'value'))
+
+    def test_no_links(self):
+        content = pbc.RpbGetResp().content.add()
+        metadata = pbc_transport.decodeContentMetadata(content)
+        self.assertEqual(metadata, {MD_USERMETA: {}, MD_INDEX: []})
+
+    @defer.inlineCallbacks
+    def test_siblings_are_decoded_on_access(self):
+        contents = [(pbc_transport.decodeContentMetadata(self.content(value)),
+                     value) for value in ('{"a": 1}', '{"b": 2}', 'not json')]
+        obj = self.bucket.new('key')
+        obj.populate(('vclock', contents))
+
+        self.assertEqual(obj.get_sibling_count(), 3)
+        # never decoded, passed on as read
+        self.assertEqual(obj.get_encoded_data(), '{"a": 1}')
+        self.assertEqual(obj.get_data(), {'a': 1})
+
+        sibling = yield obj.get_sibling(1)
+        self.assertEqual(sibling.vclock(), 'vclock')
+        self.assertEqual(sibling.get_data(), {'b': 2})
+        self.assertEqual(sibling.get_usermeta(), {'meta': 'data'})
+        self.assertIdentical((yield obj.get_sibling(1)), sibling)
+        # a broken sibling only fails when it is looked at
+        broken = yield obj.get_sibling(2)
+        self.assertRaises(ValueError, broken.get_data)
+
+
+class Test_PBCTransportPool(unittest.TestCase):
+    """
+    connection acquisition with all transports busy, no Riak needed
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(pbc_transport, 'reactor', self.clock)
+        self.transport = pbc_transport.PBCTransport(riak.RiakClient())
+        self.transport.MAX_TRANSPORTS = 1
+        self.pool, = self.transport.cluster.nodes
+        # a single connection, in use
+        proto = pbc.RiakPBCClientFactory().buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.stp = pbc_transport.StatefulTransport(self.pool)
+        self.stp.setTransport(proto)
+        self.pool._active.add(self.stp)
+        self.stp.setActive()
+
+    def test_waiters_are_served_in_order(self):
+        served = []
+        for i in range(3):
+            self.pool._getFreeTransport().addCallback(
+                lambda stp, i=i: served.append((i, stp)))
+        self.assertEqual(served, [])
+
+        self.stp.setIdle()
+        self.assertEqual(served, [(0, self.stp)])
+        self.assertTrue(self.stp.isActive())
+        self.stp.setIdle()
+        self.stp.setIdle()
+        self.assertEqual([i for i, stp in served], [0, 1, 2])
+        self.assertEqual(len(self.pool._waiters), 0)
+
+    def test_bounded_queue(self):
+        self.transport.MAX_WAITERS = 1
+        self.pool._getFreeTransport()
+        self.failureResultOf(self.pool._getFreeTransport(),
+                             exceptions.PoolExhausted)
+
+    def test_acquire_timeout(self):
+        self.transport.ACQUIRE_TIMEOUT = 2
+        d = self.pool._getFreeTransport()
+        self.clock.advance(2)
+        self.failureResultOf(d, exceptions.PoolExhausted)
+        self.assertEqual(len(self.pool._waiters), 0)
+        # nobody is waiting anymore
+        self.stp.setIdle()
+        self.assertTrue(self.stp.isIdle())
+
+    def test_deadline(self):
+        d = self.pool._getFreeTransport(deadline=time.time() + 0.5)
+        self.clock.advance(0.5)
+        self.failureResultOf(d, exceptions.RequestTimeout)
+
+    def test_concurrency_limit(self):
+        self.transport.MAX_TRANSPORTS = 2
+        self.pool.limiter.limit = 1
+        # not adapted unless asked for
+        self.assertEqual(self.pool.concurrencyLimit(), 2)
+        self.transport.ADAPTIVE_LIMIT = True
+        self.assertEqual(self.pool.concurrencyLimit(), 1)
+        d = self.pool._getFreeTransport()
+        self.assertEqual(len(self.pool._waiters), 1)
+        self.transport.ADAPTIVE_LIMIT = False
+        self.assertEqual(self.pool.concurrencyLimit(), 2)
+        self.stp.setIdle()
+        self.assertIdentical(self.successResultOf(d), self.stp)
+
+    def test_no_pipelining_behind_a_stream(self):
+        self.transport.MAX_TRANSPORTS = 2
+        self.transport.setPipelineDepth(2)
+        proto = self.stp.getTransport()
+        proto.streamKeys('bucket', ResultStream())
+        # paused by its stream, a get pipelined on it would hang
+        proto.pauseProducing()
+        stp = self.pool._acquireTransport()
+        self.assertNotIdentical(stp, self.stp)
+        self.assertEqual(stp.getTransport(), None)
+        stp.setIdle()
+
+        done = pbc.RpbListKeysResp()
+        done.done = True
+        body = done.SerializeToString()
+        proto.resumeProducing()
+        proto.dataReceived(pack('>IB', len(body) + 1,
+                                pbc.MSG_CODE_LIST_KEYS_RESP) + body)
+        self.assertIdentical(self.pool._acquireTransport(), self.stp)
+
+    def test_mapred_deadline(self):
+        self.patch(pbc, 'reactor', self.clock)
+        self.transport._s_version = '2.0.0'
+        self.stp.setIdle()
+        d = self.transport.mapred('bucket', [], timeout=2000)
+        proto = self.stp.getTransport()
+        request = pbc.RpbMapRedReq()
+        request.ParseFromString(proto.transport.value()[5:])
+        self.assertTrue(0 < json.loads(request.request)['timeout'] <= 2000)
+        self.clock.advance(2)
+        self.failureResultOf(d, exceptions.RequestTimeout)
+
+    def test_released_transports_are_idle(self):
+        self.stp.setIdle()
+        self.assertEqual(list(self.pool._idle), [self.stp])
+        self.assertEqual(self.pool._active, set())
+        d = self.pool._getFreeTransport()
+        self.assertIdentical(self.successResultOf(d), self.stp)
+        self.assertEqual(self.pool._active, set([self.stp]))
+
+    def test_disconnected_transports_are_evicted(self):
+        self.stp.setIdle()
+        self.stp.getTransport().connectionLost(None)
+        self.assertEqual(self.pool._transports, [])
+        # frees the slot for a new transport
+        stp = self.pool._acquireTransport()
+        self.assertEqual(stp.getTransport(), None)
+        self.assertEqual(self.pool._transports, [stp])
+
+
+class Test_PBCWarmPool(unittest.TestCase):
+    """
+    pre-opened connections and the connect limit, no Riak needed
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(pbc_transport, 'reactor', self.clock)
+        self.patch(pbc, 'reactor', self.clock)
+        self.connects = []
+        self.patch(pbc.RiakPBCClient, 'connect',
+                   lambda client, host, port: self.connect())
+        self.transport = pbc_transport.PBCTransport(riak.RiakClient())
+        self.pool, = self.transport.cluster.nodes
+
+    def connect(self):
+        d = defer.Deferred()
+        self.connects.append(d)
+        return d
+
+    def connected(self, d):
+        proto = pbc.RiakPBCClientFactory().buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        d.callback(proto)
+        return proto
+
+    def test_min_idle(self):
+        self.transport.setMinIdle(2)
+        self.assertEqual(len(self.connects), 2)
+        protos = [self.connected(d) for d in self.connects]
+        # pinged before they are used
+        self.assertEqual(len(self.pool._idle), 0)
+        protos[0].dataReceived(pack('>IB', 1, pbc.MSG_CODE_PING_RESP))
+        error = pbc.RpbErrorResp()
+        error.errmsg, error.errcode = 'broken', 1
+        body = error.SerializeToString()
+        protos[1].dataReceived(pack('>IB', len(body) + 1,
+                                    pbc.MSG_CODE_ERROR_RESP) + body)
+        self.assertEqual([stp.getTransport() for stp in self.pool._idle],
+                         [protos[0]])
+        self.assertTrue(protos[1].transport.disconnecting)
+
+        # taking the idle one tops the pool up again
+        stp = self.successResultOf(self.pool._getFreeTransport())
+        self.assertIdentical(stp.getTransport(), protos[0])
+        self.assertEqual(len(self.connects), 4)
+
+    def test_connects_are_capped(self):
+        self.transport.MAX_CONNECTING = 2
+        acquired = [self.pool._getFreeTransport() for i in range(3)]
+        self.assertEqual(len(self.connects), 2)
+        self.connected(self.connects[0])
+        self.successResultOf(acquired[0])
+        self.assertEqual(len(self.connects), 3)
+
+    def pong(self, proto):
+        proto.dataReceived(pack('>IB', 1, pbc.MSG_CODE_PING_RESP))
+
+    def idleTransport(self):
+        acquired = self.pool._getFreeTransport()
+        proto = self.connected(self.connects[-1])
+        stp = self.successResultOf(acquired)
+        stp.setIdle()
+        return stp, proto
+
+    def test_idle_timeout(self):
+        stp, proto = self.idleTransport()
+        self.clock.advance(self.transport.MAX_IDLETIME - 1)
+        self.assertEqual(list(self.pool._idle), [stp])
+        # using it restarts the timer
+        self.successResultOf(self.pool._getFreeTransport()).setIdle()
+        self.clock.advance(self.transport.MAX_IDLETIME - 1)
+        self.assertFalse(proto.transport.disconnecting)
+        self.clock.advance(1)
+        self.assertEqual(list(self.pool._idle), [])
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_idle_min_idle_is_pinged(self):
+        stp, proto = self.idleTransport()
+        self.transport.min_idle = 1
+        self.clock.advance(self.transport.MAX_IDLETIME)
+        self.assertEqual(list(self.pool._idle), [])
+        self.pong(proto)
+        self.assertEqual(list(self.pool._idle), [stp])
+        self.assertFalse(proto.transport.disconnecting)
+
+    def test_ping_before_reuse(self):
+        self.transport.PING_AFTER_IDLE = 10
+        self.patch(time, 'time', self.clock.seconds)
+        stp, proto = self.idleTransport()
+        self.clock.advance(5)
+        # recently used, no ping
+        self.successResultOf(self.pool._getFreeTransport()).setIdle()
+        self.assertEqual(len(proto.transport.value()), 0)
+
+        self.clock.advance(11)
+        acquired = self.pool._getFreeTransport()
+        self.assertNoResult(acquired)
+        self.assertEqual(proto.transport.value(),
+                         pack('>IB', 1, pbc.MSG_CODE_PING_REQ))
+        # no answer, a new connection is opened instead
+        self.clock.advance(self.transport.PING_TIMEOUT)
+        self.assertTrue(proto.isRetired())
+        self.assertEqual(len(self.connects), 2)
+        fresh = self.connected(self.connects[-1])
+        self.assertIdentical(self.successResultOf(acquired).getTransport(),
+                             fresh)
+
+
+class Test_PBCHedging(unittest.TestCase):
+    """
+    hedged reads, no Riak needed
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(pbc_transport, 'reactor', self.clock)
+        self.transport = pbc_transport.PBCTransport(riak.RiakClient())
+        self.transport.setHedging(90, budget=1)
+        latency = metrics.Histogram()
+        for i in range(self.transport.HEDGE_MIN_SAMPLES):
+            latency.observe(0.01)
+        self.transport.metrics.operations['get'] = latency
+        self.reads = []
+
+    def read(self, attempt):
+        d = defer.Deferred()
+        self.reads.append((attempt, d))
+        return d
+
+    def test_hedge_wins(self):
+        result = self.transport._hedged('get', self.read)
+        self.assertEqual(len(self.reads), 1)
+        self.clock.advance(0.01)
+        self.assertEqual(len(self.reads), 2)
+        self.reads[1][1].callback('hedge')
+        self.assertEqual(self.successResultOf(result), 'hedge')
+        self.assertTrue(self.reads[0][0].cancelled)
+        self.reads[0][1].errback(defer.CancelledError())
+        self.assertEqual((self.transport.metrics.hedges,
+                          self.transport.metrics.hedgeWins), (1, 1))
+
+    def test_fast_reads_are_not_hedged(self):
+        result = self.transport._hedged('get', self.read)
+        self.reads[0][1].callback('first')
+        self.assertEqual(self.successResultOf(result), 'first')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failure_waits_for_the_other_read(self):
+        result = self.transport._hedged('get', self.read)
+        self.clock.advance(0.01)
+        self.reads[0][1].errback(exceptions.RequestTimeout('timeout'))
+        self.assertNoResult(result)
+        self.reads[1][1].callback('hedge')
+        self.assertEqual(self.successResultOf(result), 'hedge')
+
+    def test_budget(self):
+        self.transport.setHedging(90, budget=0.25)
+        for i in range(8):
+            self.transport._hedged('get', self.read)
+            self.clock.advance(0.01)
+        self.assertEqual(self.transport.metrics.hedges, 2)
+        self.assertEqual(len(self.reads), 10)
+
+    def test_unmeasured_operations_are_not_hedged(self):
+        self.transport._hedged('index', self.read)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancelled_attempt_sends_nothing(self):
+        pool, = self.transport.cluster.nodes
+        proto = pbc.RiakPBCClientFactory().buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        stp = pbc_transport.StatefulTransport(pool)
+        stp.setTransport(proto)
+        pool._active.add(stp)
+        stp.setActive()
+        stp.setIdle()
+
+        self.transport.MAX_TRANSPORTS = 1
+        busy = self.successResultOf(self.transport._getFreeTransport())
+        attempt = pbc_transport.ReadAttempt()
+        d = self.transport._getFreeTransport(attempt=attempt)
+        attempt.cancelled = True
+        busy.setIdle()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(list(pool._idle), [stp])
@@ -1,7 +1,7 @@
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from riakasaurus import riak, transport
+from riakasaurus import riak, transport, exceptions
 
 
 RIAK_CLIENT_ID = 'TEST'
@@ -28,6 +28,8 @@ class Tests(unittest.TestCase):
 
     @defer.inlineCallbacks
     def test_put_raises_exception_if_max_transports_reached(self):
+        # fail instead of waiting for a transport
+        self.client.get_transport().MAX_WAITERS = 0
         data = 'My data'
         objs = [self.bucket.new_binary(str(i), data) for i in range(4)]
         ds = map(self.put_new, objs)
@@ -55,6 +57,14 @@ class Tests(unittest.TestCase):
         obj = self.bucket.new_binary('my_key', data)
         yield self.put_new(obj)
 
+    @defer.inlineCallbacks
+    def test_pipelining_shares_connections(self):
+        t = self.client.get_transport()
+        t.setPipelineDepth(10)
+        objs = [self.bucket.new_binary(str(i), 'My data') for i in range(20)]
+        yield defer.gatherResults(map(self.put_new, objs))
+        self.assertTrue(len(t._transports) <= 3)
+
     def put_new(self, obj):
         w = self.bucket.get_w(None)
         dw = self.bucket.get_dw(None)
@@ -62,4 +72,4 @@ class Tests(unittest.TestCase):
         return self.client.get_transport().put_new(obj, w=w, dw=dw, pw=pw)
 
     def is_too_many_transports_failure(self, failure):
-        return failure.value.message.startswith('too many transports')
+        return failure.check(exceptions.PoolExhausted)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+tests for retrying idempotent requests, trial. No Riak needed.
+"""
+
+from struct import pack
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from riakasaurus import riak, exceptions
+from riakasaurus.transport import metrics, pbc, pbc_transport, retry
+
+
+class Test_RetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(retry, 'reactor', self.clock)
+        self.patch(retry.time, 'time', self.clock.seconds)
+        # the longest delay, without jitter
+        self.patch(retry.random, 'uniform', lambda low, high: high)
+        self.policy = retry.RetryPolicy(retries=2, backoff=0.1)
+        self.results = []
+
+    def request(self):
+        return defer.maybeDeferred(self.results.pop, 0)
+
+    def test_retries_network_errors(self):
+        self.results = [defer.fail(error.ConnectionLost()),
+                        defer.fail(error.ConnectionRefusedError()), 'ok']
+        counted = metrics.TransportMetrics(None)
+        d = self.policy.call(self.request, metrics=counted)
+        self.assertNoResult(d)
+        self.clock.advance(0.1)
+        self.assertNoResult(d)
+        self.clock.advance(0.2)
+        self.assertEqual(self.successResultOf(d), 'ok')
+        self.assertEqual((self.policy.retried, counted.retries), (2, 2))
+
+    def test_gives_up(self):
+        self.results = [defer.fail(error.ConnectionLost()) for i in range(3)]
+        d = self.policy.call(self.request)
+        self.clock.pump([0.1, 0.2])
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual(self.policy.retried, 2)
+
+    def test_other_errors_are_not_retried(self):
+        self.results = [defer.fail(exceptions.RequestTimeout('timeout'))]
+        self.failureResultOf(self.policy.call(self.request),
+                             exceptions.RequestTimeout)
+
+    def test_deadline(self):
+        self.results = [defer.fail(error.ConnectionLost())]
+        self.policy.backoff = 10
+        d = self.policy.call(self.request, deadline=1)
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual(self.policy.retried, 0)
+
+    def test_backoff_is_capped(self):
+        self.policy.max_backoff = 0.5
+        self.assertEqual(self.policy.delay(1), 0.2)
+        self.assertEqual(self.policy.delay(10), 0.5)
+
+
+class Test_PBCRetries(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(retry, 'reactor', self.clock)
+        self.patch(pbc_transport, 'reactor', self.clock)
+        self.patch(pbc, 'reactor', self.clock)
+        self.protos = []
+        self.patch(pbc.RiakPBCClient, 'connect',
+                   lambda client, host, port: defer.succeed(self.connect()))
+        self.client = riak.RiakClient(
+            retry_policy=retry.RetryPolicy(backoff=0.1))
+        self.transport = pbc_transport.PBCTransport(self.client)
+        self.robj = riak.RiakObject(self.client, self.client.bucket('b'), 'k')
+
+    def connect(self):
+        proto = pbc.RiakPBCClientFactory().buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.protos.append(proto)
+        return proto
+
+    def drop(self, proto):
+        proto.connectionLost(failure.Failure(error.ConnectionLost()))
+
+    def test_get_is_retried_on_a_new_connection(self):
+        d = self.transport.get(self.robj)
+        self.drop(self.protos[0])
+        self.assertNoResult(d)
+        self.clock.advance(self.client.retry_policy.backoff)
+        self.assertEqual(len(self.protos), 2)
+        self.protos[1].dataReceived(pack('>IB', 1, pbc.MSG_CODE_GET_RESP))
+        self.successResultOf(d)
+        self.assertEqual(self.transport.metrics.retries, 1)
+
+    def test_put_is_not_retried(self):
+        d = self.transport.put(self.robj)
+        self.drop(self.protos[0])
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual(len(self.protos), 1)
+        self.assertEqual(self.transport.metrics.retries, 0)
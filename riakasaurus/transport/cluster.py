@@ -0,0 +1,424 @@
+"""
+Load balancing over the nodes of a Riak cluster.
+
+A Cluster holds the nodes a transport talks to and picks one for every
+request with a balancing strategy. Nodes that fail to connect EJECT_AFTER
+times in a row, or don't answer health pings, are ejected and get no
+requests until a health ping succeeds again.
+
+Every node also has a CircuitBreaker. It opens when too many of the recent
+requests to the node failed or timed out, and requests are then failed
+right away with CircuitOpen instead of piling up on an overloaded node.
+After OPEN_TIME a single request is let through to probe the node.
+
+An AdaptiveLimit finds how many requests a node can take at once: it
+grows while latency stays close to the best seen recently, and shrinks
+when latency climbs or requests time out.
+"""
+
+import random
+import time
+from collections import deque
+
+from twisted.internet import defer, error, reactor, task
+from twisted.python import log
+
+from riakasaurus import exceptions
+
+
+def parseNodes(nodes, port):
+    """
+    turn 'host', 'host:port' and (host, port) entries into (host, port)
+    tuples, port is used for entries without one
+    """
+    parsed = []
+    for node in nodes:
+        if isinstance(node, basestring):
+            if ':' in node:
+                host, nodePort = node.rsplit(':', 1)
+                node = (host, int(nodePort))
+            else:
+                node = (node, port)
+        parsed.append(tuple(node))
+    return parsed
+
+
+class Node(object):
+    """
+    a Riak node and what is known about its load and health
+    """
+    # weight of the latest sample in the moving average of the latency
+    LATENCY_DECAY = 0.3
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.pending = 0
+        # moving average of the request latency in seconds, None until
+        # the first request finished
+        self.latency = None
+        # connect or health check failures in a row
+        self.failures = 0
+        self.ejected = False
+        self.breaker = CircuitBreaker()
+
+    def __repr__(self):
+        return '<%s %s:%s pending=%d%s%s>' % (
+            self.__class__.__name__, self.host, self.port,
+            self.outstanding(), ' ejected' if self.ejected else '',
+            ' ' + self.breaker.state if not self.breaker.isClosed() else '')
+
+    def outstanding(self):
+        """
+        requests sent to this node and not answered yet
+        """
+        return self.pending
+
+    def requestStarted(self):
+        self.pending += 1
+        return time.time()
+
+    def requestFinished(self, started):
+        self.pending -= 1
+        self.recordLatency(time.time() - started)
+
+    def requestFailed(self):
+        """
+        a request that never reached the node, its latency means nothing
+        """
+        self.pending -= 1
+
+    def recordLatency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.LATENCY_DECAY * (seconds - self.latency)
+
+
+class CircuitBreaker(object):
+    """
+    the circuit breaker of a node, see the module documentation
+
+    Closed, it counts the outcome of the last WINDOW requests and opens if
+    at least MIN_REQUESTS of them are counted and FAILURE_RATE of them
+    failed. Open, it refuses requests for OPEN_TIME seconds and then goes
+    half-open: a single probe request is let through, closing the breaker
+    if it succeeds and opening it again if it fails. A probe that never
+    reports back is replaced by another one after OPEN_TIME.
+
+    Outcomes of requests started before the breaker last changed state are
+    ignored: while half-open only the probe decides, not a request sent
+    before the breaker opened that happens to finish first.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    WINDOW = 20
+    MIN_REQUESTS = 10
+    FAILURE_RATE = 0.5
+    OPEN_TIME = 10
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=self.WINDOW)  # True for success
+        self._failed = 0
+        self._opened = None   # when it was opened
+        self._probe = None    # when the half-open probe was let through
+        self._changed = None  # when it was last closed or half-opened
+
+    def isClosed(self):
+        return self.state == self.CLOSED
+
+    def allows(self):
+        """
+        whether a request would be let through, without claiming the probe
+        """
+        if self.state == self.CLOSED:
+            return True
+        now = reactor.seconds()
+        if self.state == self.OPEN:
+            return now - self._opened >= self.OPEN_TIME
+        return self._probe is None or now - self._probe >= self.OPEN_TIME
+
+    def acquire(self):
+        """
+        let a request through, returns False if it has to be refused. The
+        first request after OPEN_TIME becomes the half-open probe.
+        """
+        if self.state == self.CLOSED:
+            return True
+        if not self.allows():
+            return False
+        self.state = self.HALF_OPEN
+        self._probe = self._changed = reactor.seconds()
+        return True
+
+    def record(self, success, started=None):
+        """
+        count the outcome of a request sent at started, in reactor.seconds()
+        """
+        if self.state == self.OPEN:
+            # requests sent before it opened, they don't tell anything new
+            return
+        if (started is not None and self._changed is not None and
+                started < self._changed):
+            # sent before the probe or before it closed again
+            return
+        if self.state == self.HALF_OPEN:
+            if success:
+                self.close()
+            else:
+                self.trip()
+            return
+        if len(self._outcomes) == self.WINDOW and not self._outcomes[0]:
+            self._failed -= 1
+        self._outcomes.append(success)
+        if not success:
+            self._failed += 1
+            if (len(self._outcomes) >= self.MIN_REQUESTS and
+                    self._failed >= self.FAILURE_RATE * len(self._outcomes)):
+                self.trip()
+
+    def trip(self):
+        self.state = self.OPEN
+        self._opened = reactor.seconds()
+        self._probe = None
+
+    def close(self):
+        self.state = self.CLOSED
+        self._outcomes.clear()
+        self._failed = 0
+        self._probe = None
+        self._changed = reactor.seconds()
+
+
+class AdaptiveLimit(object):
+    """
+    requests allowed in flight to a node, adjusted AIMD style from the
+    latency of the requests
+
+    Every request that took less than TOLERANCE times the baseline latency
+    (the lowest seen over the last two windows of WINDOW samples) raises
+    the limit by one, if the limit was at least half used. Slower requests
+    and dropped ones (timeouts, overload) multiply it by BACKOFF, at most
+    once per round trip so a burst of slow answers doesn't collapse it.
+
+    :ivar increases: times the limit went up
+    :ivar decreases: times the limit went down
+    """
+    INITIAL = 20
+    MINIMUM = 1
+    BACKOFF = 0.9
+    TOLERANCE = 2.0
+    WINDOW = 100
+
+    def __init__(self):
+        self.limit = float(self.INITIAL)
+        self.increases = 0
+        self.decreases = 0
+        self._baseline = None    # lowest latency of the previous window
+        self._windowMin = None   # lowest latency of the current window
+        self._samples = 0
+        self._backedOff = None   # when the limit was last decreased
+
+    def current(self):
+        return int(self.limit)
+
+    def baseline(self):
+        """
+        lowest recent latency, None without samples
+        """
+        if self._baseline is None:
+            return self._windowMin
+        if self._windowMin is None:
+            return self._baseline
+        return min(self._baseline, self._windowMin)
+
+    def sample(self, latency, inflight, dropped=False):
+        """
+        a request took latency seconds with inflight requests to the node
+        """
+        before = self.current()
+        if not dropped:
+            if self._windowMin is None or latency < self._windowMin:
+                self._windowMin = latency
+            self._samples += 1
+            if self._samples >= self.WINDOW:
+                self._baseline, self._windowMin = self._windowMin, None
+                self._samples = 0
+        if dropped or latency > self.TOLERANCE * self.baseline():
+            now = reactor.seconds()
+            if self._backedOff is None or now - self._backedOff >= latency:
+                self._backedOff = now
+                self.limit = max(self.MINIMUM, self.limit * self.BACKOFF)
+        elif inflight * 2 >= self.limit:
+            self.limit += 1
+        if self.current() > before:
+            self.increases += 1
+        elif self.current() < before:
+            self.decreases += 1
+
+    def asDict(self):
+        return {
+            'limit': self.current(),
+            'baseline': self.baseline(),
+            'increases': self.increases,
+            'decreases': self.decreases,
+        }
+
+
+class RoundRobin(object):
+    """
+    every node in turn
+    """
+    def __init__(self):
+        self._next = 0
+
+    def select(self, nodes):
+        self._next += 1
+        return nodes[self._next % len(nodes)]
+
+
+class LeastOutstanding(object):
+    """
+    the node with the fewest requests in flight, ties are broken at
+    random so idle nodes share the load
+    """
+    def select(self, nodes):
+        least = min(node.outstanding() for node in nodes)
+        return random.choice([node for node in nodes
+                              if node.outstanding() == least])
+
+
+class LatencyWeighted(object):
+    """
+    a random node, weighted by the inverse of its average latency. Nodes
+    without a measurement yet are weighted like the fastest one.
+    """
+    def select(self, nodes):
+        known = [node.latency for node in nodes if node.latency is not None]
+        fastest = max(min(known), 0.0001) if known else 1
+        weights = [1 / max(node.latency, 0.0001)
+                   if node.latency is not None else 1 / fastest
+                   for node in nodes]
+        pick = random.random() * sum(weights)
+        for node, weight in zip(nodes, weights):
+            pick -= weight
+            if pick < 0:
+                return node
+        return nodes[-1]
+
+
+STRATEGIES = {
+    'round_robin': RoundRobin,
+    'least_outstanding': LeastOutstanding,
+    'latency_weighted': LatencyWeighted,
+}
+
+
+class Cluster(object):
+    """
+    the nodes of a transport, see the module documentation
+
+    :param nodes: Node instances
+    :param strategy: a name from STRATEGIES, or an object with a
+        select(nodes) method
+    """
+    # connect or health check failures in a row that eject a node
+    EJECT_AFTER = 3
+    # seconds between health pings
+    HEALTH_INTERVAL = 5
+    # seconds a node has to answer a health ping
+    PING_TIMEOUT = 2
+
+    def __init__(self, nodes, strategy='round_robin'):
+        self.nodes = list(nodes)
+        if isinstance(strategy, basestring):
+            try:
+                strategy = STRATEGIES[strategy]()
+            except KeyError:
+                raise ValueError('unknown balancing strategy %r, use one '
+                                 'of %s' % (strategy, ', '.join(STRATEGIES)))
+        self.strategy = strategy
+        self._ping = None
+        self._health = None
+
+    def available(self):
+        """
+        the nodes that are not ejected. If all of them are, all nodes:
+        trying one is better than failing every request.
+        """
+        return [node for node in self.nodes if not node.ejected] or self.nodes
+
+    def pick(self):
+        """
+        the node for the next request, nodes with an open circuit breaker
+        are skipped. Raises CircuitOpen if there is none left.
+        """
+        if len(self.nodes) == 1:
+            node = self.nodes[0]
+        else:
+            nodes = [node for node in self.available()
+                     if node.breaker.allows()]
+            if not nodes:
+                raise exceptions.CircuitOpen(
+                    'circuit breakers of all %d nodes are open' %
+                    len(self.nodes))
+            node = self.strategy.select(nodes)
+        if not node.breaker.acquire():
+            raise exceptions.CircuitOpen(
+                'circuit breaker of %s:%s is open' % (node.host, node.port))
+        return node
+
+    def succeeded(self, node):
+        """
+        node connected or answered a health ping
+        """
+        node.failures = 0
+        if node.ejected:
+            node.ejected = False
+            log.msg('[%s] reinstated %s' % (self.__class__.__name__, node))
+
+    def failed(self, node):
+        """
+        node could not be connected to or failed a health ping
+        """
+        node.failures += 1
+        if node.failures >= self.EJECT_AFTER and not node.ejected:
+            node.ejected = True
+            log.msg('[%s] ejected %s after %d failures' % (
+                self.__class__.__name__, node, node.failures))
+
+    def startHealthChecks(self, ping):
+        """
+        ping every node each HEALTH_INTERVAL seconds
+
+        :param ping: called with a node and PING_TIMEOUT, returns a
+            deferred failing if the node is not healthy. Connect errors
+            are expected to be reported by the transport already.
+        """
+        self._ping = ping
+        self._health = task.LoopingCall(self.checkHealth)
+        self._health.clock = reactor
+        self._health.start(self.HEALTH_INTERVAL, now=False)
+
+    def stopHealthChecks(self):
+        if self._health is not None and self._health.running:
+            self._health.stop()
+
+    def checkHealth(self):
+        return defer.DeferredList([self._checkNode(node)
+                                   for node in self.nodes])
+
+    def _checkNode(self, node):
+        def healthy(result):
+            self.succeeded(node)
+
+        def unhealthy(failure):
+            if not failure.check(error.ConnectError):
+                self.failed(node)
+
+        return defer.maybeDeferred(self._ping, node,
+                                   self.PING_TIMEOUT).addCallbacks(
+            healthy, unhealthy)
@@ -7,16 +7,19 @@ from twisted.internet import defer, reactor, protocol, error
 from twisted.web.http_headers import Headers
 from twisted.web import client
 client._HTTP11ClientFactory.noisy = False
-from twisted.web.client import Agent
+from twisted.web.client import Agent, HTTPConnectionPool
 from twisted.web.iweb import IBodyProducer
+from twisted.internet.interfaces import IConsumer
+from twisted.web.http import PotentialDataLoss
 from twisted.python import log
+from twisted.python.failure import Failure
 
 # MD_ resources
 from riakasaurus.metadata import *
 
 from riakasaurus.riak_index_entry import RiakIndexEntry
 from riakasaurus.mapreduce import RiakLink
-from riakasaurus.transport import transport
+from riakasaurus.transport import transport, cluster, metrics
 from riakasaurus import exceptions
 
 from distutils.version import LooseVersion
@@ -24,6 +27,7 @@ from cStringIO import StringIO
 from xml.etree import ElementTree
 
 import urllib
+import json
 import re
 import csv
 import time
@@ -52,6 +56,245 @@ class BodyReceiver(protocol.Protocol):
         self.finished.callback(self.buffer)
 
 
+class JSONStreamParser(object):
+    """
+    incremental parser of concatenated JSON objects, the body Riak sends
+    for keys=stream and buckets=stream. feed() returns the objects a chunk
+    completes, the incomplete rest is kept until more data arrives.
+    """
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+
+    def feed(self, data):
+        buf = self.buffer + data
+        objects = []
+        pos = 0
+        while True:
+            while buf[pos:pos + 1].isspace():
+                pos += 1
+            if pos == len(buf):
+                break
+            try:
+                obj, pos = self.decoder.raw_decode(buf, pos)
+            except ValueError:
+                # incomplete, wait for the rest
+                break
+            objects.append(obj)
+        self.buffer = buf[pos:]
+        return objects
+
+    def close(self):
+        """
+        the body is complete, raises ValueError if an object was cut off
+        """
+        if self.buffer.strip():
+            raise ValueError('truncated JSON stream: %r' % self.buffer[:80])
+
+
+class MultipartParser(object):
+    """
+    incremental parser of a multipart/mixed body, as Riak sends it for
+    chunked=true MapReduce. feed() returns the (headers, body) of the parts
+    a chunk completes, headers a dict with lowercase names. A part is
+    complete once the delimiter following it arrived.
+    """
+    def __init__(self, boundary):
+        self.delimiter = '\r\n--' + boundary
+        # the first delimiter need not follow a line break
+        self.buffer = '\r\n'
+        self.searched = 0
+        self.started = False
+        self.done = False
+
+    def feed(self, data):
+        self.buffer += data
+        parts = []
+        while not self.done:
+            end = self.buffer.find(self.delimiter, self.searched)
+            after = end + len(self.delimiter)
+            if end < 0 or len(self.buffer) < after + 2:
+                # no need to search the same bytes again
+                self.searched = max(0, len(self.buffer) - len(self.delimiter)
+                                    - 1)
+                break
+            if self.started:
+                parts.append(self._part(self.buffer[:end]))
+            self.started = True
+            self.done = self.buffer[after:after + 2] == '--'
+            self.buffer = self.buffer[after:]
+            self.searched = 0
+        return parts
+
+    def _part(self, text):
+        # the rest of the delimiter line, then headers, a blank line, body
+        text = text[text.find('\r\n') + 2:]
+        if text.startswith('\r\n'):
+            return {}, text[2:]
+        lines, _, body = text.partition('\r\n\r\n')
+        headers = {}
+        for line in lines.split('\r\n'):
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return headers, body
+
+    def close(self):
+        """
+        the body is complete, raises ValueError without the final delimiter
+        """
+        if not self.done:
+            raise ValueError('truncated multipart body')
+
+
+class JSONStreamReceiver(protocol.Protocol):
+    """
+    body consumer for streamed listings, writes the field of every JSON
+    object to stream as it arrives instead of buffering the body. A stream
+    providing registerProducer may pause the connection.
+    """
+    def __init__(self, finished, field, stream):
+        self.finished = finished
+        self.field = field
+        self.stream = stream
+        self.parser = JSONStreamParser()
+
+    def connectionMade(self):
+        if hasattr(self.stream, 'registerProducer'):
+            self.stream.registerProducer(self.transport)
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        try:
+            for obj in self.parser.feed(data):
+                self.objectReceived(obj)
+        except Exception:
+            self.finished.errback()
+            self.transport.loseConnection()
+
+    def objectReceived(self, obj):
+        if 'error' in obj:
+            raise exceptions.RiakError(obj['error'])
+        if obj.get(self.field):
+            self.stream.write(obj[self.field])
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if not reason.check(client.ResponseDone, PotentialDataLoss):
+            self.finished.errback(reason)
+            return
+        try:
+            self.parser.close()
+        except ValueError:
+            self.finished.errback()
+        else:
+            self.finished.callback(None)
+
+
+class MultipartReceiver(JSONStreamReceiver):
+    """
+    body consumer for multipart/mixed bodies with a JSON object in every
+    part, passes each object to resultReceived as its part arrives
+    """
+    def __init__(self, finished, boundary, stream):
+        JSONStreamReceiver.__init__(self, finished, None, stream)
+        self.boundary = boundary
+        if boundary is not None:
+            self.parser = MultipartParser(boundary)
+
+    def dataReceived(self, data):
+        if self.boundary is not None:
+            JSONStreamReceiver.dataReceived(self, data)
+
+    def connectionLost(self, reason):
+        if self.boundary is None and not self.finished.called:
+            self.finished.errback(exceptions.RiakError(
+                'response is not multipart/mixed'))
+            return
+        JSONStreamReceiver.connectionLost(self, reason)
+
+    def objectReceived(self, part):
+        headers, body = part
+        result = json.loads(body)
+        if 'error' in result:
+            raise exceptions.RiakError(result['error'])
+        self.resultReceived(result)
+
+
+class MapRedReceiver(MultipartReceiver):
+    """
+    body consumer for chunked MapReduce, writes (phase, results) to stream
+    for every part as it arrives, like PBCTransport.stream_mapred
+    """
+    def resultReceived(self, result):
+        self.stream.write((result.get('phase'), result.get('data', [])))
+
+
+class IndexReceiver(MultipartReceiver):
+    """
+    body consumer for streamed secondary index queries, writes the keys,
+    or (term, key) pairs for return_terms, of every part to stream as it
+    arrives and keeps the continuation of the page
+    """
+    continuation = None
+
+    def resultReceived(self, result):
+        if result.get('continuation'):
+            self.continuation = result['continuation']
+        if result.get('keys'):
+            self.stream.write(result['keys'])
+        elif result.get('results'):
+            self.stream.write([pair.items()[0]
+                               for pair in result['results']])
+
+
+class BodyWriter(protocol.Protocol):
+    """
+    body consumer writing the body to a file or an IConsumer as it arrives
+    instead of buffering it. An IConsumer is registered with the
+    connection as its producer, so it can pause it.
+    """
+    def __init__(self, finished, consumer):
+        self.finished = finished
+        self.consumer = consumer
+        self.registered = IConsumer.providedBy(consumer)
+
+    def connectionMade(self):
+        if self.registered:
+            self.consumer.registerProducer(self.transport, True)
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        try:
+            self.consumer.write(data)
+        except Exception:
+            self.finished.errback()
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.registered:
+            self.consumer.unregisterProducer()
+        if self.finished.called:
+            return
+        if reason.check(client.ResponseDone, PotentialDataLoss):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
+class ListCollector(object):
+    """
+    stream for a JSONStreamReceiver collecting all chunks in one list
+    """
+    def __init__(self):
+        self.items = []
+
+    def write(self, chunk):
+        self.items.extend(chunk)
+
+
 class StringProducer(object):
     """
     Body producer for t.w.c.Agent
@@ -125,18 +368,98 @@ class XMLSearchResult(object):
         }
 
 
+class MeteredConnectionPool(HTTPConnectionPool):
+    """
+    a persistent connection pool counting connects and the time requests
+    wait for a connection in the metrics of the transport
+    """
+    def __init__(self, reactor, metrics):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.metrics = metrics
+
+    def getConnection(self, key, endpoint):
+        started = time.time()
+
+        def acquired(connection):
+            self.metrics.acquireWait.observe(time.time() - started)
+            return connection
+        return HTTPConnectionPool.getConnection(
+            self, key, endpoint).addCallback(acquired)
+
+    def _newConnection(self, key, endpoint):
+        started = time.time()
+
+        def connected(connection):
+            self.metrics.connects += 1
+            self.metrics.connectLatency.observe(time.time() - started)
+            return connection
+
+        def failed(failure):
+            self.metrics.connectFailures += 1
+            return failure
+        return HTTPConnectionPool._newConnection(
+            self, key, endpoint).addCallbacks(connected, failed)
+
+
 class HTTPTransport(transport.FeatureDetection):
 
     implements(transport.ITransport)
 
     """ HTTP Transport for Riak """
+    # idle connections kept open to every node
+    MAX_PERSISTENT = 10
+    # seconds after which an idle connection is closed
+    MAX_IDLETIME = 5 * 60
+    # bytes read from a file at a time by put_stream
+    UPLOAD_CHUNK = 2 ** 16
+
     def __init__(self, client, prefix=None):
         self.host = client._host
         self.port = client._port
         self.client = client
         self._client_id = None
+        self.cluster = cluster.Cluster(
+            [cluster.Node(host, port) for host, port in client._nodes],
+            client._balancer)
+        # pool and request metrics, see metrics
+        self.metrics = metrics.HTTPTransportMetrics(self)
+        # keep-alive connections shared by all requests
+        self.pool = MeteredConnectionPool(reactor, self.metrics)
+        self.pool.maxPersistentPerHost = self.MAX_PERSISTENT
+        self.pool.cachedConnectionTimeout = self.MAX_IDLETIME
+        self.agent = Agent(reactor, pool=self.pool)
+        if len(self.cluster.nodes) > 1:
+            self.cluster.startHealthChecks(self._pingNode)
+
+    def quit(self):
+        """
+        stop the health checks of the nodes and close the idle
+        connections
+        """
+        self.cluster.stopHealthChecks()
+        return self.pool.closeCachedConnections()
+
+    def setMaxPersistent(self, count):
+        """
+        keep at most count idle connections open to every node, more are
+        closed as they become idle
+        """
+        self.pool.maxPersistentPerHost = count
 
-    def http_response(self, response):
+    def setMaxIdleTime(self, seconds):
+        """
+        close connections idle for seconds, from the next time they become
+        idle
+        """
+        self.pool.cachedConnectionTimeout = seconds
+
+    def http_response(self, response, receiver=None):
+        """
+        the headers and body of response. With a receiver the body of a
+        200 response is not buffered but delivered to the protocol
+        receiver(response, finished), firing finished with the body to
+        return.
+        """
         def haveBody(body):
             headers = {"http_code": response.code}
             for key, val in response.headers.getAllRawHeaders():
@@ -144,6 +467,10 @@ class HTTPTransport(transport.FeatureDetection):
 
             return headers, body.read()
 
+        if receiver is not None and response.code == 200:
+            d = defer.Deferred()
+            response.deliverBody(receiver(response, d))
+            return d.addCallback(lambda body: haveBody(StringIO(body or '')))
         if response.length:
             d = defer.Deferred()
             response.deliverBody(BodyReceiver(d))
@@ -153,12 +480,45 @@ class HTTPTransport(transport.FeatureDetection):
 
     def abort_request(self, agent):
         """Called to abort request on timeout"""
-        if not agent.called:
-            t = self.client.request_timeout
-            agent.cancel()
+        # once connected agent is called already, waiting for the deferred
+        # of the request itself. cancel() passes on to that one.
+        agent.cancel()
 
-    def http_request(self, method, path, headers={}, body=None):
-        url = "http://%s:%s%s" % (self.host, self.port, path)
+    def http_request(self, method, path, headers={}, body=None, timeout=None,
+                     node=None, receiver=None):
+        """
+        send a request to node, by default the one picked by the balancing
+        strategy. GET and HEAD requests without a node are retried with the
+        retry policy of the client, they are idempotent. All attempts share
+        the timeout. Requests with a receiver (see http_response) are not
+        retried, the receiver may have passed on part of the body already.
+        """
+        if node is None and receiver is None and method in ('GET', 'HEAD'):
+            timeout = timeout or self.client.request_timeout
+            deadline = time.time() + timeout if timeout else None
+
+            def attempt():
+                budget = None
+                if deadline is not None:
+                    budget = deadline - time.time()
+                    if budget <= 0:
+                        return defer.fail(
+                            exceptions.RequestTimeout('deadline exceeded'))
+                return self._http_request(method, path, headers, body,
+                                          budget)
+            return self.client.retry_policy.call(attempt, deadline,
+                                                 self.metrics)
+        return self._http_request(method, path, headers, body, timeout, node,
+                                  receiver)
+
+    def _http_request(self, method, path, headers, body, timeout,
+                      node=None, receiver=None):
+        if node is None:
+            try:
+                node = self.cluster.pick()
+            except exceptions.CircuitOpen:
+                return defer.fail()
+        url = "http://%s:%s%s" % (node.host, node.port, path)
 
         h = {}
         for k, v in headers.items():
@@ -171,37 +531,103 @@ class HTTPTransport(transport.FeatureDetection):
         if not 'content-type' in h.keys():
             h['content-type'] = ['application/json']
 
-        if body:
+        if IBodyProducer.providedBy(body):
+            bodyProducer = body
+        elif body:
             bodyProducer = StringProducer(body)
         else:
             bodyProducer = None
 
-        requestAgent = Agent(reactor).request(
+        started = node.requestStarted()
+        # for the circuit breaker, which keeps reactor time
+        sent = reactor.seconds()
+        requestAgent = self.agent.request(
                 method, str(url), Headers(h), bodyProducer)
 
-        if self.client.request_timeout:
+        if timeout or self.client.request_timeout:
             # Start request timer
-            t = self.client.request_timeout
+            t = timeout or self.client.request_timeout
             timeout = reactor.callLater(t,
                 self.abort_request, requestAgent)
 
             def timeoutProxy(request):
                 if timeout.active():
                     timeout.cancel()
-                return self.http_response(request)
+                return self.http_response(request, receiver)
 
             def requestAborted(failure):
-                failure.trap(defer.CancelledError,
-                             error.ConnectingCancelledError)
+                # cancelling a request that was sent already fails it with
+                # ResponseNeverReceived, not with CancelledError
+                if not timeout.called:
+                    if timeout.active():
+                        timeout.cancel()
+                    return failure
 
                 raise exceptions.RequestTimeout(
                     "Request took longer than %s seconds" % t)
 
             requestAgent.addCallback(timeoutProxy).addErrback(requestAborted)
         else:
-            requestAgent.addCallback(self.http_response)
+            requestAgent.addCallback(self.http_response, receiver)
+
+        def requestFinished(result):
+            op = self._operation(method, path)
+            if not isinstance(result, Failure):
+                node.requestFinished(started)
+                if node.failures:
+                    self.cluster.succeeded(node)
+                # 503 is how an overloaded node answers
+                node.breaker.record(result[0]['http_code'] < 500, sent)
+                self.metrics.requestDone(
+                    op, time.time() - started,
+                    failed=result[0]['http_code'] >= 500)
+            elif result.check(error.ConnectError):
+                node.requestFailed()
+                self.cluster.failed(node)
+                node.breaker.record(False, sent)
+            else:
+                node.requestFinished(started)
+                node.breaker.record(False, sent)
+                self.metrics.requestDone(
+                    op, time.time() - started, failed=True,
+                    timedOut=bool(result.check(exceptions.RequestTimeout)))
+            return result
+
+        return requestAgent.addBoth(requestFinished)
+
+    def _operation(self, method, path):
+        """
+        the operation a request is counted for in the metrics, see
+        metrics.OPERATIONS
+        """
+        path = path.split('?', 1)[0]
+        if '/datatypes/' in path:
+            return 'datatype_fetch' if method == 'GET' else 'datatype_update'
+        if '/counters/' in path:
+            return 'counter_get' if method == 'GET' else 'counter_update'
+        if '/index/' in path:
+            return 'index'
+        if path.startswith('/%s' % self.client._mapred_prefix):
+            return 'mapred'
+        if '/keys/' in path and method in ('GET', 'HEAD'):
+            return 'get'
+        if path.endswith('/keys') or '/keys/' in path:
+            if method in ('PUT', 'POST'):
+                return 'put'
+            if method == 'DELETE':
+                return 'delete'
+        return 'other'
 
-        return requestAgent
+    @defer.inlineCallbacks
+    def _pingNode(self, node, timeout):
+        """
+        health check of a single node
+        """
+        headers, body = yield self.http_request('GET', '/ping',
+                                                timeout=timeout, node=node)
+        if body != 'OK':
+            raise exceptions.RiakError('ping of %s:%s answered %r' % (
+                node.host, node.port, body))
 
     def build_rest_path(self, bucket=None, key=None, params=None, prefix=None):
         """
@@ -234,6 +660,13 @@ class HTTPTransport(transport.FeatureDetection):
         # Return.
         return path
 
+    def _milliseconds(self, timeout):
+        """
+        the timeout query parameter, Riak expects milliseconds
+        """
+        if timeout:
+            return max(1, int(timeout * 1000))
+
     def decodeJson(self, s):
         return self.client.get_decoder('application/json')(s)
 
@@ -241,20 +674,50 @@ class HTTPTransport(transport.FeatureDetection):
         return self.client.get_encoder('application/json')(s)
 
     @defer.inlineCallbacks
-    def get_keys(self, bucket):
-        params = {
-            'props': 'true',
-            'keys': 'true'
-        }
+    def _stream_json(self, prefix, params, field, stream, timeout=None):
+        """
+        GET a streamed listing, writing field of every JSON object in the
+        body to stream as it arrives, see JSONStreamReceiver
+        """
+        url = self.build_rest_path(prefix=prefix, params=params)
+        headers, body = yield self.http_request(
+            'GET', url, timeout=timeout,
+            receiver=lambda response, finished: JSONStreamReceiver(
+                finished, field, stream))
+        if headers['http_code'] != 200:
+            raise exceptions.RiakError('Error listing %s: %s' % (field, body))
+
+    def _list_json(self, prefix, params, field, timeout=None):
+        """
+        like _stream_json, collecting all chunks in a list. Retried with
+        the retry policy of the client, nothing is returned before the
+        listing is complete.
+        """
+        def listing():
+            items = ListCollector()
+            d = self._stream_json(prefix, params, field, items, timeout)
+            return d.addCallback(lambda _: items.items)
+        return self.client.retry_policy.call(listing, metrics=self.metrics)
+
+    def get_keys(self, bucket, timeout=None):
+        """
+        list the keys of a bucket, parsed chunk by chunk from a keys=stream
+        listing so the body is never held in memory
+        """
+        params = {'keys': 'stream', 'timeout': self._milliseconds(timeout)}
         prefix = 'types/%s/buckets/%s/keys' %(bucket.bucket_type,bucket.name)
-        url = self.build_rest_path(prefix = prefix, params=params)
-        headers, encoded_props = yield self.http_request('GET', url)
-        if headers['http_code'] == 200:
-            props = self.decodeJson(encoded_props)
-        else:
-            raise Exception('Error getting bucket properties.')
+        return self._list_json(prefix, params, 'keys', timeout)
 
-        defer.returnValue(props['keys'])
+    @defer.inlineCallbacks
+    def stream_keys(self, bucket, stream, timeout=None):
+        """
+        list the keys of a bucket, writing every chunk of a keys=stream
+        listing to stream as it arrives
+        """
+        params = {'keys': 'stream', 'timeout': self._milliseconds(timeout)}
+        prefix = 'types/%s/buckets/%s/keys' %(bucket.bucket_type,bucket.name)
+        yield self._stream_json(prefix, params, 'keys', stream, timeout)
+        stream.finish()
 
     @defer.inlineCallbacks
     def set_bucket_props(self, bucket, props):
@@ -340,44 +803,66 @@ class HTTPTransport(transport.FeatureDetection):
             defer.returnValue({})
 
     @defer.inlineCallbacks
-    def get(self, robj, r=None, pr=None, vtag=None):
+    def get(self, robj, r=None, pr=None, vtag=None, timeout=None):
         """
         Get a bucket/key from the server
         """
         # We could detect quorum_controls here but HTTP ignores
         # unknown flags/params.
-        params = {'r': r, 'pr': pr}
+        params = {'r': r, 'pr': pr, 'timeout': self._milliseconds(timeout)}
 
         if vtag is not None:
             params['vtag'] = vtag
 
         url = self.build_rest_path(robj.get_bucket(), robj.get_key(),
                                    params=params)
-        response = yield self.http_request('GET', url)
+        # all siblings in one multipart/mixed response instead of a list
+        # of vtags to fetch one by one
+        headers = {'Accept': 'multipart/mixed, */*;q=0.9'}
+        response = yield self.http_request('GET', url, headers,
+                                           timeout=timeout)
+        defer.returnValue(
+            self.parse_body(response, [200, 300, 404])
+        )
+
+    @defer.inlineCallbacks
+    def get_stream(self, robj, consumer, r=None, pr=None, timeout=None):
+        """
+        like get, but the value is written to consumer, a file or an
+        IConsumer, chunk by chunk as it arrives and returned empty. Not
+        retried, part of the value may have been written already.
+        """
+        params = {'r': r, 'pr': pr, 'timeout': self._milliseconds(timeout)}
+        url = self.build_rest_path(robj.get_bucket(), robj.get_key(),
+                                   params=params)
+        response = yield self.http_request(
+            'GET', url, timeout=timeout,
+            receiver=lambda response, finished: BodyWriter(finished,
+                                                           consumer))
         defer.returnValue(
             self.parse_body(response, [200, 300, 404])
         )
 
     @defer.inlineCallbacks
-    def head(self, robj, r=None, pr=None, vtag=None):
+    def head(self, robj, r=None, pr=None, vtag=None, timeout=None):
         """
         Get metadata for a bucket/key from the server, basically
         the same as get() but retrieves no data
         """
-        params = {'r': r, 'pr': pr}
+        params = {'r': r, 'pr': pr, 'timeout': self._milliseconds(timeout)}
 
         if vtag is not None:
             params['vtag'] = vtag
         url = self.build_rest_path(robj.get_bucket(), robj.get_key(),
                                    params=params)
 
-        response = yield self.http_request('HEAD', url)
+        response = yield self.http_request('HEAD', url, timeout=timeout)
         defer.returnValue(
             self.parse_body(response, [200, 300, 404])
         )
 
     def put(self, robj, w=None, dw=None, pw=None, return_body=True,
-            if_none_match=False):
+            if_none_match=False, timeout=None):
         """
         Serialize put request and deserialize response
         """
@@ -387,7 +872,8 @@ class HTTPTransport(transport.FeatureDetection):
             'returnbody': str(return_body).lower(),
             'w': w,
             'dw': dw,
-            'pw': pw
+            'pw': pw,
+            'timeout': self._milliseconds(timeout)
         }
         url = self.build_rest_path(bucket=robj.get_bucket(),
                                    key=robj.get_key(),
@@ -400,14 +886,18 @@ class HTTPTransport(transport.FeatureDetection):
             headers["If-None-Match"] = "*"
         content = robj.get_encoded_data()
         return self.do_put(
-            url, headers, content, return_body, key=robj.get_key())
+            url, headers, content, return_body, key=robj.get_key(),
+            timeout=timeout)
 
     @defer.inlineCallbacks
-    def do_put(self, url, headers, content, return_body=False, key=None):
+    def do_put(self, url, headers, content, return_body=False, key=None,
+               timeout=None):
         if key is None:
-            response = yield self.http_request('POST', url, headers, content)
+            response = yield self.http_request('POST', url, headers, content,
+                                               timeout=timeout)
         else:
-            response = yield self.http_request('PUT', url, headers, content)
+            response = yield self.http_request('PUT', url, headers, content,
+                                               timeout=timeout)
 
         if return_body:
             defer.returnValue(self.parse_body(response, [200, 201, 300]))
@@ -415,9 +905,41 @@ class HTTPTransport(transport.FeatureDetection):
             self.check_http_code(response, [204])
             defer.returnValue(None)
 
+    @defer.inlineCallbacks
+    def put_stream(self, robj, source, w=None, dw=None, pw=None,
+                   timeout=None):
+        """
+        store the value of robj read from source, a file or an
+        IBodyProducer, chunk by chunk instead of from memory. Returns the
+        key, generated by Riak if robj has none.
+        """
+        params = {
+            'returnbody': 'false',
+            'w': w,
+            'dw': dw,
+            'pw': pw,
+            'timeout': self._milliseconds(timeout)
+        }
+        url = self.build_rest_path(bucket=robj.get_bucket(),
+                                   key=robj.get_key(), params=params)
+        headers = self.build_put_headers(robj)
+        if not IBodyProducer.providedBy(source):
+            source = client.FileBodyProducer(source,
+                                             readSize=self.UPLOAD_CHUNK)
+        if robj.get_key() is None:
+            response = yield self.http_request('POST', url, headers, source,
+                                               timeout=timeout)
+            self.check_http_code(response, [201])
+            location = response[0]['location']
+            defer.returnValue(location[location.rindex('/') + 1:])
+        response = yield self.http_request('PUT', url, headers, source,
+                                           timeout=timeout)
+        self.check_http_code(response, [200, 204])
+        defer.returnValue(robj.get_key())
+
     @defer.inlineCallbacks
     def put_new(self, robj, w=None, dw=None, pw=None, return_body=True,
-                if_none_match=False):
+                if_none_match=False, timeout=None):
         """Put a new object into the Riak store, returning its (new) key."""
         # We could detect quorum_controls here but HTTP ignores
         # unknown flags/params.
@@ -425,7 +947,8 @@ class HTTPTransport(transport.FeatureDetection):
             'returnbody': str(return_body).lower(),
             'w': w,
             'dw': dw,
-            'pw': pw
+            'pw': pw,
+            'timeout': self._milliseconds(timeout)
         }
         url = self.build_rest_path(bucket=robj.get_bucket(), params=params)
         headers = self.build_put_headers(robj)
@@ -434,7 +957,8 @@ class HTTPTransport(transport.FeatureDetection):
         if if_none_match:
             headers["If-None-Match"] = "*"
         content = robj.get_encoded_data()
-        response = yield self.http_request('POST', url, headers, content)
+        response = yield self.http_request('POST', url, headers, content,
+                                           timeout=timeout)
         location = response[0]['location']
         idx = location.rindex('/')
         key = location[idx + 1:]
@@ -481,44 +1005,43 @@ class HTTPTransport(transport.FeatureDetection):
 
     @defer.inlineCallbacks
     def delete(self, robj, rw=None, r=None, w=None, dw=None, pr=None,
-               pw=None):
+               pw=None, timeout=None):
         """
         Delete an object.
         """
         # We could detect quorum_controls here but HTTP ignores
         # unknown flags/params.
-        params = {'rw': rw, 'r': r, 'w': w, 'dw': dw, 'pr': pr, 'pw': pw}
+        params = {'rw': rw, 'r': r, 'w': w, 'dw': dw, 'pr': pr, 'pw': pw,
+                  'timeout': self._milliseconds(timeout)}
         headers = {}
         url = self.build_rest_path(robj.get_bucket(), robj.get_key(),
                                    params=params)
         ts = yield self.tombstone_vclocks()
         if ts and robj.vclock() is not None:
             headers['X-Riak-Vclock'] = robj.vclock()
-        response = yield self.http_request('DELETE', url, headers)
+        response = yield self.http_request('DELETE', url, headers,
+                                           timeout=timeout)
         self.check_http_code(response, [204, 404])
         defer.returnValue(self)
 
-    @defer.inlineCallbacks
     def get_buckets(self,bucket_type = 'default'):
         """
-        Fetch a list of all buckets
+        Fetch a list of all buckets, parsed chunk by chunk from a
+        buckets=stream listing
         """
-        params = {'buckets': 'true'}
         prefix = 'types/%s/buckets' %bucket_type
-        url = self.build_rest_path(None, prefix = prefix,params=params)
-        response = yield self.http_request('GET', url)
-
-        headers, encoded_props = response[0:2]
-        if headers['http_code'] == 200:
-            props = self.decodeJson(encoded_props)
-        else:
-            print url
-            print headers
-            print response
-            log.err()
-            raise Exception('Error getting buckets.')
+        return self._list_json(prefix, {'buckets': 'stream'}, 'buckets')
 
-        defer.returnValue(props['buckets'])
+    @defer.inlineCallbacks
+    def stream_buckets(self, stream, bucket_type='default'):
+        """
+        list all buckets, writing every chunk of a buckets=stream listing
+        to stream as it arrives
+        """
+        prefix = 'types/%s/buckets' %bucket_type
+        yield self._stream_json(prefix, {'buckets': 'stream'}, 'buckets',
+                                stream)
+        stream.finish()
 
     @defer.inlineCallbacks
     def get_bucket_props(self, bucket):
@@ -589,15 +1112,54 @@ class HTTPTransport(transport.FeatureDetection):
         result = self.decodeJson(response[1])
         defer.returnValue(result)
 
+    @defer.inlineCallbacks
+    def stream_mapred(self, inputs, query, stream, timeout=None):
+        """
+        Run a MapReduce query with chunked=true, writing (phase, results)
+        to stream for every part of the response as it arrives.
+        """
+        plm = yield self.phaseless_mapred()
+        if not plm and (query is None or len(query) is 0):
+            raise Exception('Phase-less MapReduce is not supported '
+                            'by this Riak node')
+        job = {'inputs': inputs, 'query': query}
+        if timeout is not None:
+            job['timeout'] = timeout
+        content = self.encodeJson(job)
+
+        def receiver(response, finished):
+            ctype = response.headers.getRawHeaders('content-type', [''])[0]
+            return MapRedReceiver(finished, self._boundary(ctype), stream)
+
+        url = "/%s?chunked=true" % self.client._mapred_prefix
+        headers = {'Content-Type': 'application/json'}
+        headers, body = yield self.http_request('POST', url, headers, content,
+                                                receiver=receiver)
+        if headers['http_code'] != 200:
+            raise exceptions.RiakError(
+                'Error running MapReduce operation. Headers: %s Body: %s' %
+                (repr(headers), repr(body)))
+        stream.finish()
+
+    def _boundary(self, ctype):
+        """
+        the boundary of a multipart content type, None if it is not one
+        """
+        match = re.search(r'boundary="?([^";]+)"?', ctype)
+        if match and ctype.startswith('multipart/'):
+            return match.group(1)
+
     @defer.inlineCallbacks
     def get_index(self, bucket, index, startkey, endkey=None,bucket_type='default',
-            return_terms=False, max_results=None,continuation=None):
+            return_terms=False, max_results=None,continuation=None,
+            timeout=None):
         """
         Performs a secondary index query.
         """
         # TODO: use resource detection
         params = {'return_terms': return_terms, 'max_results': max_results,
-                  'continuation': continuation}
+                  'continuation': continuation,
+                  'timeout': self._milliseconds(timeout)}
         p = {}
         for k,v in params.iteritems():
             if isinstance(v,bool):
@@ -613,12 +1175,61 @@ class HTTPTransport(transport.FeatureDetection):
         uri = '/%s' % ('/'.join(segments))
         if p:
             uri="%s?%s" %(uri,urllib.urlencode(p))
-        headers, data = response = yield self.get_request(uri)
+        headers, data = response = yield self.get_request(uri,
+                                                          timeout=timeout)
         self.check_http_code(response, [200])
         jsonData = self.decodeJson(data)
         defer.returnValue(jsonData)
         #defer.returnValue(jsonData[u'keys'][:])
 
+    @defer.inlineCallbacks
+    def stream_index(self, bucket, index, startkey, stream, endkey=None,
+                     return_terms=False, max_results=None, continuation=None,
+                     bucket_type='default', timeout=None):
+        """
+        Secondary index query with stream=true, writing the keys (or
+        (term, key) pairs with return_terms) of every part of the response
+        to stream as it arrives. With max_results the query is paged like
+        PBCTransport.stream_index. All pages share the timeout.
+        """
+        deadline = time.time() + timeout if timeout else None
+        segments = ["types", bucket_type, "buckets", bucket, "index", index,
+                    str(startkey)]
+        if endkey:
+            segments.append(str(endkey))
+        prefix = '/'.join(segments)
+        while True:
+            budget = None
+            if deadline is not None:
+                budget = deadline - time.time()
+                if budget <= 0:
+                    raise exceptions.RequestTimeout('deadline exceeded')
+            params = {'stream': 'true',
+                      'return_terms': str(bool(return_terms)).lower(),
+                      'max_results': max_results,
+                      'continuation': continuation,
+                      'timeout': self._milliseconds(budget)}
+            url = self.build_rest_path(prefix=prefix, params=params)
+            page = []
+
+            def receiver(response, finished):
+                ctype = response.headers.getRawHeaders('content-type',
+                                                       [''])[0]
+                page.append(IndexReceiver(finished, self._boundary(ctype),
+                                          stream))
+                return page[0]
+
+            headers, body = yield self.http_request('GET', url,
+                                                    timeout=budget,
+                                                    receiver=receiver)
+            if headers['http_code'] != 200:
+                raise exceptions.RiakError(
+                    'Error querying index %s: %s' % (index, body))
+            continuation = page[0].continuation
+            if not continuation or stream.isStopped():
+                break
+        stream.finish()
+
     @defer.inlineCallbacks
     def create_search_schema(self, schema,content):
 #        if not (yield self.pb_search_admin()):
@@ -699,8 +1310,8 @@ class HTTPTransport(transport.FeatureDetection):
 
         Fetches the value of a Riak Datatype.
 
-        .. note:: This request is automatically retried :attr:`retries`
-           times if it fails due to network error.
+        .. note:: This request is retried if it fails due to a network
+           error, see the retry_policy of the client.
 
         :param r: the read quorum
         :type r: integer, string, None
@@ -886,13 +1497,34 @@ class HTTPTransport(transport.FeatureDetection):
 
         # If 300(Siblings), then return the list of siblings
         elif status == 300:
+            boundary = self._boundary(headers.get('content-type', ''))
+            if boundary is not None:
+                return self.parse_siblings(headers, data, boundary)
             # Parse and get rid of 'Siblings:' string in element 0
             siblings = data.strip().split('\n')
             siblings.pop(0)
             return siblings
 
-        # Parse the headers...
-        vclock = None
+        return headers.get('x-riak-vclock'), [(self.parse_metadata(headers),
+                                               data)]
+
+    def parse_siblings(self, headers, data, boundary):
+        """
+        the vclock and the (metadata, data) of every sibling in a
+        multipart/mixed 300 response, like a PBC get returns them
+        """
+        parser = MultipartParser(boundary)
+        parts = parser.feed(data)
+        parser.close()
+        return headers.get('x-riak-vclock'), [
+            (self.parse_metadata(part_headers), body)
+            for part_headers, body in parts]
+
+    def parse_metadata(self, headers):
+        """
+        the metadata of an object from the (lowercase) headers of a
+        response or of one part of a multipart response
+        """
         metadata = {MD_USERMETA: {}, MD_INDEX: []}
         links = []
         for header, value in headers.iteritems():
@@ -905,7 +1537,7 @@ class HTTPTransport(transport.FeatureDetection):
             elif header == 'etag':
                 metadata[MD_VTAG] = value
             elif header == 'link':
-                self.parse_links(links, headers['link'])
+                self.parse_links(links, value)
             elif header == 'last-modified':
                 metadata[MD_LASTMOD] = value
             elif header.startswith('x-riak-meta-'):
@@ -919,14 +1551,11 @@ class HTTPTransport(transport.FeatureDetection):
                     for token in line:
                         rie = RiakIndexEntry(field, token)
                         metadata[MD_INDEX].append(rie)
-            elif header == 'x-riak-vclock':
-                vclock = value
             elif header == 'x-riak-deleted':
                 metadata[MD_DELETED] = True
         if links:
             metadata[MD_LINKS] = links
-
-        return vclock, [(metadata, data)]
+        return metadata
 
     def to_link_header(self, link):
         """
@@ -978,10 +1607,10 @@ class HTTPTransport(transport.FeatureDetection):
 
         return headers
 
-    def get_request(self, uri=None, params=None):
+    def get_request(self, uri=None, params=None, timeout=None):
         url = self.build_rest_path(bucket=None, params=params, prefix=uri)
 
-        return self.http_request('GET', url)
+        return self.http_request('GET', url, timeout=timeout)
 
 
 
@@ -0,0 +1,265 @@
+"""
+Connection pool and request metrics of a PBCTransport.
+
+Every PBCTransport has a TransportMetrics instance as its metrics
+attribute. It counts connects, timeouts and failed acquires and keeps
+histograms of the time requests wait for a connection, of connect latency
+and of the latency of every operation, taken from the request traces of
+the connections (see pbc.tracing). Recording a value is a counter update
+and a bisect over a few bucket bounds, cheap enough to stay on.
+
+HTTPTransport has the same metrics (HTTPTransportMetrics), taken from its
+connection pool and its requests.
+
+    metrics = client.get_transport().metrics
+    metrics.asDict()['acquire_wait']['p99']
+"""
+
+from bisect import bisect_left
+
+from riakasaurus.transport import pbc
+
+
+class Histogram(object):
+    """
+    a distribution of durations in seconds, counted in fixed buckets
+
+    :ivar count: number of values
+    :ivar total: sum of all values
+    :ivar max: the largest value, None without one
+    """
+    # upper bounds of the buckets, values above the last bound go in an
+    # overflow bucket
+    BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+              0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        if self.count:
+            return self.total / self.count
+
+    def percentile(self, p):
+        """
+        upper bound of the bucket holding the p-th percentile (0-100),
+        the largest value if that is smaller. None without values.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank and seen:
+                return min(bound, self.max)
+        return self.max
+
+    def asDict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.mean(),
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': zip(self.BOUNDS + (None,), self.buckets),
+        }
+
+    def __repr__(self):
+        return '<Histogram count=%d mean=%s max=%s>' % (
+            self.count, self.mean(), self.max)
+
+
+# the operation the latency of a request is counted for, by message code
+OPERATIONS = {
+    pbc.MSG_CODE_GET_REQ: 'get',
+    pbc.MSG_CODE_PUT_REQ: 'put',
+    pbc.MSG_CODE_DEL_REQ: 'delete',
+    pbc.MSG_CODE_INDEX_REQ: 'index',
+    pbc.MSG_CODE_MAPRED_REQ: 'mapred',
+    pbc.MSG_CODE_DATATYPE_FETCH_REQ: 'datatype_fetch',
+    pbc.MSG_CODE_DATATYPE_UPDATE_REQ: 'datatype_update',
+    pbc.MSG_CODE_COUNTER_GET_REQ: 'counter_get',
+    pbc.MSG_CODE_COUNTER_UPDATE_REQ: 'counter_update',
+}
+
+
+class TransportMetrics(object):
+    """
+    the metrics of a PBCTransport, see the module documentation. The
+    connection counts are read from the pools when asked for, everything
+    else is counted since the transport was created or reset() was last
+    called.
+
+    :ivar acquireWait: Histogram of the seconds requests waited for a
+        connection, including connecting a new one
+    :ivar connectLatency: Histogram of the seconds connects took
+    :ivar connects: successful connects
+    :ivar connectFailures: failed connects
+    :ivar acquireFailures: requests that got no connection, because the
+        pool was exhausted or the deadline passed while waiting
+    :ivar timeouts: requests that timed out on a connection
+    :ivar failures: requests that failed on a connection, including
+        timeouts and error responses
+    :ivar retries: idempotent requests sent again after a network error,
+        see transport.retry
+    :ivar hedges: reads sent a second time, see PBCTransport.setHedging
+    :ivar hedgeWins: hedges answered before the read they hedged
+    :ivar operations: dict of operation name ('get', 'put', 'delete',
+        'index', 'mapred', 'datatype_fetch', 'datatype_update',
+        'counter_get', 'counter_update', 'other') to Histogram of the
+        request latency
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.reset()
+
+    def reset(self):
+        self.acquireWait = Histogram()
+        self.connectLatency = Histogram()
+        self.connects = 0
+        self.connectFailures = 0
+        self.acquireFailures = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedgeWins = 0
+        self.operations = {}
+
+    def openConnections(self):
+        """
+        connected transports to all nodes, idle or busy
+        """
+        return sum(1 for stp in self.transport._transports
+                   if stp.getTransport() is not None)
+
+    def idleConnections(self):
+        return sum(len(pool._idle) for pool in self.transport.cluster.nodes)
+
+    def activeConnections(self):
+        """
+        transports with requests in flight, including ones still
+        connecting
+        """
+        return sum(len(pool._active)
+                   for pool in self.transport.cluster.nodes)
+
+    def waiting(self):
+        """
+        requests waiting for a connection
+        """
+        return sum(len(pool._waiters)
+                   for pool in self.transport.cluster.nodes)
+
+    def concurrencyLimits(self):
+        """
+        dict of 'host:port' to the concurrency limit of the node, its
+        baseline latency and how often the limit went up and down
+        """
+        limits = {}
+        for pool in self.transport.cluster.nodes:
+            limit = pool.limiter.asDict()
+            limit['limit'] = pool.concurrencyLimit()
+            limits['%s:%s' % (pool.host, pool.port)] = limit
+        return limits
+
+    def maxConnections(self):
+        """
+        connections allowed to every node, None without a limit
+        """
+        return self.transport.MAX_TRANSPORTS
+
+    def requestTraced(self, trace):
+        """
+        tracer added to every connection of the transport
+        """
+        self.requestDone(OPERATIONS.get(trace.code, 'other'),
+                         trace.duration(), trace.timedOut,
+                         trace.failure is not None)
+
+    def requestDone(self, op, seconds, timedOut=False, failed=False):
+        """
+        a request of operation op took seconds
+        """
+        try:
+            histogram = self.operations[op]
+        except KeyError:
+            histogram = self.operations[op] = Histogram()
+        histogram.observe(seconds)
+        if timedOut:
+            self.timeouts += 1
+        if failed:
+            self.failures += 1
+
+    def asDict(self):
+        """
+        all metrics as plain dicts and numbers
+        """
+        return {
+            'open': self.openConnections(),
+            'idle': self.idleConnections(),
+            'active': self.activeConnections(),
+            'waiting': self.waiting(),
+            'max_transports': self.maxConnections(),
+            'concurrency_limits': self.concurrencyLimits(),
+            'acquire_wait': self.acquireWait.asDict(),
+            'acquire_failures': self.acquireFailures,
+            'connect_latency': self.connectLatency.asDict(),
+            'connects': self.connects,
+            'connect_failures': self.connectFailures,
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedgeWins,
+            'operations': dict((op, histogram.asDict())
+                               for op, histogram in self.operations.items()),
+        }
+
+
+class HTTPTransportMetrics(TransportMetrics):
+    """
+    the metrics of an HTTPTransport. Every request in flight holds a
+    connection, requests never wait for one: the pool opens a new
+    connection if no idle one is left and only limits how many are kept
+    open, to MAX_PERSISTENT per node (see HTTPTransport.setMaxPersistent).
+    """
+    def openConnections(self):
+        return self.idleConnections() + self.activeConnections()
+
+    def idleConnections(self):
+        return sum(len(connections) for connections in
+                   self.transport.pool._connections.values())
+
+    def activeConnections(self):
+        return sum(node.pending for node in self.transport.cluster.nodes)
+
+    def waiting(self):
+        return 0
+
+    def maxConnections(self):
+        return None
+
+    def concurrencyLimits(self):
+        return {}
+
+    def asDict(self):
+        stats = TransportMetrics.asDict(self)
+        stats['max_persistent'] = self.transport.pool.maxPersistentPerHost
+        return stats
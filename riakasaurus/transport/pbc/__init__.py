@@ -1,10 +1,11 @@
-from twisted.protocols.basic import Int32StringReceiver
 from twisted.internet.protocol import ClientFactory
 from twisted.internet.defer import Deferred
 from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
+from twisted.python import log
 
-from struct import pack, unpack
+from struct import pack
+from collections import deque
 
 from pprint import pformat
 
@@ -12,6 +13,9 @@ from pprint import pformat
 from riakasaurus.transport.pbc import riak_kv_pb2, riak_pb2,riak_search_pb2,riak_yokozuna_pb2,riak_dt_pb2
 from riakasaurus import exceptions
 import dt_codec
+import kv_codec
+from framing import FrameReceiver
+from tracing import RequestTrace
 
 ## Protocol codes
 MSG_CODE_ERROR_RESP = 0
@@ -132,7 +136,28 @@ def toHex(s):
     return reduce(lambda x, y: x + y, lst)
 
 
-class RiakPBC(Int32StringReceiver):
+class PendingRequest(object):
+    """
+    book keeping for a request sent on a RiakPBC connection that is still
+    waiting for its response. Riak answers requests in the order they were
+    sent, so a connection keeps these in a FIFO.
+    """
+    def __init__(self, code):
+        self.code = code
+        self.d = Deferred()
+        self.results = []
+        self.stream = None
+        self.continuation = None
+        self.timeoutd = None
+        # a RequestTrace, only if the connection has tracers
+        self.trace = None
+
+    def cancelTimeout(self):
+        if self.timeoutd and self.timeoutd.active():
+            self.timeoutd.cancel()
+
+
+class RiakPBC(FrameReceiver):
 
     MAX_LENGTH = 9999999
 
@@ -188,8 +213,23 @@ class RiakPBC(Int32StringReceiver):
         26: 'INDEX_RESP',
         27: 'SEARCH_QUERY_REQ',
         28: 'SEARCH_QUERY_RESP',
+        29: 'RESET_BUCKET_REQ',
+        30: 'RESET_BUCKET_RESP',
+        50: 'COUNTER_UPDATE_REQ',
+        51: 'COUNTER_UPDATE_RESP',
+        52: 'COUNTER_GET_REQ',
+        53: 'COUNTER_GET_RESP',
+        54: 'YOKOZUNA_INDEX_GET_REQ',
         55: 'MSG_CODE_YOKOZUNA_INDEX_GET_RESP',
+        56: 'YOKOZUNA_INDEX_PUT_REQ',
+        57: 'YOKOZUNA_INDEX_DELETE_REQ',
+        58: 'YOKOZUNA_SCHEMA_GET_REQ',
         59: 'MSG_CODE_YOKOZUNA_SCHEMA_GET_RESP',
+        60: 'YOKOZUNA_SCHEMA_PUT_REQ',
+        80: 'DATATYPE_FETCH_REQ',
+        81: 'DATATYPE_FETCH_RESP',
+        82: 'DATATYPE_UPDATE_REQ',
+        83: 'DATATYPE_UPDATE_RESP',
     }
 
     nonMessages = (
@@ -208,9 +248,21 @@ class RiakPBC(Int32StringReceiver):
     }
 
     timeout = None
-    timeoutd = None
     disconnected = False
+    # set once a request timed out, no new requests should be sent and the
+    # connection is closed as soon as the outstanding ones are answered
+    retired = False
     debug = 0
+    # callables getting a RequestTrace for every finished request, see
+    # addTracer()
+    tracers = ()
+
+    def __init__(self):
+        FrameReceiver.__init__(self)
+        # requests that have been sent but not (completely) answered yet
+        self._pending = deque()
+        # deferreds from notifyDisconnect()
+        self._disconnectNotifications = []
 
     # ------------------------------------------------------------------
     # Server Operations .. setClientId, getClientId, getServerInfo, ping
@@ -259,10 +311,16 @@ class RiakPBC(Int32StringReceiver):
 
         return self.__send(code, request)
 
-    def get_index(self, bucket, index, startkey, endkey=None,return_terms=False, max_results=None, continuation=None,bucket_type = 'default'):
+    def get_index(self, bucket, index, startkey, endkey=None,return_terms=False, max_results=None, continuation=None,bucket_type = 'default', stream=None, timeout=None):
+        """
+        secondary index query, if stream is given every RpbIndexResp
+        carrying results is written to it as it arrives and the deferred
+        fires with the continuation of the page (or None)
+
+        timeout (in seconds) is also passed on to Riak
+        """
         code = pack('B', MSG_CODE_INDEX_REQ)
         req = RpbIndexReq(bucket=bucket, index=index,type=bucket_type)
-        self.__indexResultList = []
         if endkey:
             req.qtype = RpbIndexReq.range
             req.range_min = str(startkey)
@@ -276,9 +334,9 @@ class RiakPBC(Int32StringReceiver):
         if continuation:
             req.continuation = continuation
         req.stream = True
-        d = self.__send(code, req)
-        d.addCallback(lambda resp: resp)
-        return d
+        if timeout:
+            req.timeout = kv_codec.milliseconds(timeout)
+        return self.__send(code, req, stream, timeout)
 
     def create_search_index(self, index, schema=None, n_val=None):
         code = pack('B', MSG_CODE_YOKOZUNA_INDEX_PUT_REQ)
@@ -370,8 +428,8 @@ class RiakPBC(Int32StringReceiver):
 
         Fetches the value of a Riak Datatype.
 
-        .. note:: This request is automatically retried :attr:`retries`
-           times if it fails due to network error.
+        .. note:: This request is retried if it fails due to a network
+           error, see the retry_policy of the client.
 
         :param r: the read quorum
         :type r: integer, string, None
@@ -548,15 +606,22 @@ class RiakPBC(Int32StringReceiver):
                 request.fl.append(str(f))
         return self.__send(code, request)
 
-    def mapred(self, request,content_type='application/json'):
-        self.__mapredList = []
+    def mapred(self, request,content_type='application/json', stream=None,
+               timeout=None):
+        """
+        run a mapreduce job, if stream is given every RpbMapRedResp
+        carrying results is written to it as soon as it arrives
+
+        timeout (in seconds) only applies to the response, the timeout of
+        the job is part of request
+        """
         if content_type != 'application/json':
             raise Exception("Only json request is implemented")
         code = pack('B', MSG_CODE_MAPRED_REQ)
         req = RpbMapRedReq()
         req.request=request
         req.content_type=content_type
-        return self.__send(code, req)
+        return self.__send(code, req, stream, timeout)
 
 
 
@@ -564,28 +629,54 @@ class RiakPBC(Int32StringReceiver):
     # ------------------------------------------------------------------
     # Bucket Operations .. getKeys, getBuckets, get/set Bucket properties
     # ------------------------------------------------------------------
-    def getKeys(self, bucket,bucket_type = 'default'):
+    def getKeys(self, bucket,bucket_type = 'default', timeout=None):
         """
         operates different than the other messages, as it returns more than
-        one respone .. see stringReceived() for handling
+        one respone .. see frameReceived() for handling
         """
         code = pack('B', MSG_CODE_LIST_KEYS_REQ)
         request = RpbListKeysReq()
         request.bucket = bucket
         request.type = bucket_type
-        self.__keyList = []
-        return self.__send(code, request)
+        if timeout:
+            request.timeout = kv_codec.milliseconds(timeout)
+        return self.__send(code, request, timeout=timeout)
+
+    def streamKeys(self, bucket, stream, bucket_type='default', timeout=None):
+        """
+        like getKeys, but every RpbListKeysResp is written to stream as it
+        arrives instead of collecting all keys. The stream may pause this
+        connection while its consumer falls behind.
+        """
+        code = pack('B', MSG_CODE_LIST_KEYS_REQ)
+        request = RpbListKeysReq()
+        request.bucket = bucket
+        request.type = bucket_type
+        if timeout:
+            request.timeout = kv_codec.milliseconds(timeout)
+        return self.__send(code, request, stream, timeout)
 
     def getBuckets(self,bucket_type = 'default'):
         """
         operates different than the other messages, as it returns more than
-        one respone .. see stringReceived() for handling
+        one respone .. see frameReceived() for handling
         """
         code = pack('B', MSG_CODE_LIST_BUCKETS_REQ)
         req = RpbListBucketsReq()
         req.type = bucket_type
         return self.__send(code,req)
 
+    def streamBuckets(self, stream, bucket_type='default'):
+        """
+        like getBuckets, but Riak streams the buckets and every
+        RpbListBucketsResp is written to stream as it arrives
+        """
+        code = pack('B', MSG_CODE_LIST_BUCKETS_REQ)
+        req = RpbListBucketsReq()
+        req.type = bucket_type
+        req.stream = True
+        return self.__send(code, req, stream)
+
     def getBucketProperties(self, bucket,bucket_type = 'default'):
         code = pack('B', MSG_CODE_GET_BUCKET_REQ)
         request = RpbGetBucketReq()
@@ -620,13 +711,52 @@ class RiakPBC(Int32StringReceiver):
 
     def connectionLost(self, reason):
         self.disconnected = True
+        notifications, self._disconnectNotifications = \
+            self._disconnectNotifications, []
+        for d in notifications:
+            d.callback(None)
+        # nothing will answer the outstanding requests anymore
+        while self._pending:
+            self._finishRequest(failure=reason)
 
     def setTimeout(self, t):
         self.timeout = t
 
-    def __send(self, code, request=None):
+    def addTracer(self, tracer):
+        """
+        call tracer with a RequestTrace for every request finished on this
+        connection, see tracing
+        """
+        self.tracers = self.tracers + (tracer,)
+
+    def removeTracer(self, tracer):
+        self.tracers = tuple(t for t in self.tracers if t != tracer)
+
+    def pendingCount(self):
+        """
+        number of requests sent on this connection still waiting for
+        their response
+        """
+        return len(self._pending)
+
+    def isStreaming(self):
+        """
+        whether a streamed response is pending, its stream may pause the
+        connection until the consumer catches up
+        """
+        return any(p.stream is not None for p in self._pending)
+
+    def __send(self, code, request=None, stream=None, timeout=None):
         """
         helper method for logging, sending and returning the deferred
+
+        requests are pipelined, the deferred of every request is queued
+        and fired in order as the responses come back.
+
+        if a stream is given, the chunks of a multi message response are
+        written to it as they arrive and the deferred fires with the
+        continuation (if any) once the response is complete. Finishing the
+        stream is left to the caller, it may span several requests.
         """
         if self.debug:
             print "[%s] %s %s" % (
@@ -635,47 +765,153 @@ class RiakPBC(Int32StringReceiver):
                 str(request).replace('\n', ' ')
             )
         if request:
-            msg = code + request.SerializeToString()
+            body = request.SerializeToString()
         else:
-            msg = code
-        self.sendString(msg)
-        self.factory.d = Deferred()
-        if self.timeout:
-            self.timeoutd = reactor.callLater(self.timeout,
-                                              self._triggerTimeout)
-
-        return self.factory.d
+            body = ''
+        return self.sendRequest(ord(code), body, stream, timeout)
 
-    def _triggerTimeout(self):
-        if not self.factory.d.called:
+    def sendRequest(self, code, body='', stream=None, timeout=None):
+        """
+        send an already encoded request, see kv_codec
+
+        :param code: the message code
+        :type code: int
+        :param body: the serialized request message
+        :type body: str
+        :param timeout: seconds to wait for the response, defaults to the
+            timeout of the connection
+        :type timeout: float
+        """
+        pending = PendingRequest(code)
+        if stream is not None:
+            pending.stream = stream
+            stream.registerProducer(self)
+        self._pending.append(pending)
+        self.sendFrame(code, body)
+        if self.tracers:
+            pending.trace = RequestTrace(
+                code, self.PBMessageTypes.get(code, str(code)),
+                len(body) + 5, reactor.seconds())
+        timeout = timeout or self.timeout
+        if timeout:
+            pending.timeoutd = reactor.callLater(timeout,
+                                                 self._triggerTimeout,
+                                                 pending)
+
+        return pending.d
+
+    def _triggerTimeout(self, pending):
+        # the request stays queued, its response (if it ever arrives)
+        # still has to be consumed to keep the pipeline in order. The
+        # connection is retired, whatever held up the request may hold up
+        # the next one too.
+        self.retired = True
+        if pending.trace is not None:
+            pending.trace.timedOut = True
+        if not pending.d.called:
             try:
-                self.factory.d.errback(exceptions.RequestTimeout('timeout'))
+                pending.d.errback(exceptions.RequestTimeout('timeout'))
             except Exception, e:
                 print "Unable to handle Timeout: %s" % e
+        self._closeIfRetired()
+
+    def retire(self):
+        """
+        send no new requests, close the connection once the outstanding
+        ones are answered
+        """
+        self.retired = True
+        self._closeIfRetired()
+
+    def _closeIfRetired(self):
+        """
+        close a retired connection once only timed out requests are left
+        """
+        if (self.retired and not self.disconnected and
+                all(p.d.called for p in self._pending)):
+            self.transport.loseConnection()
+
+    def _finishRequest(self, result=None, failure=None):
+        """
+        pop the request at the head of the pipeline and fire its deferred
+        """
+        pending = self._pending.popleft()
+        pending.cancelTimeout()
+        if pending.stream is not None:
+            result = pending.continuation
+        if pending.trace is not None:
+            # stamped before the callbacks of the caller run, their time is
+            # not the latency of Riak
+            pending.trace.finished = reactor.seconds()
+            pending.trace.failure = failure
+        if not pending.d.called:
+            if failure is not None:
+                pending.d.errback(failure)
+            else:
+                pending.d.callback(result)
+        if pending.trace is not None:
+            self._reportTrace(pending.trace)
+        if self.retired:
+            self._closeIfRetired()
+
+    def _reportTrace(self, trace):
+        for tracer in self.tracers:
+            try:
+                tracer(trace)
+            except Exception:
+                log.err(None, 'tracer %r failed' % (tracer,))
+
+    def lengthLimitExceeded(self, length):
+        if self._pending:
+            self._finishRequest(failure=Failure(exceptions.RiakPBCException(
+                'response of %d bytes exceeds the maximum frame size of %d'
+                % (length, self.MAX_LENGTH))))
+        FrameReceiver.lengthLimitExceeded(self, length)
+
+    def spooledFrameReceived(self, code, body, length):
+        """
+        a response above the spool threshold, get responses are decoded
+        leaving the values in the spool, see kv_codec.decode_spooled_get
+        """
+        if code != MSG_CODE_GET_RESP or not self._pending:
+            return FrameReceiver.spooledFrameReceived(self, code, body, length)
+        pending = self._pending[0]
+        if pending.trace is not None:
+            pending.trace.frameReceived(length + 5, reactor.seconds())
+        try:
+            response = kv_codec.decode_spooled_get(body, length)
+        except Exception:
+            self._finishRequest(failure=Failure())
+        else:
+            self._finishRequest(response)
 
-    def stringReceived(self, data):
+    def frameReceived(self, code, data):
         """
-        messages contain as first byte a message type code that is used
+        messages contain a message type code that is used
         to map to the correct message type in self.riakResponses
 
         messages that dont have a body to parse return True, those are
         listed in self.nonMessages
+
+        responses always belong to the oldest pending request
         """
-        if self.timeoutd and self.timeoutd.active():
-            self.timeoutd.cancel()  # stop timeout from beeing raised
+        if not self._pending:
+            raise exceptions.RiakPBCException(
+                'received a response without a pending request')
+
+        # the timeout is only cancelled once the response is complete, a
+        # streamed response that stalls after some chunks still times out
+        pending = self._pending[0]
+        if pending.trace is not None:
+            pending.trace.frameReceived(len(data) + 5, reactor.seconds())
 
         def returnOrRaiseException(msg):
             exc = exceptions.RiakPBCException(msg)
-            if self.factory.d.called:
-                raise exc
-            else:
-                self.factory.d.errback(Failure(exc))
+            self._finishRequest(failure=Failure(exc))
 
-        # decode messagetype
-        code = unpack('B', data[:1])[0]
         if self.debug:
-            print "[%s] stringReceived code %s" % (self.__class__.__name__,
-                self.PBMessageTypes[code])
+            print "[%s] frameReceived code %s" % (self.__class__.__name__,
+                self.PBMessageTypes.get(code, code))
 
         if code not in self.riakResponses and code not in self.nonMessages:
             returnOrRaiseException('unknown messagetype: %d' % code)
@@ -683,25 +919,24 @@ class RiakPBC(Int32StringReceiver):
         elif code in self.nonMessages:
             # for instance ping doesnt have a message, so we just return True
             if self.debug:
-                print "[%s] stringReceived empty message type %s" % (
+                print "[%s] frameReceived empty message type %s" % (
                     self.__class__.__name__, self.PBMessageTypes[code])
-            if not self.factory.d.called:
-                self.factory.d.callback(True)
+            self._finishRequest(True)
             return
         elif code == MSG_CODE_ERROR_RESP:
             response = self.riakResponses[code]()
-            response.ParseFromString(data[1:])
+            response.ParseFromString(data)
             returnOrRaiseException('%s (%d)' % (
                 response.errmsg, response.errcode)
             )
         elif code == MSG_CODE_MAPRED_RESP:
-            # listKeys is special as it returns multiple response messages
-            # each message can contain multiple keys
+            # mapred is special as it returns multiple response messages
+            # each message contains the results of one phase
             # the last message contains a optional field "done"
             # so collect all the messages until the last one, then call the
             # callback
             response = RpbMapRedResp()
-            response.ParseFromString(data[1:])
+            response.ParseFromString(data)
             if self.debug:
                 print "[%s] %s %s" % (
                         self.__class__.__name__,
@@ -709,15 +944,17 @@ class RiakPBC(Int32StringReceiver):
                         str(response).replace('\n', ' ')
                     )
 
-            self.__mapredList.append(response)
+            if pending.stream is not None:
+                if response.HasField('response'):
+                    pending.stream.write(response)
+            else:
+                pending.results.append(response)
             if response.HasField('done') and response.done:
-                if not self.factory.d.called:
-                    self.factory.d.callback(self.__mapredList)
-                    self.__mapredList = []
+                self._finishRequest(pending.results)
 
         elif code == MSG_CODE_INDEX_RESP:
             response = RpbIndexResp()
-            response.ParseFromString(data[1:])
+            response.ParseFromString(data)
             if self.debug:
                 print "[%s] %s %s" % (
                         self.__class__.__name__,
@@ -725,12 +962,15 @@ class RiakPBC(Int32StringReceiver):
                         str(response).replace('\n', ' ')
                     )
 
-            self.__indexResultList.append(response)
+            if pending.stream is not None:
+                if response.HasField('continuation'):
+                    pending.continuation = response.continuation
+                if len(response.keys) or len(response.results):
+                    pending.stream.write(response)
+            else:
+                pending.results.append(response)
             if response.HasField('done') and response.done:
-                if not self.factory.d.called:
-                    self.factory.d.callback(self.__indexResultList)
-                    self.__indexResultList = []
-
+                self._finishRequest(pending.results)
 
         elif code == MSG_CODE_LIST_KEYS_RESP:
             # listKeys is special as it returns multiple response messages
@@ -739,7 +979,7 @@ class RiakPBC(Int32StringReceiver):
             # so collect all the messages until the last one, then call the
             # callback
             response = RpbListKeysResp()
-            response.ParseFromString(data[1:])
+            response.ParseFromString(data)
             if self.debug:
                 print "[%s] %s %s" % (
                         self.__class__.__name__,
@@ -747,26 +987,36 @@ class RiakPBC(Int32StringReceiver):
                         str(response).replace('\n', ' ')
                     )
 
-            self.__keyList.extend([x for x in response.keys])
+            if pending.stream is not None:
+                if len(response.keys):
+                    pending.stream.write([x for x in response.keys])
+            else:
+                pending.results.extend([x for x in response.keys])
+            if response.HasField('done') and response.done:
+                self._finishRequest(pending.results)
+
+        elif code == MSG_CODE_LIST_BUCKETS_RESP and pending.stream is not None:
+            # a streamed bucket listing, one message per chunk until done
+            response = RpbListBucketsResp()
+            response.ParseFromString(data)
+            if len(response.buckets):
+                pending.stream.write([x for x in response.buckets])
             if response.HasField('done') and response.done:
-                if not self.factory.d.called:
-                    self.factory.d.callback(self.__keyList)
-                    self.__keyList = []
+                self._finishRequest(None)
         else:
             # normal handling, pick the message code, call ParseFromString()
             # on it, and return the message
             response = self.riakResponses[code]()
-            if len(data) > 1:
+            if data:
                 # if there's data, parse it, otherwise return empty object
-                response.ParseFromString(data[1:])
+                response.ParseFromString(data)
                 if self.debug:
                     print "[%s] %s %s" % (
                         self.__class__.__name__,
                         response.__class__.__name__,
                         str(response).replace('\n', ' ')
                     )
-            if not self.factory.d.called:
-                self.factory.d.callback(response)
+            self._finishRequest(response)
 
     def _resolveNums(self, val):
         if isinstance(val, str):
@@ -781,6 +1031,23 @@ class RiakPBC(Int32StringReceiver):
     def isDisconnected(self):
         return self.disconnected
 
+    def notifyDisconnect(self):
+        """
+        a deferred firing once the connection is lost
+        """
+        d = Deferred()
+        if self.disconnected:
+            d.callback(None)
+        else:
+            self._disconnectNotifications.append(d)
+        return d
+
+    def isRetired(self):
+        """
+        whether this connection must not be used for new requests
+        """
+        return self.retired or self.disconnected
+
     @defer.inlineCallbacks
     def quit(self):
         yield self.transport.loseConnection()
@@ -791,7 +1058,6 @@ class RiakPBCClientFactory(ClientFactory):
     noisy = False
 
     def __init__(self):
-        self.d = Deferred()
         self.connected = Deferred()
 
     def clientConnectionFailed(self, connector, reason):
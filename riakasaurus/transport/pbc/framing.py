@@ -0,0 +1,204 @@
+"""
+Framing for the Riak protocol buffers protocol.
+
+Every message is a 4 byte big endian length, followed by a 1 byte message
+code and the encoded message. Int32StringReceiver concatenates its whole
+unprocessed buffer with every chunk received and slices each frame out of
+it, which copies a large value over and over while it trickles in. The
+FrameReceiver appends incoming data to a single growable bytearray and
+copies each large message body exactly once, when it is handed to the
+protocol. Consumed frames are only dropped from the front of the buffer
+once they add up to COMPACT_AFTER bytes, or once the buffer is used up.
+
+Frames larger than the spool threshold are not buffered at all, their
+body is written to a SpooledTemporaryFile as it arrives and handed over
+as a file.
+"""
+
+from struct import Struct, pack
+from tempfile import SpooledTemporaryFile
+
+from twisted.internet import protocol
+
+_length = Struct('>I')
+
+
+class FrameReceiver(protocol.Protocol):
+    """
+    Protocol receiving length prefixed (code, body) frames.
+
+    Subclasses implement frameReceived(code, body). MAX_LENGTH is the
+    largest frame accepted, it can be changed per connection with
+    setMaxFrameSize(). Frames above it are passed to lengthLimitExceeded().
+
+    If a spool threshold is set with setSpoolThreshold(), bodies above it
+    are spooled and passed to spooledFrameReceived(code, body, length)
+    instead. Up to SPOOL_MEMORY bytes of a spooled body are kept in memory
+    before it rolls over to disk.
+    """
+    MAX_LENGTH = 99999999
+    SPOOL_MEMORY = 1024 * 1024
+    # bodies up to this size are sliced out of the buffer, that is faster
+    # for small ones than going through a memoryview
+    SLICE_MAX = 4096
+    # consumed bytes kept at the front of the buffer before it is compacted
+    COMPACT_AFTER = 64 * 1024
+
+    spoolThreshold = None
+    paused = False
+    _processing = False
+
+    def __init__(self):
+        # _offset is always at a frame boundary, or after the body of the
+        # frame being spooled
+        self._buffer = bytearray()
+        self._offset = 0
+        # (code, remaining, file) of the frame being spooled
+        self._spool = None
+        # spooled frames waiting for delivery while paused
+        self._spooled = []
+
+    def setMaxFrameSize(self, size):
+        self.MAX_LENGTH = size
+
+    def setSpoolThreshold(self, size):
+        """
+        spool bodies larger than size bytes to a temporary file, None
+        disables spooling
+        """
+        self.spoolThreshold = size
+
+    def frameReceived(self, code, body):
+        """
+        Override this to handle a complete frame.
+
+        :param code: the message code
+        :type code: int
+        :param body: the encoded message, without length prefix and code
+        :type body: str
+        """
+        raise NotImplementedError
+
+    def spooledFrameReceived(self, code, body, length):
+        """
+        Called instead of frameReceived() for a spooled frame, body is a
+        file positioned at the start of the message. The default reads it
+        back and calls frameReceived().
+        """
+        self.frameReceived(code, body.read())
+
+    def lengthLimitExceeded(self, length):
+        """
+        Called when a frame larger than MAX_LENGTH is announced, the
+        default is to drop the connection.
+        """
+        self.transport.loseConnection()
+
+    def sendFrame(self, code, body=''):
+        """
+        send a single message, the length prefix and the message code are
+        written separately so the body is not copied.
+        """
+        self.transport.writeSequence(
+            [pack('>IB', len(body) + 1, code), body])
+
+    def dataReceived(self, data):
+        if self._spool is not None:
+            data = self._spoolData(data)
+        self._buffer.extend(data)
+        self._processFrames()
+
+    def _spoolData(self, data):
+        """
+        write data to the frame being spooled, return what is left over
+        """
+        code, length, body = self._spool
+        remaining = length - body.tell()
+        if len(data) < remaining:
+            body.write(data)
+            return ''
+        body.write(data[:remaining])
+        self._spool = None
+        body.seek(0)
+        self._spooled.append((code, body, length))
+        return data[remaining:]
+
+    def _processFrames(self):
+        if self._processing:
+            # re-entered from a frameReceived callback, e.g. through
+            # resumeProducing(), the outer loop will pick up the rest
+            return
+        self._processing = True
+        buf = self._buffer
+        offset = self._offset
+        # looked up once, small frames are dominated by the per frame
+        # overhead. Frames above spoolLength are spooled or too large.
+        unpackLength = _length.unpack_from
+        frameReceived = self.frameReceived
+        sliceMax = self.SLICE_MAX
+        maxLength = spoolLength = self.MAX_LENGTH
+        if self.spoolThreshold is not None:
+            spoolLength = min(self.spoolThreshold + 1, maxLength)
+        try:
+            while not self.paused:
+                if self._spooled:
+                    self.spooledFrameReceived(*self._spooled.pop(0))
+                    continue
+                available = len(buf) - offset
+                if available < 5:
+                    break
+                length = unpackLength(buf, offset)[0]
+                if length > spoolLength or length < 1:
+                    if length > maxLength or length < 1:
+                        self._buffer = buf = bytearray()
+                        offset = 0
+                        self.lengthLimitExceeded(length)
+                        return
+                    # move what is there of the body to the spool, the
+                    # rest is written to it as it arrives
+                    self._spool = (buf[offset + 4], length - 1,
+                                   SpooledTemporaryFile(self.SPOOL_MEMORY))
+                    end = min(len(buf), offset + 4 + length)
+                    self._spoolData(buf[offset + 5:end])
+                    offset = end
+                    continue
+                if available < length + 4:
+                    break
+                code = buf[offset + 4]
+                start = offset + 5
+                offset += 4 + length
+                if length > sliceMax:
+                    body = memoryview(buf)[start:offset].tobytes()
+                else:
+                    body = bytes(buf[start:offset])
+                frameReceived(code, body)
+        finally:
+            if offset == len(buf):
+                # all consumed, nothing to move
+                del buf[:]
+                offset = 0
+            elif offset > self.COMPACT_AFTER:
+                # drop consumed frames, only a partial frame is moved
+                del buf[:offset]
+                offset = 0
+            self._offset = offset
+            self._processing = False
+
+    def pauseProducing(self):
+        """
+        stop delivering frames and reading from the socket
+        """
+        self.paused = True
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """
+        deliver buffered frames and continue reading from the socket
+        """
+        self.paused = False
+        self.transport.resumeProducing()
+        self._processFrames()
+
+    def stopProducing(self):
+        self.paused = True
+        self.transport.stopProducing()
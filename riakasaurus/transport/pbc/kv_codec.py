@@ -0,0 +1,402 @@
+"""
+Encoders for the hot key/value requests.
+
+RpbGetReq, RpbPutReq and RpbDelReq are written straight to their wire
+format from a RiakObject, instead of filling in the generated protobuf
+classes attribute by attribute. Field tags and the special quorum values
+are computed once at import time.
+
+RpbGetResp messages spooled to a file by the frame receiver are decoded
+without loading the values, every value is exposed as a file-like
+SpooledValue reading its range of the spool file.
+"""
+from riakasaurus import exceptions
+from riakasaurus.transport.pbc import riak_kv_pb2
+
+
+def encode_varint(value):
+    if value < 128:
+        return _SMALL_VARINTS[value]
+    out = []
+    while value > 127:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+_SMALL_VARINTS = tuple(chr(i) for i in xrange(128))
+
+
+def _tag(field, wire_type):
+    return encode_varint((field << 3) | wire_type)
+
+_VARINT = 0
+_BYTES = 2
+
+_TRUE = '\x01'
+_FALSE = '\x00'
+
+# symbolic quorum values, as understood by Riak, pre-encoded
+_QUORUMS = {}
+for _name, _value in (('one', 4294967295 - 1),
+                      ('quorum', 4294967295 - 2),
+                      ('all', 4294967295 - 3),
+                      ('default', 4294967295 - 4)):
+    for _variant in (_name, _name.upper(), _name.capitalize()):
+        _QUORUMS[_variant] = encode_varint(_value)
+        _QUORUMS[unicode(_variant)] = _QUORUMS[_variant]
+
+
+def encode_quorum(value):
+    """
+    encode a quorum value, either an integer or one of 'one', 'quorum',
+    'all' and 'default'
+    """
+    try:
+        return _QUORUMS[value]
+    except (KeyError, TypeError):
+        pass
+    if isinstance(value, basestring):
+        try:
+            return _QUORUMS[value.lower()]
+        except KeyError:
+            raise exceptions.RiakPBCException('invalid value %s' % (value))
+    return encode_varint(int(value))
+
+
+def milliseconds(timeout):
+    """
+    a timeout in seconds as the milliseconds Riak expects, at least 1
+    """
+    return max(1, int(timeout * 1000))
+
+
+def _timeout_field(tag, timeout):
+    if not timeout:
+        return ''
+    return tag + encode_varint(milliseconds(timeout))
+
+
+def _bytes_field(tag, value):
+    if value.__class__ is unicode:
+        value = value.encode('utf-8')
+    return tag + encode_varint(len(value)) + value
+
+
+def _quorum_field(tag, value):
+    if value is None:
+        return ''
+    return tag + encode_quorum(value)
+
+
+def _bool_field(tag, value):
+    if value is None:
+        return ''
+    return tag + (_TRUE if value else _FALSE)
+
+
+def _message_field(tag, message):
+    return tag + encode_varint(len(message)) + message
+
+
+# RpbGetReq
+GET_BUCKET = _tag(1, _BYTES)
+GET_KEY = _tag(2, _BYTES)
+GET_R = _tag(3, _VARINT)
+GET_PR = _tag(4, _VARINT)
+GET_BASIC_QUORUM = _tag(5, _VARINT)
+GET_NOTFOUND_OK = _tag(6, _VARINT)
+GET_IF_MODIFIED = _tag(7, _BYTES)
+GET_HEAD = _tag(8, _VARINT)
+GET_DELETEDVCLOCK = _tag(9, _VARINT)
+GET_TIMEOUT = _tag(10, _VARINT)
+GET_TYPE = _tag(13, _BYTES)
+
+# RpbPutReq
+PUT_BUCKET = _tag(1, _BYTES)
+PUT_KEY = _tag(2, _BYTES)
+PUT_VCLOCK = _tag(3, _BYTES)
+PUT_CONTENT = _tag(4, _BYTES)
+PUT_W = _tag(5, _VARINT)
+PUT_DW = _tag(6, _VARINT)
+PUT_RETURN_BODY = _tag(7, _VARINT)
+PUT_PW = _tag(8, _VARINT)
+PUT_IF_NONE_MATCH = _tag(10, _VARINT)
+PUT_RETURN_HEAD = _tag(11, _VARINT)
+PUT_TIMEOUT = _tag(12, _VARINT)
+PUT_TYPE = _tag(16, _BYTES)
+
+# RpbDelReq
+DEL_BUCKET = _tag(1, _BYTES)
+DEL_KEY = _tag(2, _BYTES)
+DEL_RW = _tag(3, _VARINT)
+DEL_VCLOCK = _tag(4, _BYTES)
+DEL_R = _tag(5, _VARINT)
+DEL_W = _tag(6, _VARINT)
+DEL_PR = _tag(7, _VARINT)
+DEL_PW = _tag(8, _VARINT)
+DEL_DW = _tag(9, _VARINT)
+DEL_TIMEOUT = _tag(10, _VARINT)
+DEL_TYPE = _tag(13, _BYTES)
+
+# RpbContent, RpbLink, RpbPair
+CONTENT_VALUE = _tag(1, _BYTES)
+CONTENT_CONTENT_TYPE = _tag(2, _BYTES)
+CONTENT_LINKS = _tag(6, _BYTES)
+CONTENT_USERMETA = _tag(9, _BYTES)
+CONTENT_INDEXES = _tag(10, _BYTES)
+LINK_BUCKET = _tag(1, _BYTES)
+LINK_KEY = _tag(2, _BYTES)
+LINK_TAG = _tag(3, _BYTES)
+PAIR_KEY = _tag(1, _BYTES)
+PAIR_VALUE = _tag(2, _BYTES)
+
+
+def encode_get(bucket, key, bucket_type='default', r=None, pr=None,
+               basic_quorum=None, notfound_ok=None, if_modified=None,
+               head=None, deletedvclock=None, timeout=None):
+    """
+    serialized RpbGetReq, timeout is in seconds
+    """
+    parts = [_bytes_field(GET_BUCKET, bucket),
+             _bytes_field(GET_KEY, key),
+             _quorum_field(GET_R, r),
+             _quorum_field(GET_PR, pr),
+             _bool_field(GET_BASIC_QUORUM, basic_quorum),
+             _bool_field(GET_NOTFOUND_OK, notfound_ok),
+             _bool_field(GET_HEAD, head),
+             _bool_field(GET_DELETEDVCLOCK, deletedvclock),
+             _timeout_field(GET_TIMEOUT, timeout),
+             _bytes_field(GET_TYPE, bucket_type)]
+    if if_modified is not None:
+        parts.append(_bytes_field(GET_IF_MODIFIED, if_modified))
+    return ''.join(parts)
+
+
+def encode_content(robj):
+    """
+    RpbContent of a RiakObject, as a list of byte strings. The value is
+    kept as a separate item so it is only copied into the final request.
+    """
+    value = robj.get_encoded_data()
+    if hasattr(value, 'read'):
+        # a spooled or file-like value, it has to be sent in one frame
+        value.seek(0)
+        value = value.read()
+    if value.__class__ is unicode:
+        value = value.encode('utf-8')
+    parts = [_bytes_field(CONTENT_CONTENT_TYPE, robj.get_content_type())]
+
+    for l in robj.get_links():
+        parts.append(_message_field(CONTENT_LINKS,
+                                    _bytes_field(LINK_BUCKET, l.get_bucket()) +
+                                    _bytes_field(LINK_KEY, l.get_key()) +
+                                    _bytes_field(LINK_TAG, l.get_tag())))
+
+    for key, meta in robj.get_usermeta().iteritems():
+        parts.append(_message_field(CONTENT_USERMETA,
+                                    _bytes_field(PAIR_KEY, key) +
+                                    _bytes_field(PAIR_VALUE, meta)))
+
+    for index in robj.get_indexes():
+        parts.append(_message_field(CONTENT_INDEXES,
+                                    _bytes_field(PAIR_KEY, index.get_field()) +
+                                    _bytes_field(PAIR_VALUE, index.get_value())))
+    return [CONTENT_VALUE, encode_varint(len(value)), value, ''.join(parts)]
+
+
+def encode_put(robj, w=None, dw=None, pw=None, return_body=None,
+               if_none_match=None, return_head=None, timeout=None):
+    """
+    serialized RpbPutReq storing a RiakObject, timeout is in seconds
+    """
+    bucket = robj.get_bucket()
+    content = encode_content(robj)
+    parts = [_bytes_field(PUT_BUCKET, bucket.name)]
+    key = robj.get_key()
+    if key is not None:
+        parts.append(_bytes_field(PUT_KEY, key))
+    vclock = robj.vclock()
+    if vclock:
+        parts.append(_bytes_field(PUT_VCLOCK, vclock))
+    parts.append(PUT_CONTENT)
+    parts.append(encode_varint(sum(len(x) for x in content)))
+    parts.extend(content)
+    parts.append(_quorum_field(PUT_W, w) +
+                 _quorum_field(PUT_DW, dw) +
+                 _bool_field(PUT_RETURN_BODY, return_body) +
+                 _quorum_field(PUT_PW, pw) +
+                 _bool_field(PUT_IF_NONE_MATCH, if_none_match) +
+                 _bool_field(PUT_RETURN_HEAD, return_head) +
+                 _timeout_field(PUT_TIMEOUT, timeout) +
+                 _bytes_field(PUT_TYPE, bucket.bucket_type))
+    return ''.join(parts)
+
+
+def encode_delete(bucket, key, bucket_type='default', vclock=None, rw=None,
+                  r=None, w=None, dw=None, pr=None, pw=None, timeout=None):
+    """
+    serialized RpbDelReq, timeout is in seconds
+    """
+    parts = [_bytes_field(DEL_BUCKET, bucket),
+             _bytes_field(DEL_KEY, key),
+             _quorum_field(DEL_RW, rw),
+             _quorum_field(DEL_R, r),
+             _quorum_field(DEL_W, w),
+             _quorum_field(DEL_PR, pr),
+             _quorum_field(DEL_PW, pw),
+             _quorum_field(DEL_DW, dw),
+             _timeout_field(DEL_TIMEOUT, timeout),
+             _bytes_field(DEL_TYPE, bucket_type)]
+    if vclock:
+        parts.append(_bytes_field(DEL_VCLOCK, vclock))
+    return ''.join(parts)
+
+
+# field keys of a spooled RpbGetResp, all single byte
+GET_RESP_CONTENT = ord(_tag(1, _BYTES))
+CONTENT_VALUE_KEY = ord(CONTENT_VALUE)
+
+
+class SpooledValue(object):
+    """
+    Read only file-like view of a value inside a spooled response. The
+    values of all siblings share the spool, it is closed with the last of
+    them (see SpooledGetResp).
+    """
+    def __init__(self, spool, start, length):
+        self._spool = spool
+        self._start = start
+        self._length = length
+        self._pos = 0
+        # the SpooledGetResp owning the spool
+        self._owner = None
+        self.closed = False
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size < 0 or size > self._length - self._pos:
+            size = self._length - self._pos
+        self._spool.seek(self._start + self._pos)
+        data = self._spool.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._length
+        self._pos = max(0, min(offset, self._length))
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        """
+        close this view only, the spool stays open for the other values
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._pos = 0
+        if self._owner is not None:
+            self._owner._valueClosed()
+
+
+class SpooledGetResp(object):
+    """
+    RpbGetResp decoded from a spool, the content values are left empty
+    and are found in values, in the same order. The spool is closed once
+    every SpooledValue is closed, or by release().
+    """
+    def __init__(self, response, values, spool=None):
+        self.response = response
+        self.values = values
+        self._spool = spool
+        self._open = 0
+        for value in values:
+            if isinstance(value, SpooledValue):
+                value._owner = self
+                self._open += 1
+
+    def _valueClosed(self):
+        self._open -= 1
+        if self._open <= 0:
+            self.release()
+
+    def release(self):
+        """
+        close the spool, no value can be read afterwards
+        """
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+
+def _read_varint(f):
+    result = shift = 0
+    while True:
+        b = f.read(1)
+        if not b:
+            raise exceptions.RiakPBCException('truncated message')
+        b = ord(b)
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result
+        shift += 7
+
+
+def _read_field(f, key):
+    """
+    read the field announced by key, return it encoded
+    """
+    wire_type = key & 7
+    if wire_type == _VARINT:
+        return encode_varint(key) + encode_varint(_read_varint(f))
+    elif wire_type == _BYTES:
+        size = _read_varint(f)
+        return encode_varint(key) + encode_varint(size) + f.read(size)
+    elif wire_type == 1:
+        return encode_varint(key) + f.read(8)
+    elif wire_type == 5:
+        return encode_varint(key) + f.read(4)
+    raise exceptions.RiakPBCException('unsupported wire type %d' % wire_type)
+
+
+def decode_spooled_get(spool, length):
+    """
+    decode a RpbGetResp of length bytes from the current position of
+    spool, leaving the values in place
+    """
+    response = riak_kv_pb2.RpbGetResp()
+    values = []
+    rest = []
+    end = spool.tell() + length
+    while spool.tell() < end:
+        key = _read_varint(spool)
+        if key != GET_RESP_CONTENT:
+            rest.append(_read_field(spool, key))
+            continue
+        content_end = _read_varint(spool)
+        content_end += spool.tell()
+        value = ''
+        fields = []
+        while spool.tell() < content_end:
+            key = _read_varint(spool)
+            if key == CONTENT_VALUE_KEY:
+                size = _read_varint(spool)
+                value = SpooledValue(spool, spool.tell(), size)
+                spool.seek(size, 1)
+            else:
+                fields.append(_read_field(spool, key))
+        content = response.content.add()
+        content.MergeFromString(''.join(fields))
+        content.value = ''
+        values.append(value)
+    response.MergeFromString(''.join(rest))
+    return SpooledGetResp(response, values, spool)
@@ -0,0 +1,80 @@
+"""
+Per request traces for the Riak protocol buffers protocol.
+
+A tracer is any callable taking a RequestTrace, added to a connection with
+RiakPBC.addTracer() (or to all connections of a transport with
+PBCTransport.addTracer()). It is called once for every request when the
+request is done, successfully or not. Connections without tracers don't
+create traces at all.
+"""
+
+
+class RequestTrace(object):
+    """
+    what happened to a single request
+
+    :ivar code: the message code of the request
+    :ivar name: the message type of the request, e.g. 'GET_REQ'
+    :ivar bytesSent: bytes written for the request, including framing
+    :ivar bytesReceived: bytes of all response frames, including framing
+    :ivar frames: number of response frames, more than one for streamed
+        responses (keys, index, mapred)
+    :ivar started: when the request was sent, in reactor.seconds()
+    :ivar firstFrame: when the first response frame arrived, or None
+    :ivar finished: when the request was done
+    :ivar timedOut: whether the request timed out, its response may still
+        have arrived later
+    :ivar failure: the Failure the request failed with, or None
+    """
+    firstFrame = None
+    finished = None
+    timedOut = False
+    failure = None
+
+    def __init__(self, code, name, bytesSent, started):
+        self.code = code
+        self.name = name
+        self.bytesSent = bytesSent
+        self.bytesReceived = 0
+        self.frames = 0
+        self.started = started
+
+    def frameReceived(self, size, now):
+        if self.firstFrame is None:
+            self.firstFrame = now
+        self.frames += 1
+        self.bytesReceived += size
+
+    def timeToFirstFrame(self):
+        """
+        seconds until the first response frame arrived, None without one
+        """
+        if self.firstFrame is not None:
+            return self.firstFrame - self.started
+
+    def duration(self):
+        """
+        seconds from sending the request until it was done
+        """
+        if self.finished is not None:
+            return self.finished - self.started
+
+    def asDict(self):
+        """
+        the trace as a plain dict, e.g. for a metrics exporter
+        """
+        return {
+            'code': self.code,
+            'name': self.name,
+            'bytes_sent': self.bytesSent,
+            'bytes_received': self.bytesReceived,
+            'frames': self.frames,
+            'time_to_first_frame': self.timeToFirstFrame(),
+            'duration': self.duration(),
+            'timed_out': self.timedOut,
+            'failed': self.failure is not None,
+        }
+
+    def __repr__(self):
+        return '<RequestTrace %s sent=%d received=%d frames=%d>' % (
+            self.name, self.bytesSent, self.bytesReceived, self.frames)
@@ -5,6 +5,7 @@ LineReceiver.MAX_LENGTH = 1024 * 1024 * 64
 
 from twisted.internet import defer, reactor, protocol
 from twisted.python import log
+from twisted.python.failure import Failure
 import logging
 import traceback
 
@@ -12,13 +13,15 @@ from distutils.version import LooseVersion
 
 import time
 import json
+from collections import deque
 # MD_ resources
 from riakasaurus.metadata import *
 
 from riakasaurus.riak_index_entry import RiakIndexEntry
 from riakasaurus.mapreduce import RiakLink
 from riakasaurus import exceptions
-from riakasaurus.transport.pbc import dt_codec
+from riakasaurus.transport.pbc import dt_codec, kv_codec
+from riakasaurus.transport import cluster, metrics
 
 # protobuf
 from riakasaurus.transport import transport, pbc
@@ -34,17 +37,74 @@ from riakasaurus.datatypes import Flag,Register #secondary class crdt
 
 
 
+def decodeContentMetadata(content):
+    """
+    the metadata dict of a RpbContent, a plain dict with links, usermeta
+    and indexes already turned into python objects
+    """
+    metadata = {MD_USERMETA: {}, MD_INDEX: []}
+    if content.HasField('content_type'):
+        metadata[MD_CTYPE] = content.content_type
+    if content.HasField('charset'):
+        metadata[MD_CHARSET] = content.charset
+    if content.HasField('content_encoding'):
+        metadata[MD_ENCODING] = content.content_encoding
+    if content.HasField('vtag'):
+        metadata[MD_VTAG] = content.vtag
+    if content.HasField('last_mod'):
+        metadata[MD_LASTMOD] = content.last_mod
+    if content.HasField('deleted'):
+        metadata[MD_DELETED] = content.deleted
+    if len(content.links):
+        metadata[MD_LINKS] = [RiakLink(l.bucket, l.key, l.tag)
+                              for l in content.links]
+    for md in content.usermeta:
+        metadata[MD_USERMETA][md.key] = md.value
+    for ie in content.indexes:
+        metadata[MD_INDEX].append(RiakIndexEntry(ie.key, ie.value))
+    return metadata
+
+
+class PoolWaiter(object):
+    """
+    a request waiting for a transport to be released
+    """
+    def __init__(self):
+        self.d = defer.Deferred()
+        self.timeoutd = None
+
+    def cancelTimeout(self):
+        if self.timeoutd and self.timeoutd.active():
+            self.timeoutd.cancel()
+
+
+class ReadAttempt(object):
+    """
+    one of the reads sent for a hedged request. Once another one answered
+    it is cancelled: if it didn't get a transport yet it is failed with
+    CancelledError as soon as it does, without sending anything. A read
+    sent already is not cancelled, it finishes on its connection and its
+    answer is dropped.
+    """
+    cancelled = False
+
+
 class StatefulTransport(object):
     def __init__(self,factory):
         self.__transport = None
-        self.__state = 'idle'
+        self.__pending = 0
         self.__created = time.time()
         self.__used = time.time()
+        # when the requests in flight were started, oldest first
+        self.__started = deque()
+        # seconds idle before the requests in flight
+        self.__idled = 0
         self.__factory=factory
 
     def __repr__(self):
-        return '<StatefulTransport idle=%.2fs state=\'%s\' transport=%s>' % (
-            time.time() - self.__used, self.__state, self.__transport)
+        return '<StatefulTransport idle=%.2fs state=\'%s\' pending=%d transport=%s>' % (
+            time.time() - self.__used, self.state(), self.__pending,
+            self.__transport)
 
     def __enter__(self):
         return self.getTransport()
@@ -52,24 +112,61 @@ class StatefulTransport(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.setIdle()
 
+    def state(self):
+        return 'active' if self.__pending else 'idle'
+
     def isActive(self):
-        return self.__state == 'active'
+        return self.__pending > 0
 
     def setActive(self):
-        self.__state = 'active'
+        """
+        mark one more request as in flight on this transport
+        """
+        now = time.time()
+        if not self.__pending:
+            self.__idled = now - self.__used
+        self.__pending += 1
         self.__factory.active_count+=1
-        self.__used = time.time()
+        self.__used = now
+        self.__started.append(now)
 
     def isIdle(self):
-        return self.__state == 'idle'
+        return self.__pending == 0
 
     def setIdle(self):
-        self.__state = 'idle'
+        """
+        release one in flight request, the transport is idle once all
+        pipelined requests have been released
+        """
+        self.__pending -= 1
         self.__factory.active_count-=1
         self.__used = time.time()
+        self.__factory._transportReleased(self, self.__started.popleft())
+
+    def pending(self):
+        return self.__pending
+
+    def idled(self):
+        """
+        seconds the transport was idle before it became active
+        """
+        return self.__idled
+
+    def hasCapacity(self, depth):
+        """
+        whether another request can be pipelined on this transport, not
+        behind a streamed response: it would wait while the stream is
+        paused
+        """
+        return (self.__transport is not None and
+                not self.__transport.isRetired() and
+                not self.__transport.isStreaming() and
+                self.__pending < depth)
 
     def setTransport(self, transport):
         self.__transport = transport
+        transport.notifyDisconnect().addCallback(
+            lambda _: self.__factory._transportLost(self))
 
     def getTransport(self):
         return self.__transport
@@ -81,6 +178,357 @@ class StatefulTransport(object):
         transport = self.getTransport()
         return transport and transport.isDisconnected()
 
+    def isRetired(self):
+        """
+        disconnected, or closing after a request timed out
+        """
+        transport = self.getTransport()
+        return transport and transport.isRetired()
+
+
+# requests whose latency adjusts the concurrency limit, streamed and
+# long running ones (keys, mapred, ...) would only drag it down
+LIMIT_SAMPLES = frozenset([
+    pbc.MSG_CODE_GET_REQ,
+    pbc.MSG_CODE_PUT_REQ,
+    pbc.MSG_CODE_DEL_REQ,
+    pbc.MSG_CODE_COUNTER_GET_REQ,
+    pbc.MSG_CODE_COUNTER_UPDATE_REQ,
+    pbc.MSG_CODE_DATATYPE_FETCH_REQ,
+    pbc.MSG_CODE_DATATYPE_UPDATE_REQ,
+])
+
+
+class PBCNodePool(cluster.Node):
+    """
+    the connections of a PBCTransport to a single Riak node. The limits
+    (MAX_TRANSPORTS, MAX_WAITERS, ...) are those of the PBCTransport and
+    apply to every node.
+    """
+    def __init__(self, factory, host, port):
+        cluster.Node.__init__(self, host, port)
+        self.factory = factory
+        self._idle = deque()     # idle transports, last released last
+        self._active = set()     # transports with requests in flight
+        self._waiters = deque()  # PoolWaiters, oldest first
+        self.active_count = 0
+        self._connecting = 0     # connects in progress
+        self._connectQueue = deque()  # deferreds waiting to connect
+        self._warming = 0        # connects opened to reach min_idle
+        self._expiry = {}        # idle transport -> its idle timer
+        self.limiter = cluster.AdaptiveLimit()
+
+    @property
+    def _transports(self):
+        """
+        all transports, idle and active
+        """
+        return list(self._idle) + list(self._active)
+
+    def _warm(self):
+        """
+        open connections until min_idle of them are idle, or being
+        opened to become idle
+        """
+        factory = self.factory
+        while (len(self._idle) + self._warming < factory.min_idle and
+               len(self._idle) + len(self._active) < factory.MAX_TRANSPORTS):
+            stp = StatefulTransport(self)
+            self._active.add(stp)
+            stp.setActive()
+            self._warming += 1
+            self._warmTransport(stp)
+
+    @defer.inlineCallbacks
+    def _warmTransport(self, stp):
+        """
+        connect and ping a transport for the idle pool
+        """
+        try:
+            yield self._connectTransport(stp)
+        except Exception, e:
+            # the placeholder is dropped already
+            self._warming -= 1
+            log.msg("[%s] warming %s:%s failed: %s" % (
+                    self.__class__.__name__, self.host, self.port, e
+                ), logLevel=self.factory.logToLevel)
+            return
+        yield self._checkTransport(stp)
+        self._warming -= 1
+        stp.setIdle()
+
+    @defer.inlineCallbacks
+    def _checkTransport(self, stp):
+        """
+        ping an acquired transport, it is retired if the ping fails.
+        Returns whether it succeeded.
+        """
+        try:
+            yield stp.getTransport().sendRequest(
+                pbc.MSG_CODE_PING_REQ, timeout=self.factory.PING_TIMEOUT)
+        except Exception:
+            stp.getTransport().retire()
+            defer.returnValue(False)
+        defer.returnValue(True)
+
+    def _expire(self, stp):
+        """
+        stp has been idle for MAX_IDLETIME, close it. Connections keeping
+        up min_idle are pinged instead, the next request shouldn't find
+        out they were dropped.
+        """
+        del self._expiry[stp]
+        self._idle.remove(stp)
+        if len(self._idle) >= self.factory.min_idle:
+            stp.getTransport().retire()
+            if self.factory.debug & LOGLEVEL_TRANSPORT:
+                log.msg("[%s] expire idle transport %s" % (
+                        self.__class__.__name__, stp
+                    ), logLevel=self.factory.logToLevel)
+            return
+        self._active.add(stp)
+        stp.setActive()
+        self._checkTransport(stp).addCallback(lambda ok: stp.setIdle())
+
+    def outstanding(self):
+        return self.active_count + len(self._waiters)
+
+    def concurrencyLimit(self):
+        """
+        requests allowed in flight to the node at once
+        """
+        factory = self.factory
+        maximum = factory.MAX_TRANSPORTS * factory.pipeline_depth
+        if not factory.ADAPTIVE_LIMIT:
+            return maximum
+        return min(self.limiter.current(), maximum)
+
+    def _acquireTransport(self):
+        """
+        mark a transport active and return it: an idle one, one that can
+        pipeline another request, or a new unconnected placeholder if
+        MAX_TRANSPORTS allows. None if the pool is exhausted or the
+        concurrency limit is reached.
+        """
+        factory = self.factory
+        if self.active_count >= self.concurrencyLimit():
+            return None
+        while self._idle:
+            # the most recently released one, so surplus connections stay
+            # unused and are closed after MAX_IDLETIME
+            stp = self._idle.pop()
+            self._expiry.pop(stp).cancel()
+            if stp.isRetired():
+                # closing after a timeout, it is dropped from the pool
+                continue
+            self._active.add(stp)
+            stp.setActive()
+            stp.getTransport().setTimeout(factory.timeout)
+            if len(self._idle) < factory.min_idle:
+                self._warm()
+            if factory.debug & LOGLEVEL_TRANSPORT_VERBOSE:
+                log.msg("[%s] aquired idle transport[%d]: %s" % (
+                        self.__class__.__name__,
+                        len(self._active), stp
+                    ), logLevel=factory.logToLevel)
+            return stp
+        if factory.pipeline_depth > 1:
+            # no idle connection, pipeline onto the least busy one
+            # that still has room before opening another socket
+            busy = [x for x in self._active
+                    if x.hasCapacity(factory.pipeline_depth)]
+            if busy:
+                stp = min(busy, key=lambda x: x.pending())
+                stp.setActive()
+                if factory.debug & LOGLEVEL_TRANSPORT_VERBOSE:
+                    log.msg("[%s] pipelined on transport[%d]: %s" % (
+                            self.__class__.__name__,
+                            len(self._active), stp
+                        ), logLevel=factory.logToLevel)
+                return stp
+        if len(self._active) < factory.MAX_TRANSPORTS:
+            # (no idle ones left) add a placeholder to the pool, it is
+            # connected by _getFreeTransport()
+            stp = StatefulTransport(self)
+            self._active.add(stp)
+            stp.setActive()
+            return stp
+        return None
+
+    def _waitForTransport(self, deadline=None):
+        """
+        queue up for the next transport released, waiters are served in
+        the order they arrived
+        """
+        factory = self.factory
+        if factory.MAX_WAITERS is not None and \
+                len(self._waiters) >= factory.MAX_WAITERS:
+            raise exceptions.PoolExhausted(
+                'all %d transports busy and %d requests waiting' % (
+                    len(self._transports), len(self._waiters)))
+        timeout, exc = factory.ACQUIRE_TIMEOUT, None
+        if timeout:
+            exc = exceptions.PoolExhausted(
+                'no transport available within %ss' % timeout)
+        if deadline is not None:
+            budget = factory._budget(deadline)
+            if not timeout or budget < timeout:
+                timeout = budget
+                exc = exceptions.RequestTimeout('deadline exceeded')
+        waiter = PoolWaiter()
+        if timeout:
+            waiter.timeoutd = reactor.callLater(timeout, self._waiterTimedOut,
+                                                waiter, exc)
+        self._waiters.append(waiter)
+        return waiter.d
+
+    def _waiterTimedOut(self, waiter, exc):
+        self._waiters.remove(waiter)
+        waiter.d.errback(exc)
+
+    def _transportReleased(self, stp, started):
+        """
+        called by a StatefulTransport whenever a request is done with it,
+        the request was started at started
+        """
+        if stp.getTransport() is not None:
+            self.recordLatency(time.time() - started)
+        if stp.isIdle():
+            self._active.discard(stp)
+            if stp.getTransport() is not None and not stp.isRetired():
+                self._idle.append(stp)
+                self._expiry[stp] = reactor.callLater(
+                    self.factory.MAX_IDLETIME, self._expire, stp)
+        self._serveWaiters()
+
+    def _transportLost(self, stp):
+        """
+        evict a disconnected transport
+        """
+        self._active.discard(stp)
+        if stp in self._idle:
+            self._idle.remove(stp)
+            self._expiry.pop(stp).cancel()
+        self._serveWaiters()
+        self._warm()
+
+    def _serveWaiters(self):
+        """
+        hand released capacity to waiting requests
+        """
+        while self._waiters:
+            stp = self._acquireTransport()
+            if stp is None:
+                break
+            waiter = self._waiters.popleft()
+            waiter.cancelTimeout()
+            waiter.d.callback(stp)
+
+    @defer.inlineCallbacks
+    def _getFreeTransport(self, deadline=None):
+        """
+        acquire a transport, waiting for one to be released if all
+        MAX_TRANSPORTS are busy. Fails with PoolExhausted if MAX_WAITERS
+        requests are already waiting or none is released within
+        ACQUIRE_TIMEOUT, and with RequestTimeout if deadline passes first.
+
+        Transports idle for more than PING_AFTER_IDLE seconds are pinged
+        first, and replaced if they don't answer.
+        """
+        factory = self.factory
+        started = reactor.seconds()
+        while True:
+            stp = None
+            if not self._waiters:
+                # don't overtake requests already waiting
+                stp = self._acquireTransport()
+            if stp is None:
+                try:
+                    stp = yield self._waitForTransport(deadline)
+                except (exceptions.PoolExhausted,
+                        exceptions.RequestTimeout):
+                    factory.metrics.acquireFailures += 1
+                    raise
+            if stp.getTransport() is None:
+                yield self._connectTransport(stp)
+            elif (factory.PING_AFTER_IDLE is not None and
+                    stp.pending() == 1 and
+                    stp.idled() > factory.PING_AFTER_IDLE):
+                # it may have been dropped silently while idle
+                alive = yield self._checkTransport(stp)
+                if not alive:
+                    stp.setIdle()
+                    continue
+            factory.metrics.acquireWait.observe(reactor.seconds() - started)
+            defer.returnValue(stp)
+
+    def _connectDone(self):
+        self._connecting -= 1
+        if self._connectQueue:
+            self._connectQueue.popleft().callback(None)
+
+    @defer.inlineCallbacks
+    def _connectTransport(self, stp):
+        """
+        create the transport and use it to configure the placeholder
+        """
+        factory = self.factory
+        if (factory.MAX_CONNECTING is not None and
+                self._connecting >= factory.MAX_CONNECTING):
+            # don't stampede the node, wait for a connect to finish
+            d = defer.Deferred()
+            self._connectQueue.append(d)
+            yield d
+        self._connecting += 1
+        started = reactor.seconds()
+        try:
+            transport = yield pbc.RiakPBCClient().connect(self.host, self.port)
+        except Exception:
+            self._connectDone()
+            factory.metrics.connectFailures += 1
+            self.breaker.record(False, started)
+            # drops the placeholder
+            stp.setIdle()
+            factory.cluster.failed(self)
+            raise
+        self._connectDone()
+        factory.metrics.connects += 1
+        factory.metrics.connectLatency.observe(reactor.seconds() - started)
+        factory.cluster.succeeded(self)
+        stp.setTransport(transport)
+        if factory.timeout:
+            transport.setTimeout(factory.timeout)
+        if factory.max_frame_size:
+            transport.setMaxFrameSize(factory.max_frame_size)
+        if factory.spool_threshold is not None:
+            transport.setSpoolThreshold(factory.spool_threshold)
+        transport.addTracer(factory.metrics.requestTraced)
+        transport.addTracer(self._requestTraced)
+        for tracer in factory.tracers:
+            transport.addTracer(tracer)
+        if factory.debug & LOGLEVEL_TRANSPORT:
+            log.msg("[%s] allocate new transport[%d]: %s" % (
+                    self.__class__.__name__,
+                    len(self._active), stp
+                ), logLevel=factory.logToLevel)
+
+
+    def _requestTraced(self, trace):
+        """
+        count the outcome of a request for the circuit breaker and the
+        concurrency limit. Error responses mean the node is answering,
+        unless it is overloaded.
+        """
+        failure = trace.failure
+        ok = not trace.timedOut and (
+            failure is None or
+            (failure.check(exceptions.RiakPBCException) and
+             'overload' not in str(failure.value)))
+        self.breaker.record(ok, trace.started)
+        if not ok or trace.code in LIMIT_SAMPLES:
+            self.limiter.sample(trace.duration(), self.active_count,
+                                dropped=not ok)
+
 
 class PBCTransport(transport.FeatureDetection):
     """ Protocoll buffer transport for Riak """
@@ -90,117 +538,274 @@ class PBCTransport(transport.FeatureDetection):
     debug = 0
     logToLevel = logging.INFO
     MAX_TRANSPORTS = 100
-    MAX_IDLETIME = 5 * 60     # in seconds
-    # how often (in seconds) the garbage collection should run
-    # XXX Why the hell do we even have to override GC?
-    GC_TIME = 120
-    POOL_RETRY = 30
+    # how many requests may be pipelined on a single connection,
+    # 1 disables pipelining
+    PIPELINE_DEPTH = 1
+    # seconds after which an idle connection is closed
+    MAX_IDLETIME = 5 * 60
+    # ping connections idle for longer than this many seconds before they
+    # are used again, None to use them right away
+    PING_AFTER_IDLE = None
+    # seconds such a ping (and the ping of idle min_idle connections) may
+    # take
+    PING_TIMEOUT = 2
+    # requests waiting for a transport when all MAX_TRANSPORTS are busy,
+    # None for no limit
+    MAX_WAITERS = 1000
+    # seconds a request waits for a transport, None to wait indefinitely
+    ACQUIRE_TIMEOUT = 3
+    # connects in progress to a node at the same time, None for no limit
+    MAX_CONNECTING = 10
+    # adapt the requests in flight to every node to its latency (see
+    # cluster.AdaptiveLimit), starting at AdaptiveLimit.INITIAL with
+    # MAX_TRANSPORTS * pipeline depth as the upper bound. False allows
+    # that many right away.
+    ADAPTIVE_LIMIT = False
+    # hedge reads (get, head, get_index, fetch_datatype): a read not
+    # answered within this percentile of the latency of its operation is
+    # sent a second time, the first answer wins. None disables it, see
+    # setHedging()
+    HEDGE_PERCENTILE = None
+    # hedged reads as a fraction of all reads
+    HEDGE_BUDGET = 0.05
+    # hedges that may be sent in a burst, the budget accumulates up to this
+    HEDGE_BURST = 10
+    # reads of an operation measured before they are hedged
+    HEDGE_MIN_SAMPLES = 100
 
     def __init__(self, client):
         self.host = client._host
         self.port = client._port
         self.client = client
         self._client_id = None
-        self._transports = []    # list of transports, empty on start
-        self.active_count = 0
-        self._gc = reactor.callLater(self.GC_TIME, self._garbageCollect)
+        self.cluster = cluster.Cluster(
+            [PBCNodePool(self, host, port) for host, port in client._nodes],
+            client._balancer)
         self.timeout = client.request_timeout
+        self.pipeline_depth = self.PIPELINE_DEPTH
+        self.max_frame_size = client.max_frame_size
+        self.spool_threshold = client.spool_threshold
+        self.tracers = []
+        # pool and request metrics, see metrics
+        self.metrics = metrics.TransportMetrics(self)
+        if len(self.cluster.nodes) > 1:
+            self.cluster.startHealthChecks(self._pingNode)
+        self.min_idle = 0
+        self.setMinIdle(client.min_idle)
+        self.hedge_percentile = self.HEDGE_PERCENTILE
+        self.hedge_budget = self.HEDGE_BUDGET
+        self._hedgeTokens = 0
+
+    @property
+    def _transports(self):
+        """
+        all transports to all nodes
+        """
+        return [stp for pool in self.cluster.nodes
+                for stp in pool._transports]
+
+    @property
+    def active_count(self):
+        return sum(pool.active_count for pool in self.cluster.nodes)
 
     def setTimeout(self, t):
         self.timeout = t
 
-    @defer.inlineCallbacks
-    def _getFreeTransport(self,retry = None):
-        foundOne = False
-        retry = self.POOL_RETRY if retry == None else retry
-        # Discard disconnected transports.
-        self._transports = [x for x in self._transports if not x.isDisconnected()]
+    def setMaxFrameSize(self, size):
+        """
+        set the largest response accepted, larger responses fail the
+        request and close the connection
+        """
+        self.max_frame_size = size
+        for stp in self._transports:
+            if stp.getTransport():
+                stp.getTransport().setMaxFrameSize(size)
 
+    def setSpoolThreshold(self, size):
+        """
+        spool responses larger than size bytes to a temporary file, the
+        values of such objects are file-like objects. None disables it.
+        """
+        self.spool_threshold = size
         for stp in self._transports:
-            if stp.isIdle():
-                stp.setActive()
-                stp.getTransport().setTimeout(self.timeout)
-                foundOne = True
-                if self.debug & LOGLEVEL_TRANSPORT_VERBOSE:
-                    log.msg("[%s] aquired idle transport[%d]: %s" % (
-                            self.__class__.__name__,
-                            len(self._transports), stp
-                        ), logLevel=self.logToLevel)
-                defer.returnValue(stp)
-        if not foundOne:
-            if len(self._transports) >= self.MAX_TRANSPORTS:
-                if retry > 0:
-                    d = defer.Deferred()
-                    d.addCallback(self._getFreeTransport)
-                    reactor.callLater(0.1, d.callback,retry -1 )
-                    conn = yield d
-                    defer.returnValue(conn)
-                else:
-                    raise Exception("too many transports, aborting")
-            # nothin free, create a new protocol instance, append
-            # it to self._transports and return it
-
-            # insert a placeholder into self._transports to avoid race
-            # conditions with the MAX_TRANSPORTS check above.
-            stp = StatefulTransport(self)
-            stp.setActive()
-            idx = len(self._transports)
-            self._transports.append(stp)
-
-            # create the transport and use it to configure the placeholder.
-            try:
-                transport = yield pbc.RiakPBCClient().connect(self.host, self.port)
-                stp.setTransport(transport)
-                if self.timeout:
-                    transport.setTimeout(self.timeout)
-                if self.debug & LOGLEVEL_TRANSPORT:
-                    log.msg("[%s] allocate new transport[%d]: %s" % (
-                            self.__class__.__name__, idx, stp
-                        ), logLevel=self.logToLevel)
-                defer.returnValue(stp)
-            except Exception:
-                self._transports.remove(stp)
-                raise
-
-
-    @defer.inlineCallbacks
-    def _garbageCollect(self):
-        self._gc = reactor.callLater(self.GC_TIME, self._garbageCollect)
-        for idx, stp in enumerate(self._transports):
-            if (stp.isIdle() and stp.age() > self.MAX_IDLETIME):
-                yield stp.getTransport().quit()
-                if self.debug & LOGLEVEL_TRANSPORT:
-                    log.msg("[%s] expire idle transport[%d] %s" % (
-                            self.__class__.__name__,
-                            idx,
-                            stp
-                        ), logLevel=self.logToLevel)
+            if stp.getTransport():
+                stp.getTransport().setSpoolThreshold(size)
 
-                    log.msg("[%s] %s" % (
-                            self.__class__.__name__,
-                            self._transports
-                        ), logLevel=self.logToLevel)
-
-                self._transports.remove(stp)
-            elif self.timeout and stp.isActive() and stp.age() > self.timeout:
-                yield stp.getTransport().quit()
-                if self.debug & LOGLEVEL_TRANSPORT:
-                    log.msg("[%s] expire timeouted transport[%d] %s" % (
-                            self.__class__.__name__,
-                            idx,
-                            stp
-                        ), logLevel=self.logToLevel)
+    def addTracer(self, tracer):
+        """
+        call tracer with a pbc.tracing.RequestTrace for every request
+        finished on any connection
+        """
+        self.tracers.append(tracer)
+        for stp in self._transports:
+            if stp.getTransport():
+                stp.getTransport().addTracer(tracer)
 
-                    log.msg("[%s] %s" % (
-                            self.__class__.__name__,
-                            self._transports
-                        ), logLevel=self.logToLevel)
+    def removeTracer(self, tracer):
+        self.tracers.remove(tracer)
+        for stp in self._transports:
+            if stp.getTransport():
+                stp.getTransport().removeTracer(tracer)
+
+    def _deadline(self, timeout):
+        """
+        the time by which an operation allowed timeout seconds (by default
+        the request timeout) has to be done, None for no deadline
+        """
+        timeout = timeout or self.timeout
+        if timeout:
+            return time.time() + timeout
+
+    def _budget(self, deadline):
+        """
+        seconds left until deadline, or None without one
+        """
+        if deadline is None:
+            return None
+        budget = deadline - time.time()
+        if budget <= 0:
+            raise exceptions.RequestTimeout('deadline exceeded')
+        return budget
+
+    def setMinIdle(self, count):
+        """
+        keep at least count idle connections open to every node, they are
+        opened (and pinged) right away
+        """
+        self.min_idle = count
+        for pool in self.cluster.nodes:
+            pool._warm()
+
+    def setPipelineDepth(self, depth):
+        """
+        set how many requests may be outstanding on a single connection
+        """
+        if depth < 1:
+            raise ValueError("pipeline depth must be at least 1")
+        self.pipeline_depth = depth
+
+    def setHedging(self, percentile, budget=None):
+        """
+        hedge reads not answered within percentile (e.g. 95) of the latency
+        of their operation, None disables hedging. budget is the fraction
+        of reads that may be hedged.
+
+        Hedging is PBC only, HTTPTransport never hedges. The read that
+        loses is only cancelled while it waits for a transport: PBC can't
+        recall a request that was sent, one in flight finishes on its
+        connection and its answer is dropped.
+        """
+        self.hedge_percentile = percentile
+        if budget is not None:
+            self.hedge_budget = budget
 
-                self._transports.remove(stp)
+    def _getFreeTransport(self, deadline=None, attempt=None):
+        """
+        acquire a transport to the node picked by the balancing strategy,
+        see PBCNodePool._getFreeTransport. If attempt is a ReadAttempt
+        cancelled in the meantime the transport is released again.
+        """
+        try:
+            pool = self.cluster.pick()
+        except exceptions.CircuitOpen:
+            return defer.fail()
+        d = pool._getFreeTransport(deadline)
+        if attempt is not None:
+            d.addCallback(self._checkAttempt, attempt)
+        return d
+
+    def _checkAttempt(self, stp, attempt):
+        if attempt.cancelled:
+            stp.setIdle()
+            raise defer.CancelledError()
+        return stp
+
+    def _retried(self, request, deadline=None):
+        """
+        call request with the retry policy of the client, only for
+        idempotent requests
+        """
+        return self.client.retry_policy.call(request, deadline, self.metrics)
+
+    @defer.inlineCallbacks
+    def _withTransport(self, method, *args, **kwargs):
+        """
+        call method of a free transport
+        """
+        with (yield self._getFreeTransport()) as transport:
+            ret = yield getattr(transport, method)(*args, **kwargs)
+        defer.returnValue(ret)
+
+    def _hedged(self, op, read):
+        """
+        call read with a ReadAttempt, it returns a deferred. With hedging
+        on it is called again if the first read isn't answered within the
+        hedge_percentile latency of op (from metrics), as long as the
+        budget allows. The first answer wins, the other read is cancelled.
+        """
+        if self.hedge_percentile is None:
+            return read(None)
+        self._hedgeTokens = min(self._hedgeTokens + self.hedge_budget,
+                                self.HEDGE_BURST)
+        histogram = self.metrics.operations.get(op)
+        if histogram is None or histogram.count < self.HEDGE_MIN_SAMPLES:
+            return read(None)
+
+        result = defer.Deferred()
+        attempts = []
+
+        def send(hedge):
+            attempt = ReadAttempt()
+            attempts.append(attempt)
+            read(attempt).addBoth(answered, attempt, hedge)
+
+        def hedge():
+            if self._hedgeTokens >= 1:
+                self._hedgeTokens -= 1
+                self.metrics.hedges += 1
+                send(True)
+
+        def answered(response, attempt, hedge):
+            attempts.remove(attempt)
+            if result.called:
+                # lost, a failure here is of no interest anymore
+                return
+            if isinstance(response, Failure) and attempts:
+                # the other read may still succeed
+                return
+            if timer.active():
+                timer.cancel()
+            for other in attempts:
+                other.cancelled = True
+            if hedge:
+                self.metrics.hedgeWins += 1
+            if isinstance(response, Failure):
+                result.errback(response)
+            else:
+                result.callback(response)
+
+        timer = reactor.callLater(
+            histogram.percentile(self.hedge_percentile), hedge)
+        send(False)
+        return result
+
+    @defer.inlineCallbacks
+    def _pingNode(self, pool, timeout):
+        """
+        health check of a single node
+        """
+        with (yield pool._getFreeTransport(self._deadline(timeout))) as \
+                transport:
+            yield transport.sendRequest(pbc.MSG_CODE_PING_REQ,
+                                        timeout=timeout)
 
     @defer.inlineCallbacks
     def quit(self):
-        self._gc.cancel()      # cancel the garbage collector
+        self.cluster.stopHealthChecks()
+        for pool in self.cluster.nodes:
+            for timer in pool._expiry.values():
+                timer.cancel()
+            pool._expiry.clear()
 
         for stp in self._transports:
             if self.debug & LOGLEVEL_DEBUG:
@@ -217,10 +822,11 @@ class PBCTransport(transport.FeatureDetection):
         self.quit()
 
     def put(self, robj, w=None, dw=None, pw=None, return_body=True,
-            if_none_match=False):
+            if_none_match=False, timeout=None):
 
         ret = self.__put(robj, w, dw, pw,
-                         return_body=return_body, if_none_match=if_none_match)
+                         return_body=return_body, if_none_match=if_none_match,
+                         timeout=timeout)
 
         #even if we don't want body, we still need to get the defer to wait the process is being finished here
 #        if return_body:
@@ -230,9 +836,10 @@ class PBCTransport(transport.FeatureDetection):
         return ret
 
     def put_new(self, robj, w=None, dw=None, pw=None, return_body=True,
-                if_none_match=False):
+                if_none_match=False, timeout=None):
         ret = self.__put(robj, w, dw, pw,
-                         return_body=return_body, if_none_match=if_none_match)
+                         return_body=return_body, if_none_match=if_none_match,
+                         timeout=timeout)
 #        if return_body:
             #return ret
         #else:
@@ -241,102 +848,70 @@ class PBCTransport(transport.FeatureDetection):
 
     @defer.inlineCallbacks
     def __put(self, robj, w=None, dw=None, pw=None, return_body=True,
-              if_none_match=False):
-        # std kwargs
-        kwargs = {
-                'w': w,
-                'dw': dw,
-                'pw': pw,
-                'return_body': return_body,
-                'if_none_match': if_none_match
-            }
-        # vclock
-        vclock = robj.vclock() or None
-
-        payload = {
-                'value': robj.get_encoded_data(),
-                'content_type': robj.get_content_type(),
-            }
-
-        # links
-        links = robj.get_links()
-        if links:
-            payload['links'] = []
-            for l in links:
-                payload['links'].append(
-                    (l.get_bucket(), l.get_key(), l.get_tag())
-                )
-
-        # usermeta
-        if robj.get_usermeta():
-            payload['usermeta'] = []
-            for key, value in robj.get_usermeta().iteritems():
-                payload['usermeta'].append((key, value))
-
-        # indexes
-        if robj.get_indexes():
-            payload['indexes'] = []
-            for index in robj.get_indexes():
-                payload['indexes'].append(
-                    (index.get_field(), index.get_value())
-                )
+              if_none_match=False, timeout=None):
+        deadline = self._deadline(timeout)
 
         # aquire transport, fire, release
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.put(robj.get_bucket().name,
-                                      robj.get_key(),
-                                      payload,
-                                      vclock,
-                                      bucket_type = robj.get_bucket().bucket_type,
-                                      **kwargs
-                                      )
+        with (yield self._getFreeTransport(deadline)) as transport:
+            budget = self._budget(deadline)
+            request = kv_codec.encode_put(robj, w=w, dw=dw, pw=pw,
+                                          return_body=return_body,
+                                          if_none_match=if_none_match,
+                                          timeout=budget)
+            ret = yield transport.sendRequest(pbc.MSG_CODE_PUT_REQ, request,
+                                              timeout=budget)
         defer.returnValue(self.parseRpbGetResp(ret))
 
-    @defer.inlineCallbacks
-    def get(self, robj, r=None, pr=None, vtag=None):
-
+    def get(self, robj, r=None, pr=None, vtag=None, timeout=None):
         # ***FIXME*** whats vtag for? ignored for now
+        deadline = self._deadline(timeout)
+        return self._retried(lambda: self._hedged(
+            'get', lambda attempt: self._get(robj, r, pr, deadline,
+                                             attempt=attempt)), deadline)
 
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.get(robj.get_bucket().name,
-                                      robj.get_key(),
-                                      r=r,
-                                      pr=pr,
-                                      bucket_type = robj.get_bucket().bucket_type)
-
-        defer.returnValue(self.parseRpbGetResp(ret))
+    def head(self, robj, r=None, pr=None, vtag=None, timeout=None):
+        deadline = self._deadline(timeout)
+        return self._retried(lambda: self._hedged(
+            'get', lambda attempt: self._get(robj, r, pr, deadline, head=True,
+                                             attempt=attempt)), deadline)
 
     @defer.inlineCallbacks
-    def head(self, robj, r=None, pr=None, vtag=None):
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.get(robj.get_bucket().name,
-                                      robj.get_key(),
-                                      r=r,
-                                      pr=pr,
-                                      head=True)
+    def _get(self, robj, r, pr, deadline, head=None, attempt=None):
+        bucket = robj.get_bucket()
+
+        with (yield self._getFreeTransport(deadline, attempt)) as transport:
+            budget = self._budget(deadline)
+            request = kv_codec.encode_get(bucket.name, robj.get_key(),
+                                          bucket.bucket_type, r=r, pr=pr,
+                                          head=head, timeout=budget)
+            ret = yield transport.sendRequest(pbc.MSG_CODE_GET_REQ, request,
+                                              timeout=budget)
 
         defer.returnValue(self.parseRpbGetResp(ret))
 
     @defer.inlineCallbacks
-    def delete(self, robj, rw=None, r=None, w=None, dw=None, pr=None, pw=None):
+    def delete(self, robj, rw=None, r=None, w=None, dw=None, pr=None, pw=None,
+               timeout=None):
         """
         Delete an object.
         """
         # We could detect quorum_controls here but HTTP ignores
         # unknown flags/params.
-        kwargs = {'rw': rw, 'r': r, 'w': w, 'dw': dw, 'pr': pr, 'pw': pw}
-        headers = {}
-
+        deadline = self._deadline(timeout)
+        vclock = None
         ts = yield self.tombstone_vclocks()
         if ts and robj.vclock() is not None:
-            kwargs['vclock'] = robj.vclock()
-
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.delete(robj.get_bucket().name,
-                                        robj.get_key(),
-                                        bucket_type = robj.get_bucket().bucket_type,
-                                        **kwargs
-                                        )
+            vclock = robj.vclock()
+
+        bucket = robj.get_bucket()
+        with (yield self._getFreeTransport(deadline)) as transport:
+            budget = self._budget(deadline)
+            request = kv_codec.encode_delete(bucket.name, robj.get_key(),
+                                             bucket.bucket_type, vclock=vclock,
+                                             rw=rw, r=r, w=w, dw=dw, pr=pr,
+                                             pw=pw, timeout=budget)
+            ret = yield transport.sendRequest(pbc.MSG_CODE_DEL_REQ, request,
+                                              timeout=budget)
 
         defer.returnValue(ret)
 
@@ -379,8 +954,8 @@ class PBCTransport(transport.FeatureDetection):
             options['fl']=fl
 
         options.update(params)
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.search(index,query,**options)
+        ret = yield self._retried(
+            lambda: self._withTransport('search', index, query, **options))
 
         ret = self.parseRpbSearchResp(ret) #didn't really parse it, just annotates resp structure
         defer.returnValue(ret)
@@ -389,28 +964,64 @@ class PBCTransport(transport.FeatureDetection):
     @defer.inlineCallbacks
     def mapred(self, inputs, query, timeout=None):
         """
-        Run a MapReduce query.
+        Run a MapReduce query. timeout is in milliseconds like the
+        timeout of the job, by default the request timeout applies.
         """
         plm = yield self.phaseless_mapred()
         if not plm and (query is None or len(query) is 0):
             raise Exception('Phase-less MapReduce is not supported'
                             'by this Riak node')
-        # Construct the job, optionally set the timeout...
-        job = {'inputs': inputs, 'query': query}
-        if timeout is not None:
-            job['timeout'] = timeout
-        content = self.encodeJson(job)
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.mapred(content)
+        deadline = self._deadline(timeout and timeout / 1000.0)
+        with (yield self._getFreeTransport(deadline)) as transport:
+            budget = self._budget(deadline)
+            ret = yield transport.mapred(
+                self._mapredJob(inputs, query, budget), timeout=budget)
         ret = self.parseRpbMapReduceResp(ret)
         defer.returnValue(ret)
 
+    @defer.inlineCallbacks
+    def stream_mapred(self, inputs, query, stream, timeout=None):
+        """
+        Run a MapReduce query, writing (phase, results) to stream for
+        every response message as it arrives. timeout is in milliseconds,
+        see mapred().
+        """
+        plm = yield self.phaseless_mapred()
+        if not plm and (query is None or len(query) is 0):
+            raise Exception('Phase-less MapReduce is not supported'
+                            'by this Riak node')
+        deadline = self._deadline(timeout and timeout / 1000.0)
+        stream.decoder = self.decodeRpbMapRedResp
+        with (yield self._getFreeTransport(deadline)) as transport:
+            budget = self._budget(deadline)
+            yield transport.mapred(self._mapredJob(inputs, query, budget),
+                                   stream=stream, timeout=budget)
+        stream.finish()
+
+    def _mapredJob(self, inputs, query, budget):
+        """
+        the encoded job, with the seconds left in budget as its timeout
+        """
+        job = {'inputs': inputs, 'query': query}
+        if budget is not None:
+            job['timeout'] = kv_codec.milliseconds(budget)
+        return self.encodeJson(job)
+
     @defer.inlineCallbacks
     def get_buckets(self,bucket_type = 'default'):
         with (yield self._getFreeTransport()) as transport:
             ret = yield transport.getBuckets(bucket_type)
         defer.returnValue([x for x in ret.buckets])
 
+    @defer.inlineCallbacks
+    def stream_buckets(self, stream, bucket_type='default'):
+        """
+        list all buckets, writing every chunk to stream as it arrives
+        """
+        with (yield self._getFreeTransport()) as transport:
+            yield transport.streamBuckets(stream, bucket_type)
+        stream.finish()
+
     @defer.inlineCallbacks
     def server_version(self):
         if not self._s_version:
@@ -440,8 +1051,7 @@ class PBCTransport(transport.FeatureDetection):
         """
         Check server is alive
         """
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.ping()
+        ret = yield self._retried(lambda: self._withTransport('ping'))
         defer.returnValue(ret == True)
 
     @defer.inlineCallbacks
@@ -450,9 +1060,9 @@ class PBCTransport(transport.FeatureDetection):
         if not counters:
             raise NotImplementedError("Counters are not supported")
 
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.get_counter(bucket,key,**params)
-            defer.returnValue(ret)
+        ret = yield self._retried(
+            lambda: self._withTransport('get_counter', bucket, key, **params))
+        defer.returnValue(ret)
 
     @defer.inlineCallbacks
     def update_counter(self, bucket, key, value, **params):
@@ -474,8 +1084,8 @@ class PBCTransport(transport.FeatureDetection):
 
         Fetches the value of a Riak Datatype.
 
-        .. note:: This request is automatically retried :attr:`retries`
-           times if it fails due to network error.
+        .. note:: This request is retried if it fails due to a network
+           error, see the retry_policy of the client.
 
         :param bucket: the bucket of the datatype, which must belong to a
           :class:`~riak.BucketType`
@@ -502,18 +1112,27 @@ class PBCTransport(transport.FeatureDetection):
         datatype = yield bucket.get_property('datatype')
         if not datatype:
             raise Exception("Have to be a specific datatype to use datatype")
-        with (yield self._getFreeTransport()) as transport:
+        result = yield self._retried(lambda: self._hedged(
+            'datatype_fetch', lambda attempt: self._fetch_datatype(
+                bucket, key, r, pr, basic_quorum, notfound_ok, timeout,
+                include_context, attempt)))
+        if result.value:
+            result = dt_codec.decode_dtfetch_response(result,bucket,key)
+        else:
+            result = new(datatype,bucket,key)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _fetch_datatype(self, bucket, key, r, pr, basic_quorum, notfound_ok,
+                        timeout, include_context, attempt):
+        with (yield self._getFreeTransport(attempt=attempt)) as transport:
             result = yield transport.fetch_datatype(bucket.name,key,
                                               bucket.bucket_type,r=r,pr=pr,
                                               basic_quorum=basic_quorum,
                                               notfound_ok=notfound_ok,
                                               timeout=timeout,
                                               include_context=include_context)
-            if result.value:
-                result = dt_codec.decode_dtfetch_response(result,bucket,key)
-            else:
-                result = new(datatype,bucket,key)
-            defer.returnValue(result)
+        defer.returnValue(result)
 
     @defer.inlineCallbacks
     def update_datatype(self, datatype, w=None, dw=None,
@@ -587,13 +1206,26 @@ class PBCTransport(transport.FeatureDetection):
 
 
     @defer.inlineCallbacks
-    def get_keys(self, bucket):
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.getKeys(bucket.name,bucket.bucket_type)
+    def get_keys(self, bucket, timeout=None):
+        deadline = self._deadline(timeout)
+        with (yield self._getFreeTransport(deadline)) as transport:
+            ret = yield transport.getKeys(bucket.name,bucket.bucket_type,
+                                          timeout=self._budget(deadline))
         defer.returnValue(ret)
 
     @defer.inlineCallbacks
-    def get_index(self, bucket, index, startkey, endkey=None,return_terms=False, max_results=None, continuation=None,bucket_type = 'default'):
+    def stream_keys(self, bucket, stream, timeout=None):
+        """
+        list the keys of a bucket, writing every chunk to stream as it
+        arrives
+        """
+        deadline = self._deadline(timeout)
+        with (yield self._getFreeTransport(deadline)) as transport:
+            yield transport.streamKeys(bucket.name, stream, bucket.bucket_type,
+                                       timeout=self._budget(deadline))
+        stream.finish()
+
+    def get_index(self, bucket, index, startkey, endkey=None,return_terms=False, max_results=None, continuation=None,bucket_type = 'default', timeout=None):
         '''
         message RpbIndexResp {
             repeated bytes keys = 1;
@@ -603,8 +1235,18 @@ class PBCTransport(transport.FeatureDetection):
         }
         return (results,continuation)
         '''
-        with (yield self._getFreeTransport()) as transport:
-            ret = yield transport.get_index(bucket, index, startkey, endkey=endkey,return_terms=return_terms, max_results=max_results, continuation=continuation,bucket_type=bucket_type)
+        deadline = self._deadline(timeout)
+        return self._retried(lambda: self._hedged(
+            'index', lambda attempt: self._get_index(
+                bucket, index, startkey, endkey, return_terms, max_results,
+                continuation, bucket_type, deadline, attempt)), deadline)
+
+    @defer.inlineCallbacks
+    def _get_index(self, bucket, index, startkey, endkey, return_terms,
+                   max_results, continuation, bucket_type, deadline,
+                   attempt):
+        with (yield self._getFreeTransport(deadline, attempt)) as transport:
+            ret = yield transport.get_index(bucket, index, startkey, endkey=endkey,return_terms=return_terms, max_results=max_results, continuation=continuation,bucket_type=bucket_type, timeout=self._budget(deadline))
             results = []
             if not return_terms or not endkey:
                 for resp in ret:
@@ -621,6 +1263,35 @@ class PBCTransport(transport.FeatureDetection):
                 defer.returnValue(({'keys':results,continuation:None}))
 
 
+    @defer.inlineCallbacks
+    def stream_index(self, bucket, index, startkey, stream, endkey=None,
+                     return_terms=False, max_results=None, continuation=None,
+                     bucket_type='default', timeout=None):
+        '''
+        Secondary index query writing the keys (or (term, key) pairs for
+        range queries with return_terms) of every RpbIndexResp to stream
+        as it arrives. With max_results the query is paged, the next page
+        is requested with the continuation of the previous one until the
+        index is exhausted or the stream is stopped. All pages share the
+        timeout.
+        '''
+        deadline = self._deadline(timeout)
+        if not return_terms or not endkey:
+            stream.decoder = lambda resp: list(resp.keys)
+        else:
+            stream.decoder = lambda resp: [(pair.key, pair.value)
+                                           for pair in resp.results]
+        while True:
+            with (yield self._getFreeTransport(deadline)) as transport:
+                continuation = yield transport.get_index(
+                    bucket, index, startkey, endkey=endkey,
+                    return_terms=return_terms, max_results=max_results,
+                    continuation=continuation, bucket_type=bucket_type,
+                    stream=stream, timeout=self._budget(deadline))
+            if not continuation or stream.isStopped():
+                break
+        stream.finish()
+
     @defer.inlineCallbacks
     def create_search_index(self, index, schema=None, n_val=None):
         if not (yield self.pb_search_admin()):
@@ -733,19 +1404,23 @@ class PBCTransport(transport.FeatureDetection):
         ret = []
         for result in res:
             if result.response:
-                try:
-                    res = self.decodeJson(result.response)
-                    for o in res:
-                        ret.append(o)
-#                    if len(res)>1:
-                        #print res
-                except Exception,e:
-                    log.err( e )
-                    log.err('Error parse mapred ressult')
-                    log.err( traceback.format_exc())
-                    ret.append(result.response)
+                ret.extend(self.decodeRpbMapRedResp(result)[1])
         return ret
 
+    def decodeRpbMapRedResp(self, result):
+        '''
+        decode the results carried by a single RpbMapRedResp
+        return (phase, results)
+        '''
+        try:
+            decoded = self.decodeJson(result.response)
+        except Exception,e:
+            log.err( e )
+            log.err('Error parse mapred ressult')
+            log.err( traceback.format_exc())
+            decoded = [result.response]
+        return result.phase, decoded
+
     def parseRpbGetResp(self, res):
         """
         adaptor for a RpbGetResp message
@@ -757,46 +1432,16 @@ class PBCTransport(transport.FeatureDetection):
         """
         if res == True:         # empty response
             return None
+        values = None
+        if isinstance(res, kv_codec.SpooledGetResp):
+            # the values were left in the spool
+            res, values = res.response, res.values
         vclock = res.vclock
         resList = []
-        for content in res.content:
+        for i, content in enumerate(res.content):
             # iterate over RpbContent field
-            metadata = {MD_USERMETA: {}, MD_INDEX: []}
-            data = content.value
-            if content.HasField('content_type'):
-                metadata[MD_CTYPE] = content.content_type
-
-            if content.HasField('charset'):
-                metadata[MD_CHARSET] = content.charset
-
-            if content.HasField('content_encoding'):
-                metadata[MD_ENCODING] = content.content_encoding
-
-            if content.HasField('vtag'):
-                metadata[MD_VTAG] = content.vtag
-
-            if content.HasField('last_mod'):
-                metadata[MD_LASTMOD] = content.last_mod
-
-            if content.HasField('deleted'):
-                metadata[MD_DELETED] = content.deleted
-
-            if len(content.links):
-                metadata[MD_LINKS] = []
-                for l in content.links:
-                    metadata[MD_LINKS].append(
-                        RiakLink(l.bucket, l.key, l.tag)
-                    )
-
-            if len(content.usermeta):
-                metadata[MD_USERMETA] = {}
-                for md in content.usermeta:
-                    metadata[MD_USERMETA][md.key] = md.value
-
-            if len(content.indexes):
-                metadata[MD_INDEX] = []
-                for ie in content.indexes:
-                    metadata[MD_INDEX].append(RiakIndexEntry(ie.key, ie.value))
+            metadata = decodeContentMetadata(content)
+            data = values[i] if values else content.value
             resList.append((metadata, data))
         return vclock, resList
 
@@ -0,0 +1,79 @@
+"""
+Retrying idempotent requests that failed on the network.
+
+A RiakClient has a RetryPolicy as its retry_policy. The transports use it
+for requests that can safely be sent twice: reads (get, head, secondary
+index and search queries, datatype and counter fetches) and pings. Writes,
+deletes and datatype or counter updates are never retried, Riak may have
+applied them before the connection dropped.
+
+Every retry acquires a transport again, the connection that failed is
+gone by then.
+"""
+
+import random
+import time
+
+from twisted.internet import defer, error, reactor, task
+from twisted.web import client
+
+
+# failures that mean the request may never have reached Riak, or its
+# answer got lost on the way back
+NETWORK_ERRORS = (
+    error.ConnectError,
+    error.ConnectionClosed,
+    client.ResponseFailed,
+    client.ResponseNeverReceived,
+)
+
+
+class RetryPolicy(object):
+    """
+    retry a request failing with one of errors up to retries times.
+    Before retry n it waits a random time (full jitter) of up to
+    backoff * 2 ** n seconds, at most max_backoff.
+
+    :ivar retried: retries done so far
+    """
+    def __init__(self, retries=3, backoff=0.05, max_backoff=2,
+                 errors=NETWORK_ERRORS):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.errors = errors
+        self.retried = 0
+
+    def delay(self, attempt):
+        """
+        seconds to wait before retry attempt (counting from 0)
+        """
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    @defer.inlineCallbacks
+    def call(self, request, deadline=None, metrics=None):
+        """
+        call request, which sends a request and returns a deferred, until
+        it succeeds, fails with an error not to retry on or retries is
+        reached. No retry is started that could not be done before
+        deadline (a time.time() value). Retries are counted in
+        metrics.retries if metrics is given.
+        """
+        attempt = 0
+        while True:
+            try:
+                result = yield request()
+            except self.errors:
+                if attempt >= self.retries:
+                    raise
+                delay = self.delay(attempt)
+                if deadline is not None and time.time() + delay >= deadline:
+                    raise
+                attempt += 1
+                self.retried += 1
+                if metrics is not None:
+                    metrics.retries += 1
+                yield task.deferLater(reactor, delay, lambda: None)
+            else:
+                defer.returnValue(result)
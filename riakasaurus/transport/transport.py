@@ -15,30 +15,40 @@ versions = {
 
 
 class ITransport(Interface):
-    def get_keys(self, bucket):
+    """
+    operations taking a timeout (in seconds) must be done by then, the
+    remaining time is passed on to Riak as well
+    """
+    def get_keys(self, bucket, timeout=None):
         """
         list keys for a given bucket
         """
 
+    def stream_keys(self, bucket, stream, timeout=None):
+        """
+        list keys for a given bucket, writing them chunk by chunk to a
+        riakasaurus.stream.ResultStream
+        """
+
     def put(self, robj, w=None, dw=None, pw=None, return_body=True,
-            if_none_match=False):
+            if_none_match=False, timeout=None):
         """
         store a riak_object
         """
 
     def put_new(self, robj, w=None, dw=None, pw=None, return_body=True,
-                if_none_match=False):
+                if_none_match=False, timeout=None):
         """
         store a riak_object and generate a key for it
         """
 
-    def get(self, robj, r=None, pr=None, vtag=None):
+    def get(self, robj, r=None, pr=None, vtag=None, timeout=None):
         """
         fetch a key from the server
         """
 
     def delete(self, robj, rw=None, r=None, w=None, dw=None, pr=None,
-               pw=None):
+               pw=None, timeout=None):
         """
         delete a key from the bucket
         """
@@ -59,6 +69,12 @@ class ITransport(Interface):
         return the existing buckets
         """
 
+    def stream_buckets(self, stream, bucket_type='default'):
+        """
+        list the existing buckets, writing them chunk by chunk to a
+        riakasaurus.stream.ResultStream
+        """
+
     def ping(self):
         """
         Check server is alive